@@ -1,12 +1,19 @@
+import collections
 import json
 import logging
+import re
 import requests
 import requests.exceptions
 import sys
+import threading
 from typing import List, Union, Optional
 
 from bot_logger import create_logger
+from http_session import TELEGRAM_API_URL, create_http_session
+from kill_formatter import MAX_MESSAGE_LENGTH, utf16_len
+from rate_limit import TelegramRateLimiter
 from savestate import SavedState
+from subscriptions import FILTER_ALIASES, ChatSubscription, SubscriptionIndex, parse_isk_value
 
 
 def create_reply_keyboard_markup(
@@ -30,48 +37,305 @@ def create_reply_keyboard_markup(
     return json.dumps(markup)
 
 
+_MARKDOWN_TOKENS = re.compile(r'\\|```|[*_`\[\]()]')
+
+# entities which can be closed at the end of a message part and reopened in the next one
+_REOPENABLE_ENTITIES = ('*', '_', '`', '```')
+
+
+def _scan_markdown(text: str, state: str = '') -> tuple:
+    """
+    :return: tuple (entity open at the end of text, see markdown_open_entity();
+                    index of '[' starting the link left open, or -1)
+    """
+    pos = 0
+    link_start = -1
+    while True:
+        m = _MARKDOWN_TOKENS.search(text, pos)
+        if m is None:
+            return state, (link_start if state in ('[', '(') else -1)
+        tok = m.group()
+        pos = m.end()
+        if state == '':
+            if tok == '\\':
+                pos += 1  # escaped character
+            elif tok in _REOPENABLE_ENTITIES:
+                state = tok
+            elif tok == '[':
+                state = '['
+                link_start = m.start()
+        elif state == '[':
+            if tok == ']':
+                state = ''
+                if text.startswith('(', pos):
+                    state = '('
+                    pos += 1
+        elif state == '(':
+            if tok == ')':
+                state = ''
+        elif (state == '`') and (tok == '```'):
+            state = ''
+            pos = m.start() + 1
+        elif tok == state:
+            state = ''
+
+
+def markdown_open_entity(text: str, state: str = '') -> str:
+    """
+    Find which telegram (legacy) Markdown entity is left open at the end of text
+    :param text: text
+    :param state: entity open at the beginning of text
+    :return: '' if none, else '*', '_', '`', '```', '[' (link text) or '(' (link url)
+    """
+    return _scan_markdown(text, state)[0]
+
+
+def _escape_open_links(text: str, state: str = '') -> tuple:
+    """
+    Escape '[' of links left open at the end of text, so that they are sent as plain text
+    :return: tuple (text, entity open at its end)
+    """
+    end_state, link_start = _scan_markdown(text, state)
+    while (end_state in ('[', '(')) and (link_start >= 0):
+        text = text[:link_start] + '\\' + text[link_start:]
+        end_state, link_start = _scan_markdown(text, state)
+    return text, end_state
+
+
+def _reopen_marker(state: str) -> str:
+    # code block language would be taken from the rest of the line
+    if state == '```':
+        return '```\n'
+    return state
+
+
+def _split_long_line(line: str, max_length: int, markdown: bool, state: str) -> tuple:
+    """
+    Split a line which does not fit into a message at all: between words if possible
+    :return: tuple (list of complete parts, last incomplete part, entity open at its end)
+    """
+    parts = []
+    start = 0
+    while True:
+        prefix = _reopen_marker(state) if state in _REOPENABLE_ENTITIES else ''
+        # room for closing marker
+        limit = max_length - 4 if markdown else max_length
+        end = start
+        width = utf16_len(prefix)
+        while (end < len(line)) and (width + (2 if ord(line[end]) > 0xFFFF else 1) <= limit):
+            width += 2 if ord(line[end]) > 0xFFFF else 1
+            end += 1
+        if end == start:
+            # max_length is too small for reopened marker, take at least one character
+            end = start + 1
+        if end >= len(line):
+            piece = prefix + line[start:]
+            return parts, piece, markdown_open_entity(line[start:], state) if markdown else ''
+        space = line.rfind(' ', start, end)
+        if space > start:
+            end = space + 1
+        end_state, link_start = _scan_markdown(line[start:end], state) if markdown else ('', -1)
+        piece = line[start:end]
+        if (end_state in ('[', '(')) and (piece[:link_start].strip() != ''):
+            # do not cut links, move whole link to the next part
+            end = start + link_start
+            piece = line[start:end]
+            end_state = markdown_open_entity(piece, state)
+        if end_state in ('[', '('):
+            # link does not fit into a part at all, send it as plain text
+            piece, end_state = _escape_open_links(piece, state)
+        piece = prefix + piece
+        if end_state in _REOPENABLE_ENTITIES:
+            piece += end_state
+        parts.append(piece)
+        start = end
+        state = end_state
+
+
+def split_message_text(text: str, max_length: int = MAX_MESSAGE_LENGTH, parse_mode: str = 'Markdown') -> List[str]:
+    """
+    Split text into parts fitting into a single message each, in a single pass.
+    Text is cut between paragraphs (kills of a digest) if possible, else between lines,
+    and only too long lines are cut between words. Markdown entities are never
+    left unbalanced: entity cut in the middle is closed at the end of a part
+    and reopened at the beginning of the next one. Links are moved whole to the next part,
+    or sent as plain text if they do not fit into a part at all.
+    Length is counted in UTF-16 code units, as telegram does.
+    :param text: message text
+    :param max_length: max length of a part
+    :param parse_mode: message parse mode, entities are kept balanced for 'Markdown'
+    :return: list of parts, non-empty
+    """
+    if utf16_len(text) <= max_length:
+        return [text]
+    markdown = parse_mode == 'Markdown'
+    # room for closing (and reopening) marker of entity, which may be left open at the end of part
+    limit = max_length - 4 if markdown else max_length
+    parts = []
+    cur = []
+    cur_len = 0
+    # entity open at the end of text in cur
+    state = ''
+    # index of the last empty line in cur: part can be cut there between paragraphs
+    para_break = -1
+
+    def flush(num_lines: int) -> None:
+        nonlocal cur, cur_len, state, para_break
+        part_lines = cur[:num_lines]
+        rest = cur[num_lines + 1:]
+        part = '\n'.join(part_lines)
+        part_state, link_start = _scan_markdown(part) if markdown else ('', -1)
+        if (part_state in ('[', '(')) and (part[:link_start].strip() != ''):
+            # do not cut links, move whole link to the next part
+            rest = part[link_start:].split('\n') + cur[num_lines:]
+            part = part[:link_start]
+            part_state = markdown_open_entity(part)
+        if part_state in ('[', '('):
+            # link does not fit into a part at all, send it as plain text
+            part, part_state = _escape_open_links(part)
+        if part_state in _REOPENABLE_ENTITIES:
+            part += part_state
+        if part.strip() != '':
+            parts.append(part)
+        cur = rest
+        para_break = -1
+        if len(cur) < 1:
+            # entity will be reopened by the next line
+            cur_len = 0
+            state = part_state if part_state in _REOPENABLE_ENTITIES else ''
+            return
+        if part_state in _REOPENABLE_ENTITIES:
+            cur[0] = _reopen_marker(part_state) + cur[0]
+        cur_len = sum([utf16_len(line) for line in cur]) + len(cur) - 1
+        for i, line in enumerate(cur):
+            if line == '':
+                para_break = i
+        state = markdown_open_entity('\n'.join(cur)) if markdown else ''
+
+    for line in text.split('\n'):
+        line_len = utf16_len(line)
+        if (len(cur) > 0) and (cur_len + 1 + line_len > limit):
+            if para_break > 0:
+                # cut between paragraphs, dropping the empty line
+                flush(para_break)
+            while (len(cur) > 0) and (cur_len + 1 + line_len > limit):
+                flush(len(cur))
+        if (len(cur) < 1) and (state != ''):
+            # reopen entity closed at the end of previous part
+            line = _reopen_marker(state) + line
+            line_len = utf16_len(line)
+            state = ''
+        if line_len > limit:
+            line_parts, line, state = _split_long_line(line, max_length, markdown, '')
+            parts.extend(line_parts)
+            line_len = utf16_len(line)
+        elif markdown:
+            state = markdown_open_entity(line, state)
+        if len(cur) > 0:
+            cur_len += 1
+        if (line == '') and (len(cur) > 0):
+            para_break = len(cur)
+        cur.append(line)
+        cur_len += line_len
+    if len(cur) > 0:
+        flush(len(cur))
+    return parts
+
+
 class ZKBBot:
-    def __init__(self, token: str):
+    # how many times to retry sending a message after telegram's 429 Too Many Requests
+    SEND_MAX_ATTEMPTS = 5
+
+    def __init__(self, token: str, session: requests.Session = None):
         self.token = token
+        self._session = session
+        if self._session is None:
+            self._session = create_http_session()
         self.last_update_id = 0
+        # recently handled update ids: webhook updates may come out of order,
+        # so the highest id alone can not tell whether an update was seen
+        self._seen_update_ids = set()
+        self._seen_update_ids_order = collections.deque()
+        self._updates_lock = threading.Lock()
         self.chats = {}
         self.chats_notify = []
+        # chat_id => ChatSubscription, chats not in it get all kills
+        self.subscriptions = {}
+        # registered chats by their filters, to quickly find chats to notify about a kill
+        self.subscription_index = SubscriptionIndex()
         self.savestate_filename = 'saved_state.json'
+        # keeps also other parts of state, not owned by bot (ZKB cursor)
+        self.saved_state = SavedState()
+        # guards saving and also changes of chats_notify and subscriptions,
+        # which are made from telegram updates thread; save_state() is reentrant under it
+        self._save_lock = threading.RLock()
+        self.rate_limiter = TelegramRateLimiter()
         self.log = create_logger(__name__, level=logging.DEBUG, stream=sys.stdout, filename='bot.log')
 
     def load_state(self) -> bool:
         ss = SavedState()
         if ss.load(self.savestate_filename):
+            self.saved_state = ss
             self.chats_notify = ss.involved_chatids
+            self.subscriptions = {}
+            for str_chat_id, sub_dict in ss.subscriptions.items():
+                # JSON object keys are always strings
+                chat_id = int(str_chat_id) if str_chat_id.lstrip('-').isdigit() else str_chat_id
+                self.subscriptions[chat_id] = ChatSubscription.from_dict(chat_id, sub_dict)
+            self.subscription_index.rebuild(self.subscriptions, self.chats_notify)
             self.log.debug('Loaded save state, involved chats: {}'.format(self.chats_notify))
             return True
         self.log.debug('Could not load save state')
         return False
 
     def save_state(self) -> bool:
-        ss = SavedState()
-        ss.involved_chatids = self.chats_notify
-        ok = ss.save(self.savestate_filename)
+        with self._save_lock:
+            ss = self.saved_state
+            ss.involved_chatids = list(self.chats_notify)
+            ss.subscriptions = {str(chat_id): sub.to_dict() for chat_id, sub in self.subscriptions.items()}
+            ok = ss.save(self.savestate_filename)
         self.log.debug('Saving state... ok={}'.format(ok))
+        return ok
 
-    def tg_bot_api_call_method_get(self, method_name: str, params: dict = None) -> Optional[requests.Response]:
-        url = 'https://api.telegram.org/bot{}/{}'.format(self.token, method_name)
-        # self.log.debug('Requesting url: {}'.format(url))
-        # headers = {
-        #    'content-type', ''
-        # }
+    def tg_bot_api_call(self, method_name: str, params: dict = None) -> Optional[dict]:
+        """
+        Call telegram bot API method
+        :return: full reply object, also for errors ({'ok': False, 'error_code': 429, ...}),
+                 or None if request failed
+        """
+        url = '{}bot{}/{}'.format(TELEGRAM_API_URL, self.token, method_name)
         try:
-            response = requests.get(url, params=params, timeout=15)
-            # response.raise_for_status()
+            response = self._session.get(url, params=params, timeout=15)
             rjson = response.json()
             if not rjson['ok']:
                 self.log.error('Request "{}" error: {}'.format(method_name, rjson['description']))
-                return None
-            return response
-        except requests.exceptions.RequestException as re:
+            return rjson
+        except requests.exceptions.RequestException:
             self.log.exception('Exception during telegram API call', exc_info=True)
+        except ValueError:
+            self.log.error('Request "{}" error: failed to parse reply'.format(method_name))
         return None
 
+    def tg_bot_api_call_method_get(self, method_name: str, params: dict = None) -> Optional[dict]:
+        rjson = self.tg_bot_api_call(method_name, params)
+        if (rjson is None) or (not rjson['ok']):
+            return None
+        return rjson
+
+    def mark_update_seen(self, update_id: int, max_remembered: int = 1000) -> bool:
+        """
+        :return: True if update was not handled yet, False for repeated ones
+        """
+        with self._updates_lock:
+            if update_id in self._seen_update_ids:
+                return False
+            self._seen_update_ids.add(update_id)
+            self._seen_update_ids_order.append(update_id)
+            while len(self._seen_update_ids_order) > max_remembered:
+                self._seen_update_ids.discard(self._seen_update_ids_order.popleft())
+            self.last_update_id = max(self.last_update_id, update_id)
+            return True
+
     def get_updates(self, last_update_id: int = -1) -> list:
         ret = []
         r = self.tg_bot_api_call_method_get('getUpdates', params={
@@ -80,10 +344,34 @@ class ZKBBot:
         })
         if r is None:
             return ret
-        reply = r.json()
-        ret = reply['result']
+        ret = r['result']
         return ret
 
+    def set_webhook(self, url: str, secret_token: str = '', max_connections: int = 40) -> bool:
+        """
+        Make telegram push updates to url instead of waiting for getUpdates.
+        See https://core.telegram.org/bots/api#setwebhook
+        :param url: HTTPS url of webhook
+        :param secret_token: sent back in X-Telegram-Bot-Api-Secret-Token header of every request
+        :param max_connections: max number of simultaneous connections telegram can open
+        :return: True if ok
+        """
+        params = {
+            'url': url,
+            'max_connections': max_connections,
+            'allowed_updates': json.dumps(['message'])
+        }
+        if secret_token != '':
+            params['secret_token'] = secret_token
+        return self.tg_bot_api_call_method_get('setWebhook', params) is not None
+
+    def delete_webhook(self) -> bool:
+        """
+        Remove webhook, getUpdates works only without it
+        :return: True if ok
+        """
+        return self.tg_bot_api_call_method_get('deleteWebhook') is not None
+
     def send_message_text(self, chat_id: Union[str, int], text: str, parse_mode: str = 'Markdown',
                           disable_web_page_preview: bool = False, disable_notification: bool = False,
                           reply_to_message_id: int = 0, reply_markup: str = None) -> bool:
@@ -98,18 +386,18 @@ class ZKBBot:
         :param reply_markup:
         :return:
         """
+        return self.try_send_message_text(chat_id, text, parse_mode, disable_web_page_preview,
+                                          disable_notification, reply_to_message_id, reply_markup) == 0
 
-        text_parts = []
-
-        if len(text) > 4096:
-            while len(text) > 4096:
-                text_part = text[0:4096]
-                text_parts.append(text_part)
-                text = text[4096:]
-
-        text_parts.append(text)
-
-        for a_text in text_parts:
+    def try_send_message_text(self, chat_id: Union[str, int], text: str, parse_mode: str = 'Markdown',
+                              disable_web_page_preview: bool = False, disable_notification: bool = False,
+                              reply_to_message_id: int = 0, reply_markup: str = None) -> int:
+        """
+        Same as send_message_text(), but tells why sending failed
+        :return: 0 if sent, telegram's error_code (like 403 if bot was blocked by user),
+                 or -1 if request failed (network errors, no valid reply)
+        """
+        for a_text in split_message_text(text, MAX_MESSAGE_LENGTH, parse_mode):
             params = {
                 'chat_id': chat_id,
                 'text': a_text,
@@ -121,11 +409,106 @@ class ZKBBot:
                 params['reply_to_message_id'] = reply_to_message_id
             if reply_markup is not None:
                 params['reply_markup'] = reply_markup
-            r = self.tg_bot_api_call_method_get('sendMessage', params=params)
-            if r is None:
+            error_code = self._send_with_retries(chat_id, params)
+            if error_code != 0:
+                return error_code
+        return 0
+
+    def _send_with_retries(self, chat_id: Union[str, int], params: dict) -> int:
+        """
+        :return: 0 if sent, telegram's error_code or -1, see try_send_message_text()
+        """
+        error_code = -1
+        for attempt in range(self.SEND_MAX_ATTEMPTS):
+            self.rate_limiter.acquire(chat_id)
+            rjson = self.tg_bot_api_call('sendMessage', params=params)
+            if rjson is None:
+                return -1
+            if rjson['ok']:
+                return 0
+            error_code = int(rjson.get('error_code', -1))
+            # 429 Too Many Requests: {'ok': False, 'error_code': 429, 'parameters': {'retry_after': 5}, ...}
+            retry_after = rjson.get('parameters', {}).get('retry_after')
+            if retry_after is None:
+                return error_code
+            self.log.warning('Flood limit hit, pausing sending for {} seconds'.format(retry_after))
+            self.rate_limiter.pause(retry_after)
+        return error_code
+
+    def unregister_chat(self, chat_id: Union[str, int]) -> bool:
+        """
+        Stop sending notifications to chat, its filters are kept
+        :return: True if chat was registered
+        """
+        with self._save_lock:
+            if chat_id not in self.chats_notify:
                 return False
+            self.log.info('unregistered chat {}'.format(chat_id))
+            self.chats_notify.remove(chat_id)
+            self.subscription_index.remove_chat(chat_id)
+            self.save_state()
         return True
 
+    def handle_subscription_command(self, chat_id: Union[str, int], command: str, args: List[str]) -> str:
+        """
+        Change kill filters of a chat:
+            /sub corp 98000001 98000002, /sub isk 500m, /unsub region 10000002, /unsub all, /subs
+        :return: reply text
+        """
+        usage = 'Usage: /sub <filter> <id> [<id> ...], /sub isk <min value>, ' \
+                '/unsub <filter> <id> [<id> ...], /unsub isk, /unsub all, /subs\n' \
+                'Filters: char, corp, alliance, system, region, group, ship.'
+        sub = self.subscriptions.get(chat_id)
+        if sub is None:
+            sub = ChatSubscription(chat_id)
+        else:
+            # change a copy, stored one may be being saved right now
+            sub = sub.copy()
+        if command == '/subs':
+            return sub.describe()
+        if len(args) < 1:
+            return usage
+        filter_name = args[0].lower()
+        if (command == '/unsub') and (filter_name == 'all'):
+            sub = ChatSubscription(chat_id)
+        elif filter_name == 'isk':
+            if command == '/sub':
+                if len(args) != 2:
+                    return usage
+                try:
+                    sub.min_isk = parse_isk_value(args[1])
+                except ValueError:
+                    return 'Invalid ISK value: {}'.format(args[1])
+            else:
+                sub.min_isk = 0.0
+        elif (filter_name in FILTER_ALIASES) and (len(args) > 1):
+            try:
+                ids = set([int(arg) for arg in args[1:]])
+            except ValueError:
+                ids = set()
+            if (len(ids) < 1) or (min(ids) <= 0):
+                return 'Ids should be positive numbers.\n' + usage
+            if command == '/sub':
+                sub.ids[FILTER_ALIASES[filter_name]].update(ids)
+            else:
+                sub.ids[FILTER_ALIASES[filter_name]].difference_update(ids)
+        else:
+            return usage
+        with self._save_lock:
+            if chat_id not in self.chats_notify:
+                if command == '/unsub':
+                    # removing filters must not register a chat to get all kills
+                    return 'This chat is not registered, nothing to change. Use /reg or /sub to register.'
+                self.log.info('registered new chat to notify: {}'.format(chat_id))
+                self.chats_notify.append(chat_id)
+            if sub.is_empty():
+                self.subscriptions.pop(chat_id, None)
+            else:
+                self.subscriptions[chat_id] = sub
+            self.subscription_index.update_chat(chat_id, self.subscriptions.get(chat_id))
+            self.save_state()
+        return 'Ok. Current filters:\n' + sub.describe()
+
     def handle_message(self, message: dict) -> None:
         # 'message': {
         #     'chat': {'id': 137769336, 'first_name': 'Alexey', 'last_name': 'Minnekhanov',
@@ -146,7 +529,8 @@ class ZKBBot:
             if 'text' in message:
                 if message['text'].startswith('/start'):
                     text = 'Hello! You can register to receive notifications from ZKillboard using /reg ' \
-                           'command, and unregister using /unreg command.'
+                           'command, and unregister using /unreg command. Use /sub to receive only ' \
+                           'some kills, see /help.'
                     reply_markup = create_reply_keyboard_markup(
                         [['/reg', '/unreg']], resize_keyboard=True)
                     self.send_message_text(chat['id'], text, 'Markdown', True, False, 0, reply_markup)
@@ -155,19 +539,31 @@ class ZKBBot:
                            'Commands: \n' \
                            '/reg - Register to receive notifications\n' \
                            '/unreg - Unregister from receiving notifications\n' \
+                           '/sub <filter> <id> [<id> ...] - Show only kills involving given ' \
+                           'char, corp, alliance, system, region, (ship) group or ship type\n' \
+                           '/sub isk <value> - Show only kills worth at least value (like 500m or 1.5b)\n' \
+                           '/unsub <filter> <id>, /unsub isk, /unsub all - Remove filters\n' \
+                           '/subs - Show current filters\n' \
                            '/help - This help message.'
                     self.send_message_text(chat['id'], text)
+                command_args = message['text'].split()
+                command = command_args[0].split('@')[0] if len(command_args) > 0 else ''
+                if command in ('/sub', '/unsub', '/subs'):
+                    text = self.handle_subscription_command(chat['id'], command, command_args[1:])
+                    self.send_message_text(chat['id'], text, reply_to_message_id=message_id)
                 if message['text'].startswith('/reg'):
-                    if chat['id'] not in self.chats_notify:
-                        self.log.info('registered new chat to notify: {}'.format(chat['id']))
-                        self.chats_notify.append(chat['id'])
-                        self.save_state()
+                    registered = False
+                    with self._save_lock:
+                        if chat['id'] not in self.chats_notify:
+                            self.log.info('registered new chat to notify: {}'.format(chat['id']))
+                            self.chats_notify.append(chat['id'])
+                            self.subscription_index.update_chat(chat['id'], self.subscriptions.get(chat['id']))
+                            self.save_state()
+                            registered = True
+                    if registered:
                         self.send_message_text(chat['id'], 'Ok, registered.', reply_to_message_id=message_id)
                 if message['text'].startswith('/unreg'):
-                    if chat['id'] in self.chats_notify:
-                        self.log.info('unregistered chat {}'.format(chat['id']))
-                        self.chats_notify.remove(chat['id'])
-                        self.save_state()
+                    if self.unregister_chat(chat['id']):
                         self.send_message_text(chat['id'], 'Unregistered.', reply_to_message_id=message_id)
             else:
                 self.log.debug('Got message with no text: {}'.format(message))
@@ -0,0 +1,76 @@
+import collections
+import threading
+from typing import Iterable, List
+
+
+class KillIdDedup:
+    """
+    Bounded set of already displayed kill ids, O(1) lookups.
+    Remembers at most max_size most recently added ids, older ids are evicted.
+
+    Ids go through two stages: pending (being processed, not yet safely
+    queued for sending) and confirmed. Both are checked by "in", but only
+    confirmed ids are exported by to_list() for saving, so after a restart
+    pending kills are processed again instead of being lost.
+    """
+    def __init__(self, max_size: int = 5000):
+        self.max_size = max_size
+        self._ids = set()
+        self._order = collections.deque()
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def __contains__(self, killid: int) -> bool:
+        with self._lock:
+            return (killid in self._ids) or (killid in self._pending)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._ids)
+
+    def add_pending(self, killid: int) -> bool:
+        """
+        :return: True if killid is new, False if it was already seen
+        """
+        with self._lock:
+            if (killid in self._ids) or (killid in self._pending):
+                return False
+            self._pending.add(killid)
+            return True
+
+    def confirm(self, killids: Iterable[int]) -> None:
+        with self._lock:
+            for killid in killids:
+                self._pending.discard(killid)
+                self._add(killid)
+
+    def _add(self, killid: int) -> None:
+        if killid in self._ids:
+            return
+        self._ids.add(killid)
+        self._order.append(killid)
+        while len(self._order) > self.max_size:
+            self._ids.discard(self._order.popleft())
+
+    def add(self, killid: int) -> bool:
+        """
+        Add confirmed id directly
+        :return: True if killid is new, False if it was already seen
+        """
+        with self._lock:
+            if (killid in self._ids) or (killid in self._pending):
+                return False
+            self._add(killid)
+            return True
+
+    def to_list(self) -> List[int]:
+        """
+        :return: confirmed ids, oldest first
+        """
+        with self._lock:
+            return list(self._order)
+
+    def load_list(self, killids: Iterable[int]) -> None:
+        with self._lock:
+            for killid in killids:
+                self._add(int(killid))
@@ -0,0 +1,98 @@
+import concurrent.futures
+import logging
+import sys
+from typing import Union, Iterable, List
+
+from bot import ZKBBot
+from bot_logger import create_logger
+from send_queue import OutgoingMessage, SendQueue
+
+
+class DeliveryEngine:
+    """
+    Sends the same message to many chats concurrently.
+    Telegram limits are honoured by the bot's rate limiter,
+    so the number of workers only bounds the number of requests in flight.
+    Chats which blocked the bot (error 403) are unregistered.
+    """
+    # telegram error codes which will not go away on retry:
+    # 400 chat not found or bad markup, 403 bot was blocked by user or kicked from chat
+    PERMANENT_ERRORS = (400, 403)
+
+    def __init__(self, bot: ZKBBot, max_workers: int = 8):
+        self.bot = bot
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.log = create_logger(__name__, level=logging.DEBUG, stream=sys.stdout, filename='bot.log')
+
+    def _send(self, chat_id: Union[str, int], text: str, parse_mode: str,
+              disable_web_page_preview: bool) -> int:
+        """
+        :return: 0 if sent, else error code, see ZKBBot.try_send_message_text()
+        """
+        try:
+            error_code = self.bot.try_send_message_text(chat_id, text, parse_mode, disable_web_page_preview)
+        except Exception:
+            self.log.exception('Failed to send message to chat {}'.format(chat_id))
+            return -1
+        if error_code == 403:
+            self.log.warning('Chat {} blocked the bot, unregistering it'.format(chat_id))
+            self.bot.unregister_chat(chat_id)
+        return error_code
+
+    def deliver(self, chat_ids: Iterable[Union[str, int]], text: str, parse_mode: str = 'Markdown',
+                disable_web_page_preview: bool = False) -> dict:
+        """
+        Send text to all chat_ids, wait until all are done
+        :return: dict chat_id => True if sent ok
+        """
+        futures = dict()
+        for chat_id in chat_ids:
+            future = self._executor.submit(self._send, chat_id, text, parse_mode, disable_web_page_preview)
+            futures[future] = chat_id
+        ret = dict()
+        for future in concurrent.futures.as_completed(futures):
+            ret[futures[future]] = future.result() == 0
+        num_failed = len([ok for ok in ret.values() if not ok])
+        if num_failed > 0:
+            self.log.warning('Failed to deliver to {} of {} chats'.format(num_failed, len(ret)))
+        return ret
+
+    def deliver_messages(self, messages: List[OutgoingMessage]) -> dict:
+        """
+        Send a list of different messages concurrently, wait until all are done
+        :return: dict msg_id => 0 if sent ok, else error code, see ZKBBot.try_send_message_text()
+        """
+        futures = dict()
+        for m in messages:
+            future = self._executor.submit(self._send, m.chat_id, m.text, m.parse_mode,
+                                           m.disable_web_page_preview)
+            futures[future] = m.msg_id
+        ret = dict()
+        for future in concurrent.futures.as_completed(futures):
+            ret[futures[future]] = future.result()
+        return ret
+
+    def process_queue(self, queue: SendQueue, limit: int = 100) -> int:
+        """
+        Send one batch of due messages from the persistent queue.
+        Messages failed with permanent errors are not retried.
+        :return: number of messages taken from the queue
+        """
+        messages = queue.fetch_due(limit)
+        if len(messages) < 1:
+            return 0
+        results = self.deliver_messages(messages)
+        num_failed = 0
+        for msg_id, error_code in results.items():
+            if error_code == 0:
+                queue.mark_sent(msg_id)
+                continue
+            num_failed += 1
+            queue.mark_failed(msg_id, 'sendMessage failed, error code {}'.format(error_code),
+                              permanent=error_code in self.PERMANENT_ERRORS)
+        if num_failed > 0:
+            self.log.warning('Failed to send {} of {} messages'.format(num_failed, len(results)))
+        return len(messages)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True)
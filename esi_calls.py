@@ -1,8 +1,23 @@
+import collections
+import concurrent.futures
+import email.utils
+import hashlib
 import json
 import os
 import os.path
+import threading
+import time
+from typing import Optional
+
 import requests
 
+from http_session import create_http_session
+from rate_limit import ESIErrorLimiter
+
+
+# error budget is per client IP, so all ESICalls objects share one limiter by default
+shared_error_limiter = ESIErrorLimiter()
+
 
 class ESIException(Exception):
     def __init__(self, msg: str = ''):
@@ -39,37 +54,210 @@ def analyze_esi_response_headers(headers: dict) -> None:
         pass
 
 
+class ESICacheEntry:
+    def __init__(self, data, etag: str = '', expires_at: float = 0):
+        self.data = data
+        self.etag = etag
+        self.expires_at = expires_at
+
+
+def get_expires_at(headers: dict) -> float:
+    """
+    :param headers: ESI response headers
+    :return: unix timestamp when response expires, 0 if it is not cacheable
+    """
+    if 'expires' not in headers:
+        return 0
+    try:
+        return email.utils.parsedate_to_datetime(headers['expires']).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return 0
+
+
+class ESIResponseCache:
+    """
+    Caches ESI responses until time given by Expires header. Recently used
+    responses are kept in memory and served without any I/O; responses are
+    also stored on disk to survive restarts, see cleanup() for removing old ones. Expired responses having ETag are
+    revalidated with If-None-Match, so unchanged data costs only a 304.
+    """
+    def __init__(self, cache_dir: str = './cache/esi', max_memory_entries: int = 1000):
+        self.cache_dir = cache_dir
+        self.max_memory_entries = max_memory_entries
+        self.hits = 0
+        self.misses = 0
+        self._memory = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(method: str, url: str, params: dict = None, body=None) -> str:
+        key = method + ' ' + url
+        if params:
+            key += '?' + '&'.join(['{}={}'.format(k, params[k]) for k in sorted(params.keys())])
+        if body is not None:
+            key += ' ' + json.dumps(body, sort_keys=True)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def _filename(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def _remember(self, key: str, entry: ESICacheEntry) -> None:
+        with self._lock:
+            self._memory[key] = entry
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_entries:
+                self._memory.popitem(last=False)
+
+    def get_entry(self, key: str) -> Optional[ESICacheEntry]:
+        """
+        :return: cached entry, maybe expired, or None
+        """
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                return entry
+        try:
+            with open(self._filename(key), 'rt', encoding='utf-8') as f:
+                obj = json.load(f)
+            entry = ESICacheEntry(obj['data'], obj['etag'], obj['expires_at'])
+        except (IOError, ValueError, KeyError):
+            return None
+        self._remember(key, entry)
+        return entry
+
+    def get_fresh(self, key: str):
+        """
+        :return: cached response data if not expired yet, else None
+        """
+        entry = self.get_entry(key)
+        if (entry is not None) and (entry.expires_at > time.time()):
+            self.hits += 1
+            return entry.data
+        self.misses += 1
+        return None
+
+    def save(self, key: str, entry: ESICacheEntry, persist: bool = True) -> None:
+        """
+        :param key: cache key
+        :param entry: response to cache
+        :param persist: also store on disk, False to keep only in memory
+        """
+        self._remember(key, entry)
+        if not persist:
+            return
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            fn = self._filename(key)
+            with open(fn + '.tmp', 'wt', encoding='utf-8') as f:
+                json.dump({'data': entry.data, 'etag': entry.etag, 'expires_at': entry.expires_at}, f)
+            os.replace(fn + '.tmp', fn)
+        except IOError:
+            pass
+
+    def cleanup(self, max_age: float = 7 * 24 * 3600) -> int:
+        """
+        Remove disk entries not stored or revalidated for max_age seconds.
+        Entries are kept for a while after they expire, to be revalidated by ETag.
+        :param max_age: age in seconds
+        :return: number of removed files
+        """
+        num_removed = 0
+        older_than = time.time() - max_age
+        try:
+            names = os.listdir(self.cache_dir)
+        except IOError:
+            return 0
+        for name in names:
+            fn = os.path.join(self.cache_dir, name)
+            try:
+                if os.path.getmtime(fn) < older_than:
+                    os.remove(fn)
+                    num_removed += 1
+            except IOError:
+                pass
+        return num_removed
+
+
 class ESICalls:
-    def __init__(self):
+    # max number of ids ESI accepts in a single /universe/names/ request
+    UNIVERSE_NAMES_MAX_IDS = 1000
+
+    # max number of requests sent in parallel
+    MAX_PARALLEL_REQUESTS = 4
+
+    def __init__(self, session: requests.Session = None, cache: ESIResponseCache = None,
+                 error_limiter: ESIErrorLimiter = None):
         self.ESI_BASE_URL = 'https://esi.tech.ccp.is/latest'
         self.SSO_USER_AGENT = 'ESI python agent, alexey.min@gmail.com'
+        self._session = session
+        if self._session is None:
+            self._session = create_http_session()
+        self._cache = cache
+        self.error_limiter = error_limiter
+        if self.error_limiter is None:
+            self.error_limiter = shared_error_limiter
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.MAX_PARALLEL_REQUESTS)
 
-    def characters_names(self, ids_list: list) -> list:
-        ret = []
+    def _esi_request(self, method: str, url: str, params: dict = None, body=None,
+                     accept_statuses: tuple = (), persist: bool = True):
+        """
+        Send request to ESI (or take response from cache), parse response JSON
+        :param method: 'GET' or 'POST'
+        :param url: full url
+        :param params: query string parameters
+        :param body: object to send as JSON request body
+        :param accept_statuses: error HTTP statuses to return as (status, None) instead of raising
+        :param persist: store response in disk cache, not only in memory
+        :return: tuple (HTTP status, parsed response)
+        :raises ESIException: on any error
+        """
         error_str = ''
-        if len(ids_list) < 0:
-            return ret
+        key = ''
+        cache_entry = None
+        headers = {
+            'Content-Type': 'application/json',
+            'Accept': 'application/json',
+            'User-Agent': self.SSO_USER_AGENT
+        }
+        if self._cache is not None:
+            key = self._cache.make_key(method, url, params, body)
+            data = self._cache.get_fresh(key)
+            if data is not None:
+                return 200, data
+            cache_entry = self._cache.get_entry(key)
+            if (cache_entry is not None) and (cache_entry.etag != ''):
+                headers['If-None-Match'] = cache_entry.etag
         try:
-            # https://esi.tech.ccp.is/latest/#!/Character/get_characters_names
-            # This route is cached for up to 3600 seconds
-            url = '{}/characters/names/'.format(self.ESI_BASE_URL)
-            ids_str = ''
-            for an_id in set(ids_list):
-                if len(ids_str) > 0:
-                    ids_str += ','
-                ids_str += str(an_id)
-            r = requests.get(url,
-                             params={'character_ids': ids_str},
-                             headers={
-                                 'Content-Type': 'application/json',
-                                 'Accept': 'application/json',
-                                 'User-Agent': self.SSO_USER_AGENT
-                             },
-                             timeout=20)
+            data = None
+            if body is not None:
+                data = json.dumps(body)
+            self.error_limiter.acquire()
+            try:
+                r = self._session.request(method, url, params=params, data=data, headers=headers, timeout=20)
+            except requests.exceptions.RequestException:
+                self.error_limiter.release(0)
+                raise
+            self.error_limiter.release(r.status_code, r.headers)
             response_text = r.text
             if r.status_code == 200:
                 ret = json.loads(response_text)
                 analyze_esi_response_headers(r.headers)
+                if self._cache is not None:
+                    self._cache.save(key, ESICacheEntry(ret, r.headers.get('etag', ''),
+                                                        get_expires_at(r.headers)), persist)
+                return 200, ret
+            elif (r.status_code == 304) and (cache_entry is not None):
+                # not modified, extend cached response lifetime
+                cache_entry.expires_at = get_expires_at(r.headers)
+                self._cache.save(key, cache_entry, persist)
+                return 200, cache_entry.data
+            elif r.status_code in accept_statuses:
+                return r.status_code, None
+            elif r.status_code == 420:
+                error_str = 'ESI error limit reached, requests paused for {:.0f} seconds'.format(
+                    self.error_limiter.metrics()['paused_for_secs'])
             else:
                 obj = json.loads(response_text)
                 if 'error' in obj:
@@ -80,151 +268,162 @@ class ESICalls:
             error_str = 'Error connection to ESI server: {}'.format(str(e))
         except json.JSONDecodeError:
             error_str = 'Failed to parse response JSON from CCP ESI server!'
-        if error_str != '':
-            raise ESIException(error_str)
-        return ret
+        raise ESIException(error_str)
+
+    def characters_names(self, ids_list: list) -> list:
+        if len(ids_list) < 1:
+            return []
+        # https://esi.tech.ccp.is/latest/#!/Character/get_characters_names
+        # This route is cached for up to 3600 seconds
+        url = '{}/characters/names/'.format(self.ESI_BASE_URL)
+        ids_str = ','.join([str(an_id) for an_id in sorted(set(ids_list))])
+        return self._esi_request('GET', url, params={'character_ids': ids_str})[1]
 
     def corporations_names(self, ids_list: list) -> list:
-        ret = []
-        error_str = ''
-        if len(ids_list) < 0:
-            return ret
-        try:
-            # https://esi.tech.ccp.is/latest/#!/Corporation/get_corporations_names
-            # This route is cached for up to 3600 seconds
-            url = '{}/corporations/names/'.format(self.ESI_BASE_URL)
-            ids_str = ''
-            for an_id in set(ids_list):
-                if len(ids_str) > 0:
-                    ids_str += ','
-                ids_str += str(an_id)
-            r = requests.get(url,
-                             params={'corporation_ids': ids_str},
-                             headers={
-                                 'Content-Type': 'application/json',
-                                 'Accept': 'application/json',
-                                 'User-Agent': self.SSO_USER_AGENT
-                             },
-                             timeout=20)
-            response_text = r.text
-            if r.status_code == 200:
-                ret = json.loads(response_text)
-                analyze_esi_response_headers(r.headers)
-            else:
-                obj = json.loads(response_text)
-                if 'error' in obj:
-                    error_str = 'ESI error: {}'.format(obj['error'])
-                else:
-                    error_str = 'Error connecting to ESI server: HTTP status {}'.format(r.status_code)
-        except requests.exceptions.RequestException as e:
-            error_str = 'Error connection to ESI server: {}'.format(str(e))
-        except json.JSONDecodeError:
-            error_str = 'Failed to parse response JSON from CCP ESI server!'
-        if error_str != '':
-            raise ESIException(error_str)
-        return ret
+        if len(ids_list) < 1:
+            return []
+        # https://esi.tech.ccp.is/latest/#!/Corporation/get_corporations_names
+        # This route is cached for up to 3600 seconds
+        url = '{}/corporations/names/'.format(self.ESI_BASE_URL)
+        ids_str = ','.join([str(an_id) for an_id in sorted(set(ids_list))])
+        return self._esi_request('GET', url, params={'corporation_ids': ids_str})[1]
 
     def alliances_names(self, ids_list: list) -> list:
-        ret = []
-        error_str = ''
-        if len(ids_list) < 0:
-            return ret
-        try:
-            # https://esi.tech.ccp.is/latest/#!/Alliance/get_alliances_names
-            # This route is cached for up to 3600 seconds
-            url = '{}/alliances/names/'.format(self.ESI_BASE_URL)
-            ids_str = ''
-            for an_id in set(ids_list):
-                if len(ids_str) > 0:
-                    ids_str += ','
-                ids_str += str(an_id)
-            r = requests.get(url,
-                             params={'alliance_ids': ids_str},
-                             headers={
-                                 'Content-Type': 'application/json',
-                                 'Accept': 'application/json',
-                                 'User-Agent': self.SSO_USER_AGENT
-                             },
-                             timeout=20)
-            response_text = r.text
-            if r.status_code == 200:
-                ret = json.loads(response_text)
-            else:
-                obj = json.loads(response_text)
-                if 'error' in obj:
-                    error_str = 'ESI error: {}'.format(obj['error'])
-                else:
-                    error_str = 'Error connecting to ESI server: HTTP status {}'.format(r.status_code)
-        except requests.exceptions.RequestException as e:
-            error_str = 'Error connection to ESI server: {}'.format(str(e))
-        except json.JSONDecodeError:
-            error_str = 'Failed to parse response JSON from CCP ESI server!'
-        if error_str != '':
-            raise ESIException(error_str)
-        return ret
+        if len(ids_list) < 1:
+            return []
+        # https://esi.tech.ccp.is/latest/#!/Alliance/get_alliances_names
+        # This route is cached for up to 3600 seconds
+        url = '{}/alliances/names/'.format(self.ESI_BASE_URL)
+        ids_str = ','.join([str(an_id) for an_id in sorted(set(ids_list))])
+        return self._esi_request('GET', url, params={'alliance_ids': ids_str})[1]
 
     def get_universe_solarsystem(self, ssid: int) -> dict:
-        ret = {}
-        error_str = ''
         if ssid < 0:
-            return ret
-        try:
-            # https://esi.tech.ccp.is/ui/#/Universe/get_universe_systems_system_id
-            # This route expires daily at 11:05
-            url = '{}/universe/systems/{}/'.format(self.ESI_BASE_URL, ssid)
-            r = requests.get(url,
-                             headers={
-                                 'Content-Type': 'application/json',
-                                 'Accept': 'application/json',
-                                 'User-Agent': self.SSO_USER_AGENT
-                             },
-                             timeout=20)
-            response_text = r.text
-            if r.status_code == 200:
-                ret = json.loads(response_text)
-            else:
-                obj = json.loads(response_text)
-                if 'error' in obj:
-                    error_str = 'ESI error: {}'.format(obj['error'])
-                else:
-                    error_str = 'Error connecting to ESI server: HTTP status {}'.format(r.status_code)
-        except requests.exceptions.RequestException as e:
-            error_str = 'Error connection to ESI server: {}'.format(str(e))
-        except json.JSONDecodeError:
-            error_str = 'Failed to parse response JSON from CCP ESI server!'
-        if error_str != '':
-            raise ESIException(error_str)
-        return ret
+            return {}
+        # https://esi.tech.ccp.is/ui/#/Universe/get_universe_systems_system_id
+        # This route expires daily at 11:05
+        url = '{}/universe/systems/{}/'.format(self.ESI_BASE_URL, ssid)
+        return self._esi_request('GET', url)[1]
 
     def get_universe_type(self, typeid: int) -> dict:
-        ret = {}
-        error_str = ''
         if typeid < 0:
-            return ret
-        try:
-            # https://esi.tech.ccp.is/ui/#/Universe/get_universe_types_type_id
-            # This route expires daily at 11:05
-            url = '{}/universe/types/{}/'.format(self.ESI_BASE_URL, typeid)
-            r = requests.get(url,
-                             headers={
-                                 'Content-Type': 'application/json',
-                                 'Accept': 'application/json',
-                                 'User-Agent': self.SSO_USER_AGENT
-                             },
-                             timeout=20)
-            response_text = r.text
-            if r.status_code == 200:
-                ret = json.loads(response_text)
+            return {}
+        # https://esi.tech.ccp.is/ui/#/Universe/get_universe_types_type_id
+        # This route expires daily at 11:05
+        url = '{}/universe/types/{}/'.format(self.ESI_BASE_URL, typeid)
+        return self._esi_request('GET', url)[1]
+
+    def get_universe_constellation(self, constellation_id: int) -> dict:
+        if constellation_id < 0:
+            return {}
+        # https://esi.tech.ccp.is/ui/#/Universe/get_universe_constellations_constellation_id
+        # This route expires daily at 11:05
+        url = '{}/universe/constellations/{}/'.format(self.ESI_BASE_URL, constellation_id)
+        return self._esi_request('GET', url)[1]
+
+    @staticmethod
+    def _successful_results(futures: dict) -> dict:
+        """
+        Wait for all requests; a failed one does not discard results of others
+        :param futures: dict id => future of request
+        :return: dict id => reply, only for successful requests
+        """
+        ret = dict()
+        for iid, future in futures.items():
+            try:
+                ret[iid] = future.result()
+            except ESIException:
+                pass
+        return ret
+
+    def universe_types_groups(self, type_ids: list) -> dict:
+        """
+        Find group of each type, requests are sent in parallel
+        :param type_ids: list of type ids
+        :return: dict type_id => group_id, types which failed to resolve are missing
+        """
+        ret = dict()
+        futures = dict()
+        for type_id in set(type_ids):
+            futures[type_id] = self._executor.submit(self.get_universe_type, type_id)
+        for type_id, reply in self._successful_results(futures).items():
+            if 'group_id' in reply:
+                ret[type_id] = int(reply['group_id'])
+        return ret
+
+    def universe_systems_regions(self, system_ids: list) -> dict:
+        """
+        Find region of each solar system, requests are sent in parallel
+        :param system_ids: list of solar system ids
+        :return: dict solar_system_id => region_id, systems which failed to resolve are missing
+        """
+        ret = dict()
+        futures = dict()
+        for ssid in set(system_ids):
+            futures[ssid] = self._executor.submit(self.get_universe_solarsystem, ssid)
+        constellations = dict()
+        for ssid, reply in self._successful_results(futures).items():
+            if 'constellation_id' in reply:
+                constellations[ssid] = int(reply['constellation_id'])
+        futures = dict()
+        for constellation_id in set(constellations.values()):
+            futures[constellation_id] = self._executor.submit(self.get_universe_constellation, constellation_id)
+        regions = dict()
+        for constellation_id, reply in self._successful_results(futures).items():
+            if 'region_id' in reply:
+                regions[constellation_id] = int(reply['region_id'])
+        for ssid, constellation_id in constellations.items():
+            if constellation_id in regions:
+                ret[ssid] = regions[constellation_id]
+        return ret
+
+    def universe_names(self, ids_list: list) -> tuple:
+        """
+        Resolve a set of IDs of any kind (characters, corporations, alliances,
+        solar systems, types, ...) to names and categories.
+        Requests are split into chunks of UNIVERSE_NAMES_MAX_IDS ids, sent in parallel;
+        a failed chunk does not discard results of others.
+        :param ids_list: list of ids
+        :return: tuple (list of dicts: {'id': 95465499, 'name': 'CCP Bartender', 'category': 'character'},
+                        list of ids which were in failed requests)
+        """
+        names = []
+        failed_ids = []
+        ids = sorted(set([int(an_id) for an_id in ids_list if int(an_id) > 0]))
+        chunks = [ids[start:start + self.UNIVERSE_NAMES_MAX_IDS]
+                  for start in range(0, len(ids), self.UNIVERSE_NAMES_MAX_IDS)]
+        if len(chunks) == 1:
+            try:
+                return self._universe_names_chunk(chunks[0]), failed_ids
+            except ESIException:
+                return names, chunks[0]
+        # chunks are independent, request them all in parallel;
+        # total time is then the time of the slowest single request
+        futures = dict()
+        for i, chunk in enumerate(chunks):
+            futures[i] = self._executor.submit(self._universe_names_chunk, chunk)
+        results = self._successful_results(futures)
+        for i, chunk in enumerate(chunks):
+            if i in results:
+                names.extend(results[i])
             else:
-                obj = json.loads(response_text)
-                if 'error' in obj:
-                    error_str = 'ESI error: {}'.format(obj['error'])
-                else:
-                    error_str = 'Error connecting to ESI server: HTTP status {}'.format(r.status_code)
-        except requests.exceptions.RequestException as e:
-            error_str = 'Error connection to ESI server: {}'.format(str(e))
-        except json.JSONDecodeError:
-            error_str = 'Failed to parse response JSON from CCP ESI server!'
-        if error_str != '':
-            raise ESIException(error_str)
+                failed_ids.extend(chunk)
+        return names, failed_ids
+
+    def _universe_names_chunk(self, ids: list) -> list:
+        if len(ids) < 1:
+            return []
+        # https://esi.tech.ccp.is/ui/#/Universe/post_universe_names
+        # This route is cached for up to 3600 seconds
+        url = '{}/universe/names/'.format(self.ESI_BASE_URL)
+        # the same set of ids is rarely asked again, and resolved names are
+        # kept in names database anyway, so do not fill disk cache with them
+        status, ret = self._esi_request('POST', url, body=ids, accept_statuses=(404,), persist=False)
+        if status == 404:
+            # ESI fails the whole request if any single id is invalid;
+            # split in halves to still resolve all the valid ones
+            ret = []
+            if len(ids) > 1:
+                half = len(ids) // 2
+                ret = self._universe_names_chunk(ids[:half]) + self._universe_names_chunk(ids[half:])
         return ret
@@ -1,13 +1,19 @@
+import collections
 import sqlite3
 import threading
+import time
+from typing import List, Optional
 
-from esi_calls import ESICalls, ESIException
+import requests
+
+from esi_calls import ESICalls, ESIException, ESIResponseCache
+from killmail import Killmail
 
 
 class EsiNamesResolver:
-    def __init__(self):
+    def __init__(self, session: requests.Session = None, esi_cache: ESIResponseCache = None):
         self.error_str = ''
-        self.esi_calls = ESICalls()
+        self.esi_calls = ESICalls(session, esi_cache)
 
     def resolve_characters_names(self, ids_list: list) -> list:
         ret = []
@@ -33,6 +39,34 @@ class EsiNamesResolver:
             self.error_str = ex.error_string()
         return ret
 
+    def resolve_names(self, ids_list: list) -> tuple:
+        """
+        :return: tuple (list of resolved names, list of ids whose requests failed);
+                 ids in neither of them do not exist
+        """
+        names, failed_ids = self.esi_calls.universe_names(ids_list)
+        if len(failed_ids) > 0:
+            self.error_str = 'Failed to resolve names of {} ids'.format(len(failed_ids))
+        return names, failed_ids
+
+    def resolve_types_groups(self, type_ids: list) -> dict:
+        """
+        :return: dict type_id => group_id, types which failed to resolve are missing
+        """
+        ret = self.esi_calls.universe_types_groups(type_ids)
+        if len(ret) < len(set(type_ids)):
+            self.error_str = 'Failed to resolve groups of {} types'.format(len(set(type_ids)) - len(ret))
+        return ret
+
+    def resolve_systems_regions(self, system_ids: list) -> dict:
+        """
+        :return: dict solar_system_id => region_id, systems which failed to resolve are missing
+        """
+        ret = self.esi_calls.universe_systems_regions(system_ids)
+        if len(ret) < len(set(system_ids)):
+            self.error_str = 'Failed to resolve regions of {} systems'.format(len(set(system_ids)) - len(ret))
+        return ret
+
     def resolve_solarsystem_name(self, ssid: int) -> str:
         ret = ''
         try:
@@ -55,17 +89,123 @@ class EsiNamesResolver:
         return ret
 
 
+class NameRecord:
+    """
+    Name as stored in DB: name, when it was requested from ESI, and request result
+    """
+    __slots__ = ('name', 'fetched_at', 'status')
+
+    STATUS_OK = 0
+    STATUS_NOT_FOUND = 1
+    STATUS_ERROR = 2
+
+    def __init__(self, name: str, fetched_at: int, status: int = 0):
+        self.name = name
+        self.fetched_at = fetched_at
+        self.status = status
+
+
+class NamesLRUCache:
+    """
+    Bounded in-memory cache of id => NameRecord, evicts least recently used entries.
+    """
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, iid: int) -> Optional[NameRecord]:
+        with self._lock:
+            record = self._data.get(iid)
+            if record is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(iid)
+            self.hits += 1
+            return record
+
+    def put(self, iid: int, record: NameRecord) -> None:
+        with self._lock:
+            self._data[iid] = record
+            self._data.move_to_end(iid)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {'size': len(self._data), 'max_size': self.max_size,
+                'hits': self.hits, 'misses': self.misses}
+
+
 class EveNamesDb:
-    def __init__(self, names_db_filename: str):
+    # ESI /universe/names/ category => names table
+    CATEGORY_TABLES = {
+        'character': 'charnames',
+        'corporation': 'corpnames',
+        'alliance': 'allynames',
+        'solar_system': 'solarsystems',
+        'inventory_type': 'types'
+    }
+    # max number of host parameters in a single SQLite statement is 999 by default
+    SQL_MAX_VARIABLES = 900
+    # table name => max number of names kept in memory
+    CACHE_SIZES = {
+        'charnames': 50000,
+        'corpnames': 20000,
+        'allynames': 5000,
+        'solarsystems': 10000,
+        'types': 20000
+    }
+    # table name => seconds after which a known name is refreshed in background,
+    # None for static data which never changes
+    NAME_TTL = {
+        'charnames': 30 * 24 * 3600,
+        'corpnames': 7 * 24 * 3600,
+        'allynames': 7 * 24 * 3600,
+        'solarsystems': None,
+        'types': None
+    }
+    # static id => id mappings (filled by sde_import.py or from ESI): table name => value column
+    STATIC_MAPS = {
+        'system_regions': 'region_id',
+        'type_groups': 'group_id'
+    }
+    # do not request again for some time ids which ESI could not resolve
+    NOT_FOUND_TTL = 24 * 3600
+    ERROR_TTL = 10 * 60
+
+    def __init__(self, names_db_filename: str, session: requests.Session = None,
+                 esi_cache: ESIResponseCache = None):
         self.names_db_filename = names_db_filename
         self._conn = sqlite3.connect(self.names_db_filename, check_same_thread=False)
         self._write_lock = threading.Lock()
-        self._resolver = EsiNamesResolver()
+        self._resolver = EsiNamesResolver(session, esi_cache)
+        self._caches = dict()
+        for table_name, max_size in self.CACHE_SIZES.items():
+            self._caches[table_name] = NamesLRUCache(max_size)
+        # static maps are small (all systems, all types), kept in memory entirely
+        self._static_maps = dict()
+        for table_name in self.STATIC_MAPS.keys():
+            self._static_maps[table_name] = dict()
+        # static map ids which failed to resolve: table name => dict id => time of failure
+        self._static_failed = dict()
+        for table_name in self.STATIC_MAPS.keys():
+            self._static_failed[table_name] = dict()
+        # stale names waiting to be refreshed in background: table name => set of ids
+        self._stale_ids = dict()
+        self._refresh_lock = threading.Lock()
+        self._refresh_thread = None
         self.check_tables()
+        self.warm_up_caches()
 
     def check_tables(self):
         """
-        Automatically create needed tables if not exist
+        Automatically create needed tables if not exist,
+        add columns missing in tables created by older versions
         :return: None
         """
         self._write_lock.acquire()
@@ -75,264 +215,411 @@ class EveNamesDb:
         for row in cur:
             existing_tables.append(row[0])
         cur.close()
-        if 'charnames' not in existing_tables:
-            cur = self._conn.cursor()
-            cur.execute('CREATE TABLE charnames (id INTEGER PRIMARY KEY NOT NULL, name TEXT)')
-            self._conn.commit()
-            cur.close()
-        if 'corpnames' not in existing_tables:
-            cur = self._conn.cursor()
-            cur.execute('CREATE TABLE corpnames (id INTEGER PRIMARY KEY NOT NULL, name TEXT)')
-            self._conn.commit()
-            cur.close()
-        if 'allynames' not in existing_tables:
-            cur = self._conn.cursor()
-            cur.execute('CREATE TABLE allynames (id INTEGER PRIMARY KEY NOT NULL, name TEXT)')
-            self._conn.commit()
-            cur.close()
-        if 'solarsystems' not in existing_tables:
+        for table_name in self.CACHE_SIZES.keys():
+            if table_name not in existing_tables:
+                cur = self._conn.cursor()
+                cur.execute('CREATE TABLE {} (id INTEGER PRIMARY KEY NOT NULL, name TEXT, '
+                            'fetched_at INTEGER NOT NULL DEFAULT 0, '
+                            'status INTEGER NOT NULL DEFAULT 0)'.format(table_name))
+                self._conn.commit()
+                cur.close()
+            else:
+                cur = self._conn.cursor()
+                cur.execute('PRAGMA table_info({})'.format(table_name))
+                columns = [row[1] for row in cur]
+                if 'fetched_at' not in columns:
+                    cur.execute('ALTER TABLE {} ADD COLUMN fetched_at INTEGER NOT NULL DEFAULT 0'.format(table_name))
+                if 'status' not in columns:
+                    cur.execute('ALTER TABLE {} ADD COLUMN status INTEGER NOT NULL DEFAULT 0'.format(table_name))
+                self._conn.commit()
+                cur.close()
+        for table_name, value_column in self.STATIC_MAPS.items():
+            if table_name not in existing_tables:
+                cur = self._conn.cursor()
+                cur.execute('CREATE TABLE {} (id INTEGER PRIMARY KEY NOT NULL, {} INTEGER NOT NULL)'.format(
+                    table_name, value_column))
+                self._conn.commit()
+                cur.close()
+        self._write_lock.release()
+
+    def warm_up_caches(self) -> None:
+        """
+        Pre-load most recently stored names from DB into memory caches
+        :return: None
+        """
+        for table_name, cache in self._caches.items():
             cur = self._conn.cursor()
-            cur.execute('CREATE TABLE solarsystems (id INTEGER PRIMARY KEY NOT NULL, name TEXT)')
-            self._conn.commit()
+            cur.execute('SELECT id, name, fetched_at, status FROM {} ORDER BY rowid DESC LIMIT ?'.format(
+                table_name), (cache.max_size,))
+            rows = cur.fetchall()
             cur.close()
-        if 'types' not in existing_tables:
+            # put oldest first, so that newest names are least likely to be evicted
+            for row in reversed(rows):
+                cache.put(row[0], NameRecord(row[1] or '', row[2], row[3]))
+        for table_name, value_column in self.STATIC_MAPS.items():
             cur = self._conn.cursor()
-            cur.execute('CREATE TABLE types (id INTEGER PRIMARY KEY NOT NULL, name TEXT)')
-            self._conn.commit()
+            cur.execute('SELECT id, {} FROM {}'.format(value_column, table_name))
+            self._static_maps[table_name] = {row[0]: row[1] for row in cur}
             cur.close()
-        self._write_lock.release()
+
+    def cache_stats(self) -> dict:
+        ret = dict()
+        for table_name, cache in self._caches.items():
+            ret[table_name] = cache.stats()
+        return ret
+
+    def esi_stats(self) -> dict:
+        """
+        :return: ESI error limiter state and counters
+        """
+        return self._resolver.esi_calls.error_limiter.metrics()
+
+    def _get_name(self, table_name: str, iid: int) -> str:
+        return self.get_names_bulk(table_name, [iid]).get(iid, '')
+
+    def _set_name(self, table_name: str, iid: int, name: str) -> None:
+        self.set_names_bulk({table_name: {iid: name}})
 
     def get_char_name(self, iid: int) -> str:
-        if iid <= 0:
-            return ''
-        cur = self._conn.cursor()
-        cur.execute('SELECT name FROM charnames WHERE id = ?', (iid,))
-        row = cur.fetchone()
-        cur.close()
-        if row is not None:
-            return row[0]
-        return ''
+        return self._get_name('charnames', iid)
 
     def get_corp_name(self, iid: int) -> str:
-        if iid <= 0:
-            return ''
-        cur = self._conn.cursor()
-        cur.execute('SELECT name FROM corpnames WHERE id = ?', (iid,))
-        row = cur.fetchone()
-        cur.close()
-        if row is not None:
-            return row[0]
-        return ''
+        return self._get_name('corpnames', iid)
 
     def get_ally_name(self, iid: int) -> str:
-        if iid <= 0:
-            return ''
-        cur = self._conn.cursor()
-        cur.execute('SELECT name FROM allynames WHERE id = ?', (iid,))
-        row = cur.fetchone()
-        cur.close()
-        if row is not None:
-            return row[0]
-        return ''
+        return self._get_name('allynames', iid)
 
     def get_solarsystem_name(self, iid: int) -> str:
-        if iid <= 0:
-            return ''
-        cur = self._conn.cursor()
-        cur.execute('SELECT name FROM solarsystems WHERE id = ?', (iid,))
-        row = cur.fetchone()
-        cur.close()
-        if row is not None:
-            return row[0]
-        return ''
+        return self._get_name('solarsystems', iid)
 
     def get_type_name(self, iid: int) -> str:
-        if iid <= 0:
-            return ''
-        cur = self._conn.cursor()
-        cur.execute('SELECT name FROM types WHERE id = ?', (iid,))
-        row = cur.fetchone()
-        cur.close()
-        if row is not None:
-            return row[0]
-        return ''
+        return self._get_name('types', iid)
 
     def set_char_name(self, iid: int, name: str) -> None:
-        if iid <= 0:
-            return
-        self._write_lock.acquire()
-        cur = self._conn.cursor()
-        cur.execute('INSERT OR REPLACE INTO charnames (id, name) VALUES (?, ?)', (iid, name))
-        self._conn.commit()
-        cur.close()
-        self._write_lock.release()
+        self._set_name('charnames', iid, name)
 
     def set_corp_name(self, iid: int, name: str) -> None:
-        if iid <= 0:
-            return
-        self._write_lock.acquire()
-        cur = self._conn.cursor()
-        cur.execute('INSERT OR REPLACE INTO corpnames (id, name) VALUES (?, ?)', (iid, name))
-        self._conn.commit()
-        cur.close()
-        self._write_lock.release()
+        self._set_name('corpnames', iid, name)
 
     def set_ally_name(self, iid: int, name: str) -> None:
-        if iid <= 0:
-            return
-        self._write_lock.acquire()
-        cur = self._conn.cursor()
-        cur.execute('INSERT OR REPLACE INTO allynames (id, name) VALUES (?, ?)', (iid, name))
-        self._conn.commit()
-        cur.close()
-        self._write_lock.release()
+        self._set_name('allynames', iid, name)
 
     def set_solarsystem_name(self, iid: int, name: str) -> None:
-        if iid <= 0:
-            return
-        self._write_lock.acquire()
-        cur = self._conn.cursor()
-        cur.execute('INSERT OR REPLACE INTO solarsystems (id, name) VALUES (?, ?)', (iid, name))
-        self._conn.commit()
-        cur.close()
-        self._write_lock.release()
+        self._set_name('solarsystems', iid, name)
 
     def set_type_name(self, iid: int, name: str) -> None:
-        if iid <= 0:
-            return
+        self._set_name('types', iid, name)
+
+    def get_records_bulk(self, table_name: str, ids_list) -> dict:
+        """
+        Get many name records from one table at once, using memory cache
+        and a single SELECT ... WHERE id IN (...) for the rest
+        :param table_name: one of: charnames, corpnames, allynames, solarsystems, types
+        :param ids_list: iterable of ids
+        :return: dict id => NameRecord, only for ids present in DB
+        """
+        ret = dict()
+        cache = self._caches[table_name]
+        ids_to_query = []
+        for iid in set(ids_list):
+            if iid <= 0:
+                continue
+            record = cache.get(iid)
+            if record is not None:
+                ret[iid] = record
+            else:
+                ids_to_query.append(iid)
+        for start in range(0, len(ids_to_query), self.SQL_MAX_VARIABLES):
+            chunk = ids_to_query[start:start + self.SQL_MAX_VARIABLES]
+            sql = 'SELECT id, name, fetched_at, status FROM {} WHERE id IN ({})'.format(
+                table_name, ','.join(['?'] * len(chunk)))
+            cur = self._conn.cursor()
+            cur.execute(sql, chunk)
+            for row in cur:
+                record = NameRecord(row[1] or '', row[2], row[3])
+                ret[row[0]] = record
+                cache.put(row[0], record)
+            cur.close()
+        return ret
+
+    def get_names_bulk(self, table_name: str, ids_list) -> dict:
+        """
+        Get many names from one table at once
+        :param table_name: one of: charnames, corpnames, allynames, solarsystems, types
+        :param ids_list: iterable of ids
+        :return: dict id => name, only for known names
+        """
+        ret = dict()
+        for iid, record in self.get_records_bulk(table_name, ids_list).items():
+            if record.name != '':
+                ret[iid] = record.name
+        return ret
+
+    def _write_records(self, records_by_table: dict) -> None:
+        """
+        Store many name records into several tables in a single transaction
+        :param records_by_table: dict table_name => dict id => NameRecord
+        :return: None
+        """
         self._write_lock.acquire()
-        cur = self._conn.cursor()
-        cur.execute('INSERT OR REPLACE INTO types (id, name) VALUES (?, ?)', (iid, name))
-        self._conn.commit()
-        cur.close()
-        self._write_lock.release()
+        try:
+            with self._conn:
+                for table_name, records in records_by_table.items():
+                    rows = [(iid, r.name, r.fetched_at, r.status) for iid, r in records.items() if iid > 0]
+                    if len(rows) < 1:
+                        continue
+                    self._conn.executemany(
+                        'INSERT OR REPLACE INTO {} (id, name, fetched_at, status) VALUES (?, ?, ?, ?)'.format(
+                            table_name), rows)
+        finally:
+            self._write_lock.release()
+        for table_name, records in records_by_table.items():
+            cache = self._caches[table_name]
+            for iid, record in records.items():
+                if iid > 0:
+                    cache.put(iid, record)
+
+    def set_names_bulk(self, names_by_table: dict) -> None:
+        """
+        Store many names into several tables in a single transaction
+        :param names_by_table: dict table_name => dict id => name
+        :return: None
+        """
+        now = int(time.time())
+        records_by_table = dict()
+        for table_name, names in names_by_table.items():
+            records_by_table[table_name] = {iid: NameRecord(name, now) for iid, name in names.items()}
+        self._write_records(records_by_table)
+
+    def get_static_map_bulk(self, table_name: str, ids_list) -> dict:
+        """
+        :param table_name: one of: system_regions, type_groups
+        :param ids_list: iterable of ids
+        :return: dict id => value, only for known ids
+        """
+        static_map = self._static_maps[table_name]
+        ret = dict()
+        for iid in ids_list:
+            if iid in static_map:
+                ret[iid] = static_map[iid]
+        return ret
 
-    def fill_names_in_zkb_kills(self, kills: list) -> list:
-        # 1. collect unknown IDs
-        unknown_charids = []
-        unknown_corpids = []
-        unknown_allyids = []
-        unknown_ssids = []
-        unknown_typeids = []
+    def set_static_map_bulk(self, maps_by_table: dict) -> None:
+        """
+        Store static mappings into several tables in a single transaction
+        :param maps_by_table: dict table_name => dict id => value
+        :return: None
+        """
+        self._write_lock.acquire()
+        try:
+            with self._conn:
+                for table_name, mapping in maps_by_table.items():
+                    rows = [(iid, value) for iid, value in mapping.items() if iid > 0]
+                    if len(rows) < 1:
+                        continue
+                    self._conn.executemany('INSERT OR REPLACE INTO {} (id, {}) VALUES (?, ?)'.format(
+                        table_name, self.STATIC_MAPS[table_name]), rows)
+        finally:
+            self._write_lock.release()
+        for table_name, mapping in maps_by_table.items():
+            self._static_maps[table_name].update(mapping)
+
+    def _unknown_static_ids(self, table_name: str, ids, known: dict, now: float) -> list:
+        """
+        :return: ids not known yet, except the ones which recently failed to resolve
+        """
+        failed = self._static_failed[table_name]
+        ret = []
+        for iid in ids:
+            if iid in known:
+                continue
+            failed_at = failed.get(iid)
+            if (failed_at is not None) and (now - failed_at < self.ERROR_TTL):
+                continue
+            ret.append(iid)
+        return ret
+
+    def _resolve_static_ids(self, table_name: str, ids: list, now: float) -> dict:
+        if table_name == 'system_regions':
+            mapping = self._resolver.resolve_systems_regions(ids)
+        else:
+            mapping = self._resolver.resolve_types_groups(ids)
+        failed = self._static_failed[table_name]
+        for iid in ids:
+            if iid in mapping:
+                failed.pop(iid, None)
+            else:
+                failed[iid] = now
+        return mapping
+
+    def fill_static_info_in_zkb_kills(self, kills: List[Killmail], fill_regions: bool = True,
+                                      fill_groups: bool = True) -> List[Killmail]:
+        """
+        Fill in region of each kill and ship group of each participant,
+        requesting from ESI only the ones not known yet.
+        Ids which failed to resolve are not requested again for ERROR_TTL seconds.
+        :param kills: kills
+        :param fill_regions: fill in kills' regions
+        :param fill_groups: fill in participants' ship groups
+        :return: the same kills
+        """
+        now = time.time()
+        regions = dict()
+        groups = dict()
+        new_maps = dict()
+        if fill_regions:
+            system_ids = set([kill.solar_system_id for kill in kills if kill.solar_system_id > 0])
+            regions = self.get_static_map_bulk('system_regions', system_ids)
+            unknown_systems = self._unknown_static_ids('system_regions', system_ids, regions, now)
+            if len(unknown_systems) > 0:
+                new_maps['system_regions'] = self._resolve_static_ids('system_regions', unknown_systems, now)
+                regions.update(new_maps['system_regions'])
+        if fill_groups:
+            type_ids = set()
+            for kill in kills:
+                for party in kill.participants():
+                    if party.ship_type_id > 0:
+                        type_ids.add(party.ship_type_id)
+            groups = self.get_static_map_bulk('type_groups', type_ids)
+            unknown_types = self._unknown_static_ids('type_groups', type_ids, groups, now)
+            if len(unknown_types) > 0:
+                new_maps['type_groups'] = self._resolve_static_ids('type_groups', unknown_types, now)
+                groups.update(new_maps['type_groups'])
+        if len(new_maps) > 0:
+            self.set_static_map_bulk(new_maps)
         for kill in kills:
-            if 'character_id' in kill['victim']:
-                char_id = int(kill['victim']['character_id'])
-                char_name = self.get_char_name(char_id)
-                if (char_name == '') and (char_id > 0):  # add to unknowns
-                    unknown_charids.append(char_id)
-            if 'corporation_id' in kill['victim']:
-                corp_id = int(kill['victim']['corporation_id'])
-                corp_name = self.get_corp_name(corp_id)
-                if (corp_name == '') and (corp_id >= 0):
-                    unknown_corpids.append(corp_id)
-            if 'alliance_id' in kill['victim']:
-                ally_id = int(kill['victim']['alliance_id'])
-                ally_name = self.get_ally_name(ally_id)
-                if (ally_name == '') and (ally_id >= 0):
-                    unknown_allyids.append(ally_id)
-            if 'solar_system_id' in kill:
-                ssid = int(kill['solar_system_id'])
-                ssname = self.get_solarsystem_name(ssid)
-                if (ssid > 0) and (ssname == ''):
-                    unknown_ssids.append(ssid)
-            if 'ship_type_id' in kill['victim']:
-                typeid = int(kill['victim']['ship_type_id'])
-                typename = self.get_type_name(typeid)
-                if (typeid > 0) and (typename == ''):
-                    unknown_typeids.append(typeid)
-            for atk in kill['attackers']:
-                if 'character_id' in atk:
-                    char_id = int(atk['character_id'])
-                    char_name = self.get_char_name(char_id)
-                    if (char_name == '') and (char_id >= 0):
-                        unknown_charids.append(char_id)
-                if 'corporation_id' in atk:
-                    corp_id = int(atk['corporation_id'])
-                    corp_name = self.get_corp_name(corp_id)
-                    if (corp_name == '') and (corp_id >= 0):
-                        unknown_corpids.append(corp_id)
-                if 'alliance_id' in atk:
-                    ally_id = int(atk['alliance_id'])
-                    ally_name = self.get_ally_name(ally_id)
-                    if (ally_name == '') and (ally_id >= 0):
-                        unknown_allyids.append(ally_id)
-
-        # 2. issue a single request to get all names at once
-        names = self._resolver.resolve_characters_names(unknown_charids)
-        for obj in names:
-            self.set_char_name(obj['character_id'], obj['character_name'])
-        names = self._resolver.resolve_corporations_names(unknown_corpids)
-        for obj in names:
-            self.set_corp_name(obj['corporation_id'], obj['corporation_name'])
-        names = self._resolver.resolve_alliances_names(unknown_allyids)
+            kill.region_id = regions.get(kill.solar_system_id, 0)
+            for party in kill.participants():
+                party.ship_group_id = groups.get(party.ship_type_id, 0)
+        return kills
+
+    def _is_stale(self, table_name: str, record: NameRecord, now: int) -> bool:
+        age = now - record.fetched_at
+        if record.status == NameRecord.STATUS_NOT_FOUND:
+            return age > self.NOT_FOUND_TTL
+        if record.status == NameRecord.STATUS_ERROR:
+            return age > self.ERROR_TTL
+        ttl = self.NAME_TTL[table_name]
+        return (ttl is not None) and (age > ttl)
+
+    def _resolve_ids(self, ids_by_table: dict, old_records: dict) -> dict:
+        """
+        Request names for ids from ESI and store results, including
+        ids which could not be resolved (negative caching)
+        :param ids_by_table: dict table_name => list of ids
+        :param old_records: dict table_name => dict id => NameRecord, already stored records
+        :return: dict table_name => dict id => NameRecord
+        """
+        now = int(time.time())
+        ret = {table_name: dict() for table_name in ids_by_table.keys()}
+        all_ids = []
+        for ids in ids_by_table.values():
+            all_ids.extend(ids)
+        if len(all_ids) < 1:
+            return ret
+        names, failed_ids = self._resolver.resolve_names(all_ids)
+        failed_ids = set(failed_ids)
         for obj in names:
-            self.set_ally_name(obj['alliance_id'], obj['alliance_name'])
-        # 2.1 issue several requests, each for every solarsystem
-        for ssid in unknown_ssids:
-            ssname = self._resolver.resolve_solarsystem_name(ssid)
-            if ssname != '':
-                self.set_solarsystem_name(ssid, ssname)
-        # 2.2 issue several requests, each for every typeid
-        for typeid in unknown_typeids:
-            typename = self._resolver.resolve_type_name(typeid)
-            if typename != '':
-                self.set_type_name(typeid, typename)
-
-        # 3. fill in gathered information
+            table_name = self.CATEGORY_TABLES.get(obj['category'])
+            if table_name in ret:
+                ret[table_name][obj['id']] = NameRecord(obj['name'], now)
+        for table_name, ids in ids_by_table.items():
+            for iid in ids:
+                if iid in ret[table_name]:
+                    continue
+                # ids from failed requests may exist, ask again sooner than for not found ones
+                status = NameRecord.STATUS_ERROR if iid in failed_ids else NameRecord.STATUS_NOT_FOUND
+                old_record = old_records[table_name].get(iid)
+                if (old_record is not None) and (old_record.name != ''):
+                    # could not refresh, keep old name until next TTL
+                    ret[table_name][iid] = NameRecord(old_record.name, now, old_record.status)
+                else:
+                    ret[table_name][iid] = NameRecord('', now, status)
+        self._write_records(ret)
+        return ret
+
+    def _schedule_refresh(self, stale_by_table: dict) -> None:
+        """
+        Refresh stale names in background thread; old names are used until then
+        """
+        with self._refresh_lock:
+            for table_name, ids in stale_by_table.items():
+                self._stale_ids.setdefault(table_name, set()).update(ids)
+            if (self._refresh_thread is not None) and self._refresh_thread.is_alive():
+                return
+            self._refresh_thread = threading.Thread(target=self._refresh_worker, name='names-refresh',
+                                                    daemon=True)
+            self._refresh_thread.start()
+
+    def _refresh_worker(self) -> None:
+        while True:
+            with self._refresh_lock:
+                stale_by_table = {t: list(ids) for t, ids in self._stale_ids.items() if len(ids) > 0}
+                self._stale_ids = dict()
+                if len(stale_by_table) < 1:
+                    self._refresh_thread = None
+                    return
+            old_records = dict()
+            for table_name, ids in stale_by_table.items():
+                old_records[table_name] = self.get_records_bulk(table_name, ids)
+            self._resolve_ids(stale_by_table, old_records)
+
+    def fill_names_in_zkb_kills(self, kills: List[Killmail]) -> List[Killmail]:
+        # 1. collect all IDs, by category
+        all_ids = {
+            'charnames': set(),
+            'corpnames': set(),
+            'allynames': set(),
+            'solarsystems': set(),
+            'types': set()
+        }
+        for kill in kills:
+            all_ids['solarsystems'].add(kill.solar_system_id)
+            for party in kill.participants():
+                all_ids['charnames'].add(party.character_id)
+                all_ids['corpnames'].add(party.corporation_id)
+                all_ids['allynames'].add(party.alliance_id)
+                all_ids['types'].add(party.ship_type_id)
+
+        # 2. find out which of them are already known, which are stale and which are unknown
+        now = int(time.time())
+        records = dict()
+        unknown = dict()
+        stale = dict()
+        for table_name, ids in all_ids.items():
+            records[table_name] = self.get_records_bulk(table_name, ids)
+            unknown[table_name] = []
+            stale[table_name] = []
+            for iid in ids:
+                if iid <= 0:
+                    continue
+                record = records[table_name].get(iid)
+                if (record is None) or ((record.name == '') and self._is_stale(table_name, record, now)):
+                    unknown[table_name].append(iid)
+                elif self._is_stale(table_name, record, now):
+                    stale[table_name].append(iid)
+
+        # 3. issue a single bulk request to get all unknown names at once, and store them;
+        #    stale names are used as they are and refreshed in background
+        for table_name, new_records in self._resolve_ids(unknown, records).items():
+            records[table_name].update(new_records)
+        if sum([len(ids) for ids in stale.values()]) > 0:
+            self._schedule_refresh(stale)
+
+        # 4. fill in gathered information
+        names = dict()
+        for table_name, table_records in records.items():
+            names[table_name] = {iid: r.name for iid, r in table_records.items()}
+        charnames = names['charnames']
+        corpnames = names['corpnames']
+        allynames = names['allynames']
+        typenames = names['types']
         for kill in kills:
-            if 'solar_system_id' in kill:
-                ssname = self.get_solarsystem_name(kill['solar_system_id'])
-                if ssname != '':
-                    kill['solarSystemName'] = ssname
-            victim = kill['victim']
-            if 'character_id' in victim:
-                char_id = int(victim['character_id'])
-                if char_id > 0:
-                    char_name = self.get_char_name(char_id)
-                    if char_name != '':
-                        victim['characterName'] = char_name
-            if 'corporation_id' in victim:
-                corp_id = int(victim['corporation_id'])
-                if corp_id > 0:
-                    corp_name = self.get_corp_name(corp_id)
-                    if corp_name != '':
-                        victim['corporationName'] = corp_name
-            if 'alliance_id' in victim:
-                ally_id = int(victim['alliance_id'])
-                if ally_id > 0:
-                    ally_name = self.get_ally_name(ally_id)
-                    if ally_name != '':
-                        victim['allianceName'] = ally_name
-            if 'ship_type_id' in victim:
-                ship_typeid = int(victim['ship_type_id'])
-                if ship_typeid > 0:
-                    ship_typename = self.get_type_name(ship_typeid)
-                    if ship_typename != '':
-                        victim['shipTypeName'] = ship_typename
-            for atk in kill['attackers']:
-                if 'character_id' in atk:
-                    char_id = int(atk['character_id'])
-                    if char_id > 0:
-                        char_name = self.get_char_name(char_id)
-                        if char_name != '':
-                            atk['characterName'] = char_name
-                if 'corporation_id' in atk:
-                    corp_id = int(atk['corporation_id'])
-                    if corp_id > 0:
-                        corp_name = self.get_corp_name(corp_id)
-                        if corp_name != '':
-                            atk['corporationName'] = corp_name
-                if 'alliance_id' in atk:
-                    ally_id = int(atk['alliance_id'])
-                    if ally_id > 0:
-                        ally_name = self.get_ally_name(ally_id)
-                        if ally_name != '':
-                            atk['allianceName'] = ally_name
-                if 'ship_type_id' in atk:
-                    ship_typeid = int(atk['ship_type_id'])
-                    if ship_typeid > 0:
-                        ship_typename = self.get_type_name(ship_typeid)
-                        if ship_typename != '':
-                            atk['shipTypeName'] = ship_typename
+            kill.solar_system_name = names['solarsystems'].get(kill.solar_system_id, '')
+            for party in kill.participants():
+                party.character_name = charnames.get(party.character_id, '')
+                party.corporation_name = corpnames.get(party.corporation_id, '')
+                party.alliance_name = allynames.get(party.alliance_id, '')
+                party.ship_type_name = typenames.get(party.ship_type_id, '')
 
         return kills
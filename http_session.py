@@ -0,0 +1,62 @@
+import requests
+import requests.adapters
+from urllib3.util.retry import Retry
+
+
+TELEGRAM_API_URL = 'https://api.telegram.org/'
+
+
+class HttpSession(requests.Session):
+    """
+    requests.Session with a default timeout for every request.
+    Connections are kept alive and reused from per-host pools.
+    """
+    def __init__(self, timeout: float = 20):
+        super(HttpSession, self).__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super(HttpSession, self).request(method, url, **kwargs)
+
+
+def create_http_session(pool_size: int = 10, max_retries: int = 3, timeout: float = 20,
+                        num_hosts: int = 4) -> HttpSession:
+    """
+    Create a session to be shared by ZKB, ESI and Telegram clients
+    :param pool_size: max number of kept-alive connections to a single host
+    :param max_retries: retries on connection errors and 502/503/504 responses;
+                        for telegram API only on connection errors
+    :param timeout: default timeout for requests, in seconds
+    :param num_hosts: number of per-host connection pools to keep
+    :return: session object
+    """
+    retry = Retry(total=max_retries,
+                  connect=max_retries,
+                  read=max_retries,
+                  status=max_retries,
+                  backoff_factor=0.5,
+                  status_forcelist=(502, 503, 504),
+                  allowed_methods=None,  # ESI /universe/names/ POST is safe to retry, too
+                  raise_on_status=False)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=num_hosts,
+                                            pool_maxsize=pool_size,
+                                            max_retries=retry)
+    # telegram methods like sendMessage are not idempotent: after a read error or
+    # a 5xx response the message may be already sent, so retry only failed connects
+    telegram_retry = Retry(total=max_retries,
+                           connect=max_retries,
+                           read=0,
+                           status=0,
+                           backoff_factor=0.5,
+                           allowed_methods=None,
+                           raise_on_status=False)
+    telegram_adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                     pool_maxsize=pool_size,
+                                                     max_retries=telegram_retry)
+    session = HttpSession(timeout)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.mount(TELEGRAM_API_URL, telegram_adapter)
+    return session
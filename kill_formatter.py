@@ -0,0 +1,220 @@
+"""
+Formatting of kill notifications: each kill is rendered to text once,
+and the same text fragment is reused for all chats' messages.
+
+Run this file directly to benchmark formatting speed:
+    python kill_formatter.py [num_kills] [num_chats]
+"""
+import collections
+import datetime
+import random
+import sys
+import threading
+import time
+from typing import List, Tuple
+
+from killmail import Killmail, Participant, ZkbMeta
+
+
+# telegram limit of a single message text length
+MAX_MESSAGE_LENGTH = 4096
+
+FRAGMENTS_SEPARATOR = '\n\n'
+
+# text variant => template of a single kill
+KILL_TEMPLATES = {
+    'markdown': '*{victim}* ({victim_corp}) lost a *{ship}* to *{num_attackers}* attacker(s) in *{system}*{when}.\n'
+                'Value: *{value}* ISK. https://zkillboard.com/kill/{killmail_id}/',
+    'plain': '{victim} ({victim_corp}) lost a {ship} to {num_attackers} attacker(s) in {system}{when}.\n'
+             'Value: {value} ISK. https://zkillboard.com/kill/{killmail_id}/'
+}
+
+
+def format_isk_value(value: float) -> str:
+    if value > 1000000000:
+        return str(round(value / 1000000000)) + ' Bil'
+    if value > 1000000:
+        return str(round(value / 1000000)) + ' Mil'
+    if value > 1000:
+        return str(round(value / 1000)) + ' K'
+    return str(value)
+
+
+def utf16_len(text: str) -> int:
+    """
+    Telegram measures message length in UTF-16 code units:
+    characters outside of BMP (most emoji) take 2 of them
+    """
+    return len(text.encode('utf-16-le')) // 2
+
+
+def format_kill_time(kill_dt: datetime.datetime, days_ago: int) -> str:
+    # plain formatting is many times faster than strftime
+    if days_ago == 0:
+        return ' today at {:02d}:{:02d}:{:02d}'.format(kill_dt.hour, kill_dt.minute, kill_dt.second)
+    if days_ago == 1:
+        return ' yesterday at {:02d}:{:02d}:{:02d}'.format(kill_dt.hour, kill_dt.minute, kill_dt.second)
+    return ' at {:04d}-{:02d}-{:02d} {:02d}:{:02d}:{:02d}'.format(
+        kill_dt.year, kill_dt.month, kill_dt.day, kill_dt.hour, kill_dt.minute, kill_dt.second)
+
+
+def render_kill_text(kill: Killmail, variant: str = 'markdown', days_ago: int = None) -> str:
+    """
+    Render a single kill, names should be already filled in
+    :param kill: kill
+    :param variant: one of KILL_TEMPLATES keys
+    :param days_ago: kill age in days, calculated if None
+    :return: text
+    """
+    if days_ago is None:
+        days_ago = kill.days_ago
+    victim = kill.victim
+    victim_corp = victim.corporation_name
+    if victim.alliance_name != '':
+        victim_corp = '{} / {}'.format(victim.corporation_name, victim.alliance_name)
+    return KILL_TEMPLATES[variant].format(
+        victim=victim.character_name, victim_corp=victim_corp, ship=victim.ship_type_name,
+        num_attackers=len(kill.attackers), system=kill.solar_system_name,
+        when=format_kill_time(kill.kill_dt, days_ago),
+        value=format_isk_value(kill.zkb.total_value), killmail_id=kill.killmail_id)
+
+
+class KillFormatter:
+    """
+    Renders each kill once and keeps up to max_entries most recently used
+    fragments, keyed by (killmail_id, variant, days_ago), since text says
+    "today" or "yesterday". Digests for many chats are then assembled
+    by joining cached fragments.
+    """
+    def __init__(self, max_entries: int = 5000, max_message_length: int = MAX_MESSAGE_LENGTH):
+        self.max_entries = max_entries
+        self.max_message_length = max_message_length
+        self.hits = 0
+        self.misses = 0
+        self._fragments = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def render(self, kill: Killmail, variant: str = 'markdown') -> str:
+        key = (kill.killmail_id, variant, kill.days_ago)
+        with self._lock:
+            text = self._fragments.get(key)
+            if text is not None:
+                self._fragments.move_to_end(key)
+                self.hits += 1
+                return text
+        text = render_kill_text(kill, variant, key[2])
+        with self._lock:
+            self.misses += 1
+            self._fragments[key] = text
+            while len(self._fragments) > self.max_entries:
+                self._fragments.popitem(last=False)
+        return text
+
+    def digests(self, kills: List[Killmail], variant: str = 'markdown') -> List[Tuple[List[Killmail], str]]:
+        """
+        Pack kills into as few messages as possible. Messages are split only
+        between kills, never inside of one, and each fits into max_message_length.
+        :param kills: kills to send to a chat
+        :param variant: one of KILL_TEMPLATES keys
+        :return: list of (kills in message, message text)
+        """
+        ret = []
+        separator_len = utf16_len(FRAGMENTS_SEPARATOR)
+        cur_kills = []
+        cur_texts = []
+        cur_len = 0
+        for kill in kills:
+            text = self.render(kill, variant)
+            text_len = utf16_len(text)
+            if (len(cur_texts) > 0) and (cur_len + separator_len + text_len > self.max_message_length):
+                ret.append((cur_kills, FRAGMENTS_SEPARATOR.join(cur_texts)))
+                cur_kills = []
+                cur_texts = []
+                cur_len = 0
+            if len(cur_texts) > 0:
+                cur_len += separator_len
+            cur_kills.append(kill)
+            cur_texts.append(text)
+            cur_len += text_len
+        if len(cur_texts) > 0:
+            ret.append((cur_kills, FRAGMENTS_SEPARATOR.join(cur_texts)))
+        return ret
+
+    def stats(self) -> dict:
+        return {'size': len(self._fragments), 'max_entries': self.max_entries,
+                'hits': self.hits, 'misses': self.misses}
+
+
+def _format_kill_text_concat(kill: Killmail) -> str:
+    # previous implementation, kept for benchmark comparison
+    text = ''
+    text += '*{}* '.format(kill.victim.character_name)
+    if kill.victim.alliance_name != '':
+        text += '({} / {})'.format(kill.victim.corporation_name, kill.victim.alliance_name)
+    else:
+        text += '({})'.format(kill.victim.corporation_name)
+    text += ' lost a *{}*'.format(kill.victim.ship_type_name)
+    text += ' to *{}* attacker(s) in *{}*'.format(len(kill.attackers), kill.solar_system_name)
+    killtime_full = kill.kill_dt.strftime('%Y-%m-%d %H:%M:%S')
+    killtime_time = kill.kill_dt.strftime('%H:%M:%S')
+    days_ago = kill.days_ago
+    if days_ago == 0:
+        text += ' today at {}.'.format(killtime_time)
+    elif days_ago == 1:
+        text += ' yesterday at {}.'.format(killtime_time)
+    else:
+        text += ' at {}.'.format(killtime_full)
+    text += '\n'
+    text += 'Value: *{}* ISK. '.format(format_isk_value(kill.zkb.total_value))
+    text += 'https://zkillboard.com/kill/{}/'.format(kill.killmail_id)
+    return text
+
+
+def _make_benchmark_kills(num_kills: int) -> List[Killmail]:
+    rnd = random.Random(42)
+    now = datetime.datetime.utcnow()
+    kills = []
+    for i in range(num_kills):
+        victim = Participant(91000000 + i, 98000001, 99000001 if i % 2 else 0, 0, 670)
+        victim.character_name = 'Victim {}'.format(i)
+        victim.corporation_name = 'Some Corporation'
+        victim.alliance_name = 'Some Alliance' if i % 2 else ''
+        victim.ship_type_name = 'Capsule'
+        attackers = [Participant() for _ in range(rnd.randint(1, 30))]
+        kill = Killmail(70000000 + i, '', now - datetime.timedelta(hours=rnd.randint(0, 72)), 30000142,
+                        victim, attackers, ZkbMeta(total_value=rnd.random() * 1e10))
+        kill.solar_system_name = 'Jita'
+        kills.append(kill)
+    return kills
+
+
+def benchmark(num_kills: int = 200, num_chats: int = 1000) -> None:
+    kills = _make_benchmark_kills(num_kills)
+    # each chat gets a random part of kills, like with subscription filters
+    rnd = random.Random(1)
+    chats_kills = [[kill for kill in kills if rnd.random() < 0.3] for _ in range(num_chats)]
+    num_fragments = sum([len(chat_kills) for chat_kills in chats_kills])
+    print('{} kills, {} chats, {} kill fragments in all messages'.format(num_kills, num_chats, num_fragments))
+
+    for kill in kills:
+        if render_kill_text(kill) != _format_kill_text_concat(kill):
+            print('  ERROR: texts differ!')
+            break
+
+    t0 = time.perf_counter()
+    for chat_kills in chats_kills:
+        '\n\n'.join([_format_kill_text_concat(kill) for kill in chat_kills])
+    secs = time.perf_counter() - t0
+    print('  render for every chat:  {:>10.0f} fragments/sec'.format(num_fragments / secs))
+
+    formatter = KillFormatter()
+    t0 = time.perf_counter()
+    for chat_kills in chats_kills:
+        formatter.digests(chat_kills)
+    secs = time.perf_counter() - t0
+    print('  render once, join:      {:>10.0f} fragments/sec'.format(num_fragments / secs))
+    print('  formatter cache: {}'.format(formatter.stats()))
+
+
+if __name__ == '__main__':
+    benchmark(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,126 @@
+import datetime
+from typing import Iterator, List, Optional
+
+
+class Participant:
+    """
+    Victim or attacker of a kill. Ids are 0 when not present (NPCs, structures),
+    names and ship group are filled in later by EveNamesDb.
+    """
+    __slots__ = ('character_id', 'corporation_id', 'alliance_id', 'faction_id', 'ship_type_id',
+                 'ship_group_id', 'final_blow', 'damage',
+                 'character_name', 'corporation_name', 'alliance_name', 'ship_type_name')
+
+    def __init__(self, character_id: int = 0, corporation_id: int = 0, alliance_id: int = 0,
+                 faction_id: int = 0, ship_type_id: int = 0, final_blow: bool = False, damage: int = 0):
+        self.character_id = character_id
+        self.corporation_id = corporation_id
+        self.alliance_id = alliance_id
+        self.faction_id = faction_id
+        self.ship_type_id = ship_type_id
+        self.ship_group_id = 0
+        self.final_blow = final_blow
+        # damage done for attackers, damage taken for victim
+        self.damage = damage
+        self.character_name = ''
+        self.corporation_name = ''
+        self.alliance_name = ''
+        self.ship_type_name = ''
+
+    @classmethod
+    def from_dict(cls, d: dict, is_victim: bool = False) -> 'Participant':
+        """
+        :param d: ESI killmail victim or attacker dict
+        :param is_victim: True for victim
+        """
+        p = cls(int(d.get('character_id', 0)),
+                int(d.get('corporation_id', 0)),
+                int(d.get('alliance_id', 0)),
+                int(d.get('faction_id', 0)),
+                int(d.get('ship_type_id', 0)),
+                d.get('final_blow', False) is True,
+                d.get('damage_taken', 0) if is_victim else d.get('damage_done', 0))
+        # faction warfare pilots have faction_id too, so character_id is kept as is;
+        # NPCs simply have no character_id
+        return p
+
+    def __repr__(self) -> str:
+        return 'Participant(character_id={}, corporation_id={}, alliance_id={}, ship_type_id={})'.format(
+            self.character_id, self.corporation_id, self.alliance_id, self.ship_type_id)
+
+
+class ZkbMeta:
+    """
+    zKillboard's own information about a kill
+    """
+    __slots__ = ('location_id', 'hash', 'fitted_value', 'total_value', 'points', 'npc', 'solo', 'awox')
+
+    def __init__(self, location_id: int = 0, hash: str = '', fitted_value: float = 0.0,
+                 total_value: float = 0.0, points: int = 0, npc: bool = False, solo: bool = False,
+                 awox: bool = False):
+        self.location_id = location_id
+        self.hash = hash
+        self.fitted_value = fitted_value
+        self.total_value = total_value
+        self.points = points
+        self.npc = npc
+        self.solo = solo
+        self.awox = awox
+
+    @classmethod
+    def from_dict(cls, d: dict) -> 'ZkbMeta':
+        return cls(int(d.get('locationID', 0)),
+                   d.get('hash', ''),
+                   float(d.get('fittedValue', 0.0)),
+                   float(d.get('totalValue', 0.0)),
+                   int(d.get('points', 0)),
+                   d.get('npc', False),
+                   d.get('solo', False),
+                   d.get('awox', False))
+
+    @property
+    def total_value_m(self) -> int:
+        return round(self.total_value / 1000000.0)
+
+
+class Killmail:
+    __slots__ = ('killmail_id', 'killmail_time', 'kill_dt', 'solar_system_id', 'solar_system_name',
+                 'region_id', 'victim', 'attackers', 'zkb')
+
+    def __init__(self, killmail_id: int, killmail_time: str, kill_dt: datetime.datetime, solar_system_id: int,
+                 victim: Participant, attackers: List[Participant], zkb: ZkbMeta = None):
+        self.killmail_id = killmail_id
+        self.killmail_time = killmail_time
+        self.kill_dt = kill_dt
+        self.solar_system_id = solar_system_id
+        self.solar_system_name = ''
+        # filled in later by EveNamesDb
+        self.region_id = 0
+        self.victim = victim
+        self.attackers = attackers
+        self.zkb = zkb
+        if self.zkb is None:
+            self.zkb = ZkbMeta()
+
+    @property
+    def days_ago(self) -> int:
+        return (datetime.datetime.utcnow() - self.kill_dt).days
+
+    @property
+    def final_blow_attacker(self) -> Optional[Participant]:
+        for atk in self.attackers:
+            if atk.final_blow:
+                return atk
+        return None
+
+    def participants(self) -> Iterator[Participant]:
+        """
+        :return: victim, then all attackers
+        """
+        yield self.victim
+        for atk in self.attackers:
+            yield atk
+
+    def __repr__(self) -> str:
+        return 'Killmail(killmail_id={}, killmail_time={}, solar_system_id={}, attackers={})'.format(
+            self.killmail_id, self.killmail_time, self.solar_system_id, len(self.attackers))
@@ -1,16 +1,37 @@
+import asyncio
 import configparser
-import datetime
+import hashlib
 import logging
+import secrets
 import sys
+import threading
 import time
+import urllib.parse
+from typing import Iterator, Optional
 
 from bot_logger import create_logger
-from zkillboard import ZKB
+from dedup import KillIdDedup
+from zkillboard import ZKB, ZKBRedisQ
+from zkb_cache import MemoryTTLCache, DiskCache
+from zkb_scheduler import ZKBPollScheduler
 from bot import ZKBBot
+from delivery import DeliveryEngine
+from esi_calls import ESIResponseCache
 from eve_names_resolver import EveNamesDb
+from http_session import create_http_session
+from killmail import Killmail
+from kill_formatter import KillFormatter
+from send_queue import OutgoingMessage, SendQueue
+from telegram_webhook import TelegramWebhookServer
 
 DEBUG = False
 MODE = 'all'
+# ZKB API returns up to 200 kills per page
+ZKB_PAGE_SIZE = 200
+# max pages to request in one refresh, when catching up after a busy period or downtime
+ZKB_MAX_CATCHUP_PAGES = 10
+# new kills are passed on for processing in batches of this size, not in whole pages
+ZKB_BATCH_SIZE = 50
 
 
 def load_config() -> dict:
@@ -18,8 +39,21 @@ def load_config() -> dict:
         'token': '',
         'mode': 'all',
         'corp_id': 0,
+        'ingest': 'poll',
+        'redisq_queue_id': '',
+        'cache': 'memory',
+        'cache_ttl_secs': 10,
         'refresh_interval_secs': 300,
-        'debug': False
+        'min_refresh_interval_secs': 15,
+        'debug': False,
+        'http_pool_size': 10,
+        'http_max_retries': 3,
+        'http_timeout_secs': 20,
+        'telegram_updates': 'polling',
+        'webhook_url': '',
+        'webhook_listen_host': '127.0.0.1',
+        'webhook_listen_port': 8080,
+        'webhook_secret': ''
     }
     ini = configparser.ConfigParser()
     ini.read(['bot.ini'], 'utf-8')
@@ -31,10 +65,38 @@ def load_config() -> dict:
             ret['mode'] = ini['zkb']['mode']
         if 'corp_id' in ini['zkb']:
             ret['corp_id'] = int(ini['zkb']['corp_id'])
+        if 'ingest' in ini['zkb']:
+            ret['ingest'] = ini['zkb']['ingest']
+        if 'redisq_queue_id' in ini['zkb']:
+            ret['redisq_queue_id'] = ini['zkb']['redisq_queue_id']
+        if 'cache' in ini['zkb']:
+            ret['cache'] = ini['zkb']['cache']
+        if 'cache_ttl_secs' in ini['zkb']:
+            ret['cache_ttl_secs'] = int(ini['zkb']['cache_ttl_secs'])
         if 'refresh_interval_secs' in ini['zkb']:
             ret['refresh_interval_secs'] = int(ini['zkb']['refresh_interval_secs'])
+        if 'min_refresh_interval_secs' in ini['zkb']:
+            ret['min_refresh_interval_secs'] = int(ini['zkb']['min_refresh_interval_secs'])
         if 'debug' in ini['zkb']:
             ret['debug'] = ini.getboolean('zkb', 'debug')
+    if ini.has_section('http'):
+        if 'pool_size' in ini['http']:
+            ret['http_pool_size'] = int(ini['http']['pool_size'])
+        if 'max_retries' in ini['http']:
+            ret['http_max_retries'] = int(ini['http']['max_retries'])
+        if 'timeout_secs' in ini['http']:
+            ret['http_timeout_secs'] = int(ini['http']['timeout_secs'])
+    if ini.has_section('telegram'):
+        if 'updates' in ini['telegram']:
+            ret['telegram_updates'] = ini['telegram']['updates']
+        if 'webhook_url' in ini['telegram']:
+            ret['webhook_url'] = ini['telegram']['webhook_url']
+        if 'webhook_listen_host' in ini['telegram']:
+            ret['webhook_listen_host'] = ini['telegram']['webhook_listen_host']
+        if 'webhook_listen_port' in ini['telegram']:
+            ret['webhook_listen_port'] = int(ini['telegram']['webhook_listen_port'])
+        if 'webhook_secret' in ini['telegram']:
+            ret['webhook_secret'] = ini['telegram']['webhook_secret']
     return ret
 
 
@@ -54,14 +116,368 @@ def zkb_get_kills(zkb: ZKB, corp_id: int) -> list:
     return zkb.go()
 
 
-def format_isk_value(value: float) -> str:
-    if value > 1000000000:
-        return str(round(value / 1000000000)) + ' Bil'
-    if value > 1000000:
-        return str(round(value / 1000000)) + ' Mil'
-    if value > 1000:
-        return str(round(value / 1000)) + ' K'
-    return str(value)
+def zkb_iter_new_kills(zkb: ZKB, corp_id: int, after_killid: int, batch_size: int = ZKB_BATCH_SIZE,
+                       max_pages: int = ZKB_MAX_CATCHUP_PAGES) -> Iterator[list]:
+    """
+    Get only kills newer than after_killid, requesting as many pages as needed
+    to catch up (but no more than max_pages). Catch-up pages are decoded incrementally
+    and kills are yielded as they arrive, so only one batch is kept in memory.
+    :return: generator of lists of at most batch_size kills, sorted by killmail_id ascending
+    """
+    global MODE
+    if after_killid <= 0:
+        # afterKillID/0/ would mean "from the oldest kill"
+        return
+    for page in range(1, max_pages + 1):
+        zkb.clear_url()
+        if MODE == 'w-space':
+            zkb.add_wspace()
+        elif MODE == 'corp':
+            zkb.add_corporation(corp_id)
+        elif MODE != 'all':
+            raise ValueError('Mode should be one of: all, w-space, corp. Check ini file.')
+        zkb.add_afterKillID(after_killid)
+        zkb.add_orderAsc()
+        zkb.add_page(page)
+        if page == 1:
+            # usually nothing or just a few new kills; cached and revalidated with ETag
+            kills = zkb.go()
+            num_kills = len(kills)
+            kills = sorted([kill for kill in kills if kill.killmail_id > after_killid],
+                           key=lambda k: k.killmail_id)
+            for start in range(0, len(kills), batch_size):
+                yield kills[start:start + batch_size]
+        else:
+            # catching up, pages are full: decode them incrementally,
+            # kills come already sorted because of orderAsc
+            num_kills = 0
+            batch = []
+            for kill in zkb.iter_kills():
+                num_kills += 1
+                if kill.killmail_id > after_killid:
+                    batch.append(kill)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+            if len(batch) > 0:
+                yield batch
+        if num_kills < ZKB_PAGE_SIZE:
+            break  # caught up
+
+
+def kill_matches_mode(kill: Killmail, corp_id: int) -> bool:
+    """
+    Local equivalent of modifiers used in zkb_get_kills(),
+    for kills coming from RedisQ stream, which sends all kills.
+    """
+    global MODE
+    if MODE == 'w-space':
+        # wormhole systems ids are 31000000 - 31999999
+        return 31000000 <= kill.solar_system_id < 32000000
+    if MODE == 'corp':
+        for party in kill.participants():
+            if party.corporation_id == corp_id:
+                return True
+        return False
+    return True
+
+
+async def dispatch_update(bot: ZKBBot, update: dict):
+    """
+    Handle a single telegram update, received either by polling or by webhook
+    """
+    loop = asyncio.get_event_loop()
+    if not bot.mark_update_seen(update['update_id']):
+        return  # already handled (telegram re-sends updates not confirmed in time)
+    # place to process updates (messages)
+    if 'message' in update:
+        await loop.run_in_executor(None, bot.handle_message, update['message'])
+
+
+async def telegram_updates_task(bot: ZKBBot, logger: logging.Logger):
+    """
+    Long-polls telegram getUpdates and handles incoming commands.
+    Runs independently of ZKB/ESI work, so command replies never wait for them.
+    """
+    loop = asyncio.get_event_loop()
+    # getUpdates does not work while webhook is set, maybe left from webhook mode
+    await loop.run_in_executor(None, bot.delete_webhook)
+    while True:
+        updates_list = await loop.run_in_executor(None, bot.get_updates, bot.last_update_id)
+        logger.debug(' got {} events from telegram'.format(len(updates_list)))
+        for update in updates_list:
+            await dispatch_update(bot, update)
+        if len(updates_list) == 0:
+            # getUpdates returns immediately on errors, do not hammer telegram
+            await asyncio.sleep(1)
+
+
+async def telegram_webhook_task(bot: ZKBBot, webhook: dict, logger: logging.Logger):
+    """
+    Receives updates pushed by telegram to local HTTP server, instead of polling for them.
+    :param webhook: dict with keys: url, listen_host, listen_port, secret
+    """
+    loop = asyncio.get_event_loop()
+    updates_queue = asyncio.Queue()
+
+    def on_update(update: dict):
+        # called in HTTP server thread
+        loop.call_soon_threadsafe(updates_queue.put_nowait, update)
+
+    server = TelegramWebhookServer(webhook['listen_host'], webhook['listen_port'],
+                                   urllib.parse.urlparse(webhook['url']).path or '/',
+                                   webhook['secret'], on_update)
+    server.start()
+    try:
+        ok = await loop.run_in_executor(None, bot.set_webhook, webhook['url'], webhook['secret'])
+        if not ok:
+            raise RuntimeError('Failed to set telegram webhook to {}'.format(webhook['url']))
+        logger.info('Telegram webhook set to {}'.format(webhook['url']))
+        while True:
+            update = await updates_queue.get()
+            await dispatch_update(bot, update)
+    finally:
+        server.stop()
+
+
+def ignore_initial_kills(bot: ZKBBot, kills: list, displayed_killids: KillIdDedup,
+                         logger: logging.Logger) -> int:
+    """
+    Mark kills loaded on first run as displayed and start ZKB cursor after them
+    :return: new cursor, 0 if there were no kills
+    """
+    if len(kills) < 1:
+        return 0
+    for kill in kills:
+        displayed_killids.add(kill.killmail_id)
+        bot.saved_state.zkb_last_killid = max(bot.saved_state.zkb_last_killid, kill.killmail_id)
+    bot.saved_state.displayed_killids = displayed_killids.to_list()
+    bot.save_state()
+    logger.info('Loaded and ignored {} initial kills.'.format(len(kills)))
+    return bot.saved_state.zkb_last_killid
+
+
+async def zkb_refresh_task(bot: ZKBBot, zkb: ZKB, corp_id: int, scheduler: ZKBPollScheduler,
+                           displayed_killids: KillIdDedup, kills_queue: asyncio.Queue,
+                           logger: logging.Logger):
+    """
+    Periodically requests ZKB for kills newer than the last seen one,
+    and puts new (not yet displayed) kills to kills_queue.
+    Delay between requests is chosen by scheduler from ZKB rate limits.
+    """
+    loop = asyncio.get_event_loop()
+    # persisted cursor is advanced only after kills are queued for sending,
+    # this one runs ahead of it
+    cursor = bot.saved_state.zkb_last_killid
+    interval = scheduler.min_interval
+    while cursor == 0:
+        # first run and initial kills could not be loaded yet: without a cursor
+        # afterKillID would return the oldest kills, so keep trying to get one
+        await asyncio.sleep(interval)
+        kills = await loop.run_in_executor(None, zkb_get_kills, zkb, corp_id)
+        interval = scheduler.next_interval(zkb)
+        cursor = ignore_initial_kills(bot, kills, displayed_killids, logger)
+    num_new_kills = 0
+
+    def on_kills_batch(kills: list):
+        # called in event loop thread, as soon as each batch is received
+        nonlocal cursor, num_new_kills
+        cursor = max(cursor, kills[-1].killmail_id)
+        # filter only kills that were not posted yet
+        kills_to_process = []
+        for kill in kills:
+            if displayed_killids.add_pending(kill.killmail_id):
+                kills_to_process.append(kill)
+        num_new_kills += len(kills_to_process)
+        if len(kills_to_process) > 0:
+            kills_queue.put_nowait(kills_to_process)
+
+    def fetch_new_kills(after_killid: int):
+        # runs in executor thread; batches are handled in order before this returns
+        for kills in zkb_iter_new_kills(zkb, corp_id, after_killid):
+            loop.call_soon_threadsafe(on_kills_batch, kills)
+
+    while True:
+        await asyncio.sleep(interval)
+        num_new_kills = 0
+        await loop.run_in_executor(None, fetch_new_kills, cursor)
+        interval = scheduler.next_interval(zkb)
+        logger.debug('ZKB: {} of {} requests per hour used, next poll in {:.0f}s'.format(
+            zkb.request_count, zkb.max_requests, interval))
+        logger.info('{} new kill(s) to show.'.format(num_new_kills))
+
+
+def enqueue_notification(send_queue: SendQueue, chat_ids: list, kills: list, text: str) -> int:
+    # message id depends only on kills included, so the same notification is never queued twice
+    kills_key = ','.join([str(kill.killmail_id) for kill in kills])
+    kills_hash = hashlib.sha1(kills_key.encode('utf-8')).hexdigest()
+    messages = []
+    for chat_id in chat_ids:
+        msg_id = 'kills:{}:{}'.format(kills_hash, chat_id)
+        messages.append(OutgoingMessage(msg_id, chat_id, text, 'Markdown', True))
+    return send_queue.enqueue_many(messages)
+
+
+def enqueue_started_reminder(send_queue: SendQueue, chat_ids: list) -> int:
+    text = 'Bot started. You are registered to receive notifications, type /unreg to cancel.'
+    # a new message id on every start
+    started_at = int(time.time())
+    messages = []
+    for chat_id in chat_ids:
+        msg_id = 'started:{}:{}'.format(started_at, chat_id)
+        messages.append(OutgoingMessage(msg_id, chat_id, text, 'Markdown', False))
+    return send_queue.enqueue_many(messages)
+
+
+async def zkb_stream_task(redisq: ZKBRedisQ, corp_id: int, displayed_killids: KillIdDedup,
+                          kills_queue: asyncio.Queue, logger: logging.Logger):
+    """
+    Receives kills from ZKB RedisQ stream as soon as they are published
+    and puts new kills to kills_queue.
+    """
+    loop = asyncio.get_event_loop()
+    stop_event = threading.Event()
+
+    def on_kill(kill: Killmail):
+        # called in event loop thread
+        if not displayed_killids.add_pending(kill.killmail_id):
+            return
+        logger.info('New kill {} from stream.'.format(kill.killmail_id))
+        kills_queue.put_nowait([kill])
+
+    def stream_reader():
+        # runs in executor thread
+        for kill in redisq.listen(stop_event.is_set):
+            if kill_matches_mode(kill, corp_id):
+                loop.call_soon_threadsafe(on_kill, kill)
+
+    try:
+        await loop.run_in_executor(None, stream_reader)
+    finally:
+        stop_event.set()
+
+
+async def names_resolve_task(bot: ZKBBot, eve_names: EveNamesDb, formatter: KillFormatter,
+                             displayed_killids: KillIdDedup, kills_queue: asyncio.Queue, send_queue: SendQueue,
+                             send_event: asyncio.Event, logger: logging.Logger):
+    """
+    Takes batches of new kills, fills in names from ESI and
+    puts the notification text for all registered chats to the send queue.
+    """
+    loop = asyncio.get_event_loop()
+    while True:
+        kills = await kills_queue.get()
+        # combine all batches which are already waiting into one notification
+        while not kills_queue.empty():
+            kills.extend(kills_queue.get_nowait())
+        kills = await loop.run_in_executor(None, eve_names.fill_names_in_zkb_kills, kills)
+        # regions and ship groups are needed only for matching chats' filters
+        fill_regions = bot.subscription_index.has_filters('region')
+        fill_groups = bot.subscription_index.has_filters('group')
+        if fill_regions or fill_groups:
+            kills = await loop.run_in_executor(None, eve_names.fill_static_info_in_zkb_kills, kills,
+                                               fill_regions, fill_groups)
+        logger.debug('ESI error limiter: {}'.format(eve_names.esi_stats()))
+        # each chat gets only kills matching its filters; chats with the same
+        # set of kills share the same long text messages (to avoid spam),
+        # and each kill is rendered only once for all of them
+        kills_by_chats = dict()
+        for kill in kills:
+            for chat_id in bot.subscription_index.match(kill):
+                kills_by_chats.setdefault(chat_id, []).append(kill)
+        chats_by_kills = dict()
+        for chat_id, chat_kills in kills_by_chats.items():
+            chats_by_kills.setdefault(tuple(chat_kills), []).append(chat_id)
+        for chat_kills, kill_chat_ids in chats_by_kills.items():
+            for digest_kills, text in formatter.digests(list(chat_kills)):
+                await loop.run_in_executor(None, enqueue_notification, send_queue, kill_chat_ids,
+                                           digest_kills, text)
+        if len(chats_by_kills) > 0:
+            send_event.set()
+        # all these kills are safely stored in send queue now
+        killids = [kill.killmail_id for kill in kills]
+        displayed_killids.confirm(killids)
+        bot.saved_state.displayed_killids = displayed_killids.to_list()
+        bot.saved_state.zkb_last_killid = max(bot.saved_state.zkb_last_killid, max(killids))
+        await loop.run_in_executor(None, bot.save_state)
+
+
+async def delivery_task(engine: DeliveryEngine, send_queue: SendQueue, send_event: asyncio.Event):
+    """
+    Sends messages from the persistent send queue, retrying failed ones.
+    """
+    loop = asyncio.get_event_loop()
+    while True:
+        num_taken = await loop.run_in_executor(None, engine.process_queue, send_queue)
+        if num_taken > 0:
+            continue
+        # nothing due now; sleep until next retry is due or new messages are queued
+        wait_secs = send_queue.next_due_in()
+        if (wait_secs < 0) or (wait_secs > 60):
+            wait_secs = 60
+        send_event.clear()
+        try:
+            await asyncio.wait_for(send_event.wait(), wait_secs)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run_bot(bot: ZKBBot, zkb: ZKB, redisq: Optional[ZKBRedisQ], eve_names: EveNamesDb,
+                  send_queue: SendQueue, corp_id: int, scheduler: ZKBPollScheduler, webhook: Optional[dict],
+                  logger: logging.Logger):
+    loop = asyncio.get_event_loop()
+    engine = DeliveryEngine(bot)
+    formatter = KillFormatter()
+    num_recovered = send_queue.recover()
+    send_queue.purge()
+    logger.info('Send queue: {} messages recovered, {}'.format(num_recovered, send_queue.stats()))
+    displayed_killids = KillIdDedup()
+    displayed_killids.load_list(bot.saved_state.displayed_killids)
+    kills_queue = asyncio.Queue()
+    send_event = asyncio.Event()
+
+    if webhook is not None:
+        updates_coro = telegram_webhook_task(bot, webhook, logger)
+    else:
+        updates_coro = telegram_updates_task(bot, logger)
+    # start handling commands first, nothing else should delay replies to them
+    tasks = [loop.create_task(updates_coro)]
+    try:
+        if bot.saved_state.zkb_last_killid == 0:
+            # first run: get initial ZKB kills, only to know where to start from
+            kills = await loop.run_in_executor(None, zkb_get_kills, zkb, corp_id)
+            if ignore_initial_kills(bot, kills, displayed_killids, logger) == 0:
+                logger.warning('Could not load initial kills, will retry.')
+        else:
+            logger.info('Continuing after killmail_id={}'.format(bot.saved_state.zkb_last_killid))
+
+        # remind all saved chats that they are registered; sent by delivery task
+        # at telegram's pace, after command replies
+        if len(bot.chats_notify) > 0:
+            await loop.run_in_executor(None, enqueue_started_reminder, send_queue, list(bot.chats_notify))
+            send_event.set()
+
+        if redisq is not None:
+            ingest_coro = zkb_stream_task(redisq, corp_id, displayed_killids, kills_queue, logger)
+        else:
+            ingest_coro = zkb_refresh_task(bot, zkb, corp_id, scheduler,
+                                           displayed_killids, kills_queue, logger)
+        tasks.extend([
+            loop.create_task(ingest_coro),
+            loop.create_task(names_resolve_task(bot, eve_names, formatter, displayed_killids, kills_queue,
+                                                send_queue, send_event, logger)),
+            loop.create_task(delivery_task(engine, send_queue, send_event))
+        ])
+        # tasks run forever; if any of them crashes, stop the whole bot
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        # wait for tasks to process cancellation and run their finally blocks
+        await asyncio.gather(*tasks, return_exceptions=True)
+        engine.shutdown()
 
 
 def main():
@@ -74,6 +490,12 @@ def main():
     if cfg['mode'] == 'corp':
         if cfg['corp_id'] == 0:
             raise ValueError('Cannot function without a corp_id given! Check ini file.')
+    if cfg['ingest'] not in ['poll', 'redisq']:
+        raise ValueError('Ingest should be one of: poll, redisq. Check ini file.')
+    if cfg['cache'] not in ['none', 'memory', 'disk']:
+        raise ValueError('Cache should be one of: none, memory, disk. Check ini file.')
+    if cfg['telegram_updates'] not in ['polling', 'webhook']:
+        raise ValueError('Telegram updates should be one of: polling, webhook. Check ini file.')
 
     loglevel = logging.INFO
     if DEBUG:
@@ -83,114 +505,69 @@ def main():
     token = cfg['token']
     MODE = cfg['mode']
     corp_id = cfg['corp_id']
-    zkb_refresh_interval_secs = cfg['refresh_interval_secs']
     DEBUG = cfg['debug']
     # safety check
-    if zkb_refresh_interval_secs < 15:
-        zkb_refresh_interval_secs = 15  # wait at least 15 seconds between requests to ZKB...
+    if cfg['min_refresh_interval_secs'] < 15:
+        cfg['min_refresh_interval_secs'] = 15  # wait at least 15 seconds between requests to ZKB...
+    scheduler = ZKBPollScheduler(cfg['min_refresh_interval_secs'], cfg['refresh_interval_secs'])
 
-    should_stop = False
-    displayed_killids = []
-    last_zkb_refresh_time = int(time.time())
+    # single HTTP session with kept-alive connections, shared by all clients
+    session = create_http_session(pool_size=cfg['http_pool_size'],
+                                  max_retries=cfg['http_max_retries'],
+                                  timeout=cfg['http_timeout_secs'])
 
-    zkb = ZKB({'debug': DEBUG})
-    bot = ZKBBot(token)
+    zkb_options = {'debug': DEBUG, 'session': session}
+    if cfg['cache'] == 'memory':
+        zkb_options['cache'] = MemoryTTLCache(cfg['cache_ttl_secs'])
+    elif cfg['cache'] == 'disk':
+        zkb_options['cache'] = DiskCache('cache', cfg['cache_ttl_secs'])
+    zkb = ZKB(zkb_options)
+    redisq = None
+    if cfg['ingest'] == 'redisq':
+        redisq = ZKBRedisQ({'debug': DEBUG, 'session': session, 'queue_id': cfg['redisq_queue_id']})
+    bot = ZKBBot(token, session)
     bot.load_state()
 
-    eve_names = EveNamesDb('eve_names.db')
+    webhook = None
+    if cfg['telegram_updates'] == 'webhook':
+        if cfg['webhook_url'] == '':
+            raise ValueError('webhook_url is required for webhook mode. Check ini file.')
+        webhook = {
+            'url': cfg['webhook_url'],
+            'listen_host': cfg['webhook_listen_host'],
+            'listen_port': cfg['webhook_listen_port'],
+            # without configured secret, make a new one on every start
+            'secret': cfg['webhook_secret'] or secrets.token_urlsafe(32)
+        }
 
-    logger.info('Starting, operation mode={}'.format(MODE))
+    esi_cache = ESIResponseCache('./cache/esi')
+    logger.info('Removed {} old ESI cache entries'.format(esi_cache.cleanup()))
+    eve_names = EveNamesDb('eve_names.db', session, esi_cache)
+    send_queue = SendQueue('send_queue.db')
+
+    logger.info('Starting, operation mode={}, ingest={}, telegram updates={}'.format(
+        MODE, cfg['ingest'], cfg['telegram_updates']))
     if MODE == 'corp':
         logger.info('    corp_id={}'.format(corp_id))
 
-    # get initial ZKB kills
-    kills = zkb_get_kills(zkb, corp_id)
-    for kill in kills:
-        displayed_killids.append(kill['killmail_id'])
-    logger.info('Loaded and ignored {} initial kills.'.format(len(kills)))
-
-    # remind all saved chats that they are registered
-    if len(bot.chats_notify) > 0:
-        for chatid in bot.chats_notify:
-            text = 'Bot started. You are registered to receive notifications, ' \
-                   'type /unreg to cancel.'
-            bot.send_message_text(chatid, text)
-            time.sleep(1)
-
-    # Main loop
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    bot_task = loop.create_task(run_bot(bot, zkb, redisq, eve_names, send_queue, corp_id,
+                                        scheduler, webhook, logger))
     try:
-        while not should_stop:
-            updates_list = bot.get_updates(bot.last_update_id)
-            logger.debug(' got {} events from telegram'.format(len(updates_list)))
-            i = 0
-            for update in updates_list:
-                i += 1
-                update_id = update['update_id']
-                if update_id > bot.last_update_id:
-                    bot.last_update_id = update_id
-                # place to process updates (messages)
-                if 'message' in update:
-                    bot.handle_message(update['message'])
-
-            cur_time = int(time.time())
-            # get next ZKB kills
-            if cur_time - last_zkb_refresh_time > zkb_refresh_interval_secs:
-                last_zkb_refresh_time = cur_time
-                # send request
-                kills = zkb_get_kills(zkb, corp_id)
-                # filter only kills that were not posted yet
-                kills_to_process = []
-                for kill in kills:
-                    if kill['killmail_id'] not in displayed_killids:
-                        kills_to_process.append(kill)
-
-                logger.info('{} new kill(s) to show.'.format(len(kills_to_process)))
-
-                kills_to_process = eve_names.fill_names_in_zkb_kills(kills_to_process)
-
-                # collect all new kills to a single long text message to avoid spam
-                full_text = ''
-                for kill in kills_to_process:
-                    text = ''
-                    text += '*{}* '.format(kill['victim']['characterName'])
-                    if kill['victim']['allianceName'] != '':
-                        text += '({} / {})'.format(
-                            kill['victim']['corporationName'], kill['victim']['allianceName'])
-                    else:
-                        text += '({})'.format(kill['victim']['corporationName'])
-                    text += ' lost a *{}*'.format(kill['victim']['shipTypeName'])
-                    text += ' to *{}* attacker(s) in *{}*'.format(
-                        len(kill['attackers']), kill['solarSystemName'])
-                    # kill time
-                    killtime_full = kill['kill_dt'].strftime('%Y-%m-%d %H:%M:%S')
-                    killtime_time = kill['kill_dt'].strftime('%H:%M:%S')
-                    days_ago = kill['days_ago']
-                    if days_ago == 0:
-                        text += ' today at {}.'.format(killtime_time)
-                    elif days_ago == 1:
-                        text += ' yesterday at {}.'.format(killtime_time)
-                    else:
-                        text += ' at {}.'.format(killtime_full)
-                    text += '\n'
-                    text += 'Value: *{}* ISK. '.format(format_isk_value(kill['zkb']['totalValue']))
-                    text += 'https://zkillboard.com/kill/{}/'.format(kill['killmail_id'])
-                    if len(full_text) > 0:
-                        full_text += '\n\n'
-                    full_text += text
-                    displayed_killids.append(kill['killmail_id'])
-
-                # patiently send full text to all involved chats
-                if len(full_text) > 0:
-                    for chat_id in bot.chats_notify:
-                        bot.send_message_text(chat_id, full_text, 'Markdown', True)
-                        time.sleep(1)
-
-            time.sleep(5)
-
+        loop.run_until_complete(bot_task)
     # exit on Ctrl+C
     except KeyboardInterrupt:
         logger.info('Exiting by user request.')
+        # let all tasks run their cleanup, so that executor threads
+        # (RedisQ reader) are told to stop and interpreter can exit
+        bot_task.cancel()
+        try:
+            loop.run_until_complete(bot_task)
+        except asyncio.CancelledError:
+            pass
 
+    loop.close()
     bot.save_state()
     logging.shutdown()
 
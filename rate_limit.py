@@ -0,0 +1,222 @@
+import threading
+import time
+from typing import Union
+
+
+class TokenBucket:
+    """
+    Classic token bucket: allows bursts of up to capacity,
+    refilled at rate tokens per second. Thread-safe.
+    """
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def try_acquire(self) -> float:
+        """
+        Try to take one token without blocking
+        :return: 0 if token was taken, otherwise number of seconds to wait for it
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                return 0.0
+            return (1.0 - self._tokens) / self.rate
+
+    def acquire(self) -> None:
+        """
+        Take one token, wait until it is available
+        """
+        while True:
+            wait_secs = self.try_acquire()
+            if wait_secs <= 0:
+                return
+            time.sleep(wait_secs)
+
+
+class TelegramRateLimiter:
+    """
+    Enforces telegram bot API limits for outgoing messages:
+     - about 30 messages per second in total,
+     - 1 message per second to a single chat,
+     - 20 messages per minute to a single group.
+    Also can pause all sending, when telegram replies with 429 and retry_after.
+    """
+    def __init__(self, global_rate: float = 30.0, per_chat_rate: float = 1.0,
+                 per_group_rate: float = 20.0 / 60.0):
+        self.per_chat_rate = per_chat_rate
+        self.per_group_rate = per_group_rate
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = dict()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _get_chat_bucket(self, chat_id: Union[str, int]) -> TokenBucket:
+        with self._lock:
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is None:
+                # group and channel ids are negative
+                is_group = str(chat_id).startswith('-') or str(chat_id).startswith('@')
+                if is_group:
+                    bucket = TokenBucket(self.per_group_rate)
+                else:
+                    bucket = TokenBucket(self.per_chat_rate)
+                self._chat_buckets[chat_id] = bucket
+            return bucket
+
+    def pause(self, seconds: float) -> None:
+        """
+        Stop sending anything for a given number of seconds (telegram's retry_after)
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def paused_for(self) -> float:
+        with self._lock:
+            return max(0.0, self._paused_until - time.monotonic())
+
+    def acquire(self, chat_id: Union[str, int]) -> None:
+        """
+        Wait until it is allowed to send one more message to chat_id
+        """
+        pause_secs = self.paused_for()
+        while pause_secs > 0:
+            time.sleep(pause_secs)
+            pause_secs = self.paused_for()
+        self._get_chat_bucket(chat_id).acquire()
+        self._global_bucket.acquire()
+
+
+class ESIErrorLimiter:
+    """
+    Keeps ESI error budget from running out. ESI allows a limited number of
+    error responses per time window (X-ESI-Error-Limit-Remain errors left
+    until X-ESI-Error-Limit-Reset seconds pass); exhausting it gets the IP
+    blocked with 420 responses, and repeated blocks get it banned.
+
+    While the budget is large, requests go at full speed. When it gets low,
+    requests are spread evenly over the rest of the window, and every request
+    in flight reserves one possible error, so parallel requests can not
+    overrun it together. Below min_remain nothing is sent until the window resets.
+    """
+    def __init__(self, error_limit: int = 100, slow_down_below: int = 50, min_remain: int = 10):
+        self.error_limit = error_limit
+        self.slow_down_below = slow_down_below
+        self.min_remain = min_remain
+        self._remain = error_limit
+        self._reset_at = 0.0
+        self._paused_until = 0.0
+        self._next_request_at = 0.0
+        self._in_flight = 0
+        self._cond = threading.Condition()
+        # metrics
+        self.num_requests = 0
+        self.num_errors = 0
+        self.num_blocked = 0
+        self.num_pauses = 0
+        self.throttled_secs = 0.0
+
+    def _update_window(self, now: float) -> None:
+        if (self._reset_at > 0) and (now >= self._reset_at):
+            # window has ended, ESI restores full budget
+            self._remain = self.error_limit
+            self._reset_at = 0.0
+
+    def _wait_time(self, now: float) -> float:
+        """
+        :return: seconds to wait before sending next request, 0 if it can be sent now
+        """
+        if now < self._paused_until:
+            return self._paused_until - now
+        available = self._remain - self._in_flight
+        if available <= self.min_remain:
+            if self._reset_at > now:
+                return self._reset_at - now
+            if self._in_flight > 0:
+                # wait for responses to learn actual budget
+                return 1.0
+            return 0.0
+        if (available < self.slow_down_below) and (now < self._next_request_at):
+            return self._next_request_at - now
+        return 0.0
+
+    def acquire(self) -> None:
+        """
+        Wait until a request can be sent without risk to exhaust error budget,
+        must be followed by release() after response is received
+        """
+        with self._cond:
+            started_at = time.monotonic()
+            while True:
+                now = time.monotonic()
+                self._update_window(now)
+                wait_secs = self._wait_time(now)
+                if wait_secs <= 0:
+                    break
+                self._cond.wait(wait_secs)
+            self.throttled_secs += now - started_at
+            available = self._remain - self._in_flight
+            if (available < self.slow_down_below) and (self._reset_at > now):
+                # spread the remaining budget over the rest of window
+                interval = (self._reset_at - now) / max(available - self.min_remain, 1)
+                self._next_request_at = now + interval
+            self._in_flight += 1
+            self.num_requests += 1
+
+    def release(self, status_code: int = 200, headers: dict = None) -> None:
+        """
+        Account response of a request started with acquire()
+        :param status_code: HTTP status, 0 if there was no response at all
+        :param headers: response headers
+        """
+        with self._cond:
+            now = time.monotonic()
+            self._in_flight = max(self._in_flight - 1, 0)
+            if status_code >= 400:
+                self.num_errors += 1
+            if headers is not None:
+                try:
+                    if 'X-ESI-Error-Limit-Remain' in headers:
+                        self._remain = int(headers['X-ESI-Error-Limit-Remain'])
+                    if 'X-ESI-Error-Limit-Reset' in headers:
+                        self._reset_at = now + int(headers['X-ESI-Error-Limit-Reset'])
+                except ValueError:
+                    pass
+            if status_code == 420:
+                # error limited already: stop everything until window resets
+                self.num_blocked += 1
+                self.pause(self._reset_at - now if self._reset_at > now else 60)
+            self._cond.notify_all()
+
+    def pause(self, seconds: float) -> None:
+        """
+        Stop sending anything for a given number of seconds
+        """
+        with self._cond:
+            self.num_pauses += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def metrics(self) -> dict:
+        with self._cond:
+            now = time.monotonic()
+            self._update_window(now)
+            return {
+                'errors_remain': self._remain,
+                'reset_in_secs': max(self._reset_at - now, 0.0),
+                'paused_for_secs': max(self._paused_until - now, 0.0),
+                'in_flight': self._in_flight,
+                'requests': self.num_requests,
+                'errors': self.num_errors,
+                'blocked': self.num_blocked,
+                'pauses': self.num_pauses,
+                'throttled_secs': round(self.throttled_secs, 3)
+            }
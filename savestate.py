@@ -1,10 +1,17 @@
 import json
+import os
 import sys
 
 
 class SavedState:
     def __init__(self):
         self.involved_chatids = []
+        # per-chat kill filters: str(chat_id) => ChatSubscription.to_dict()
+        self.subscriptions = {}
+        # highest killmail_id already processed, to continue from it after restart
+        self.zkb_last_killid = 0
+        # recently displayed kill ids, to not show them again after restart
+        self.displayed_killids = []
 
     def load(self, filename: str) -> bool:
         try:
@@ -14,18 +21,31 @@ class SavedState:
                 print('Failed to load saved state: Incorrect format!', file=sys.stderr)
                 return False
             self.involved_chatids = cfg['involved_chatids']
-        except IOError as e:
+            if 'subscriptions' in cfg:
+                self.subscriptions = cfg['subscriptions']
+            if 'zkb_last_killid' in cfg:
+                self.zkb_last_killid = int(cfg['zkb_last_killid'])
+            if 'displayed_killids' in cfg:
+                self.displayed_killids = cfg['displayed_killids']
+        except (IOError, ValueError) as e:
+            # ValueError: file is not valid JSON, or has wrong values
             print('Failed to load saved state: {}'.format(str(e)), file=sys.stderr)
             return False
         return True
 
     def save(self, filename: str) -> bool:
+        cfg = {
+            'involved_chatids': self.involved_chatids,
+            'subscriptions': self.subscriptions,
+            'zkb_last_killid': self.zkb_last_killid,
+            'displayed_killids': self.displayed_killids
+        }
         try:
-            with open(filename, 'wt', encoding='utf-8') as fp:
-                cfg = {
-                    'involved_chatids': self.involved_chatids
-                }
+            # write to temporary file first, so that a crash in the middle
+            # of writing does not leave a truncated state file
+            with open(filename + '.tmp', 'wt', encoding='utf-8') as fp:
                 json.dump(cfg, fp, indent=True)
+            os.replace(filename + '.tmp', filename)
         except IOError as e:
             print('Failed to save state: {}'.format(str(e)), file=sys.stderr)
             return False
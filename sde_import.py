@@ -0,0 +1,265 @@
+"""
+Import static solar system and type names from a local EVE SDE dump
+into the names database, so they never have to be requested from ESI.
+Regions of solar systems and groups of types are imported too, when present.
+
+Supported inputs:
+ - CSV files (for example Fuzzwork's mapSolarSystems.csv, invTypes.csv)
+ - JSON files: a list of objects, or a dict id => name / id => {"name": ...}
+ - YAML files in the same layout as JSON (CCP SDE types.yaml), requires PyYAML
+ - prepared SQLite SDE database with mapSolarSystems and/or invTypes tables
+
+Usage:
+    python sde_import.py [--db eve_names.db] [--table solarsystems|types] file [file ...]
+"""
+import argparse
+import csv
+import json
+import os.path
+import sqlite3
+import sys
+
+from eve_names_resolver import EveNamesDb
+
+
+# possible column names for id and name, per target table
+SDE_COLUMNS = {
+    'solarsystems': (['solarSystemID', 'solar_system_id'], ['solarSystemName', 'solar_system_name']),
+    'types': (['typeID', 'type_id'], ['typeName', 'type_name'])
+}
+
+# possible column names for static mappings, per target table: (map table, value columns)
+SDE_MAP_COLUMNS = {
+    'solarsystems': ('system_regions', ['regionID', 'region_id']),
+    'types': ('type_groups', ['groupID', 'group_id'])
+}
+
+# SQLite SDE table => target names table
+SDE_SQLITE_TABLES = {
+    'mapSolarSystems': 'solarsystems',
+    'invTypes': 'types'
+}
+
+
+def guess_table(keys, table_name: str = None) -> str:
+    if table_name is not None:
+        return table_name
+    for a_table_name, columns in SDE_COLUMNS.items():
+        for id_column in columns[0]:
+            if id_column in keys:
+                return a_table_name
+    raise ValueError('Cannot guess target table from columns {}, use --table.'.format(list(keys)))
+
+
+def get_record_name(value) -> str:
+    # CCP SDE stores localized names as {'name': {'en': 'Tristan', 'de': ...}}
+    if isinstance(value, dict):
+        if 'en' in value:
+            return value['en']
+        if 'name' in value:
+            return get_record_name(value['name'])
+        for column_names in SDE_COLUMNS.values():
+            for name_column in column_names[1]:
+                if name_column in value:
+                    return get_record_name(value[name_column])
+        return ''
+    if value is None:
+        return ''
+    return str(value)
+
+
+def names_from_records(records: list, table_name: str = None) -> tuple:
+    """
+    :param records: list of dicts, each having id and name columns
+    :param table_name: target table, guessed from column names if None
+    :return: tuple (table_name, dict id => name)
+    """
+    names = dict()
+    if len(records) < 1:
+        return table_name, names
+    table_name = guess_table(records[0].keys(), table_name)
+    id_columns, name_columns = SDE_COLUMNS[table_name]
+    id_column = [c for c in id_columns + ['id'] if c in records[0]][0]
+    name_column = [c for c in name_columns + ['name'] if c in records[0]][0]
+    for record in records:
+        name = get_record_name(record[name_column])
+        if name != '':
+            names[int(record[id_column])] = name
+    return table_name, names
+
+
+def static_map_from_records(records: list, table_name: str) -> dict:
+    """
+    :param records: list of dicts, each having id column and maybe region/group column
+    :param table_name: target names table
+    :return: dict map_table => dict id => value, empty if records have no such column
+    """
+    if (len(records) < 1) or (table_name not in SDE_MAP_COLUMNS):
+        return {}
+    map_table, value_columns = SDE_MAP_COLUMNS[table_name]
+    id_columns = [c for c in SDE_COLUMNS[table_name][0] + ['id'] if c in records[0]]
+    value_columns = [c for c in value_columns if c in records[0]]
+    if (len(id_columns) < 1) or (len(value_columns) < 1):
+        return {}
+    mapping = dict()
+    for record in records:
+        if record[value_columns[0]] not in (None, ''):
+            mapping[int(record[id_columns[0]])] = int(record[value_columns[0]])
+    return {map_table: mapping}
+
+
+def static_map_from_mapping(mapping: dict, table_name: str) -> dict:
+    """
+    :param mapping: dict id => {'name': ..., 'groupID': ...}
+    :param table_name: target names table
+    :return: dict map_table => dict id => value, empty if values have no such key
+    """
+    if table_name not in SDE_MAP_COLUMNS:
+        return {}
+    map_table, value_columns = SDE_MAP_COLUMNS[table_name]
+    ret = dict()
+    for key, value in mapping.items():
+        if not isinstance(value, dict):
+            continue
+        for value_column in value_columns:
+            if value.get(value_column) is not None:
+                ret[int(key)] = int(value[value_column])
+                break
+    if len(ret) < 1:
+        return {}
+    return {map_table: ret}
+
+
+def names_from_mapping(mapping: dict, table_name: str) -> dict:
+    """
+    :param mapping: dict id => name or id => {'name': ...}
+    :param table_name: target table, required, mapping has no column names
+    :return: dict id => name
+    """
+    if table_name is None:
+        raise ValueError('Target table cannot be guessed for id => name mapping, use --table.')
+    names = dict()
+    for key, value in mapping.items():
+        name = get_record_name(value)
+        if name != '':
+            names[int(key)] = name
+    return names
+
+
+def load_csv(filename: str, table_name: str = None) -> dict:
+    with open(filename, 'rt', encoding='utf-8', newline='') as f:
+        records = list(csv.DictReader(f))
+    table_name, names = names_from_records(records, table_name)
+    ret = {table_name: names}
+    ret.update(static_map_from_records(records, table_name))
+    return ret
+
+
+def load_structured(data, table_name: str = None) -> dict:
+    if isinstance(data, list):
+        table_name, names = names_from_records(data, table_name)
+        ret = {table_name: names}
+        ret.update(static_map_from_records(data, table_name))
+        return ret
+    if isinstance(data, dict):
+        ret = {table_name: names_from_mapping(data, table_name)}
+        ret.update(static_map_from_mapping(data, table_name))
+        return ret
+    raise ValueError('Unsupported data layout: {}'.format(type(data)))
+
+
+def load_json(filename: str, table_name: str = None) -> dict:
+    with open(filename, 'rt', encoding='utf-8') as f:
+        data = json.load(f)
+    return load_structured(data, table_name)
+
+
+def load_yaml(filename: str, table_name: str = None) -> dict:
+    try:
+        import yaml
+    except ImportError:
+        raise ValueError('PyYAML is required to import YAML files: pip install pyyaml')
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    with open(filename, 'rt', encoding='utf-8') as f:
+        data = yaml.load(f, Loader=loader)
+    return load_structured(data, table_name)
+
+
+def load_sqlite(filename: str, table_name: str = None) -> dict:
+    ret = dict()
+    conn = sqlite3.connect(filename)
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT name FROM sqlite_master WHERE type='table'")
+        existing_tables = [row[0] for row in cur]
+        for sde_table, a_table_name in SDE_SQLITE_TABLES.items():
+            if sde_table not in existing_tables:
+                continue
+            if (table_name is not None) and (table_name != a_table_name):
+                continue
+            id_column, name_column = SDE_COLUMNS[a_table_name][0][0], SDE_COLUMNS[a_table_name][1][0]
+            map_table, value_column = SDE_MAP_COLUMNS[a_table_name][0], SDE_MAP_COLUMNS[a_table_name][1][0]
+            cur.execute('SELECT {}, {}, {} FROM {}'.format(id_column, name_column, value_column, sde_table))
+            rows = cur.fetchall()
+            ret[a_table_name] = {row[0]: row[1] for row in rows if row[1]}
+            ret[map_table] = {row[0]: row[2] for row in rows if row[2] is not None}
+        cur.close()
+    finally:
+        conn.close()
+    if len(ret) < 1:
+        raise ValueError('No known SDE tables found in {}'.format(filename))
+    return ret
+
+
+def load_sde_file(filename: str, table_name: str = None) -> dict:
+    """
+    Load names from SDE file of any supported format
+    :param filename: path to file
+    :param table_name: target table (solarsystems or types), guessed if None
+    :return: dict table_name => dict id => name (or map table => dict id => value)
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.csv':
+        return load_csv(filename, table_name)
+    if ext == '.json':
+        return load_json(filename, table_name)
+    if ext in ('.yaml', '.yml'):
+        return load_yaml(filename, table_name)
+    if ext in ('.sqlite', '.sqlite3', '.db'):
+        return load_sqlite(filename, table_name)
+    raise ValueError('Unsupported file type: {}'.format(filename))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import static EVE names (SDE) into names database.')
+    parser.add_argument('--db', default='eve_names.db', help='names database file (default: eve_names.db)')
+    parser.add_argument('--table', choices=sorted(SDE_COLUMNS.keys()), default=None,
+                        help='target table, guessed from file contents if not given')
+    parser.add_argument('files', nargs='+', help='SDE files: .csv, .json, .yaml, .sqlite')
+    args = parser.parse_args()
+
+    names_by_table = dict()
+    maps_by_table = dict()
+    try:
+        for filename in args.files:
+            for table_name, names in load_sde_file(filename, args.table).items():
+                if table_name in EveNamesDb.STATIC_MAPS:
+                    maps_by_table.setdefault(table_name, dict()).update(names)
+                    print('{}: {} {} entries'.format(filename, len(names), table_name))
+                else:
+                    names_by_table.setdefault(table_name, dict()).update(names)
+                    print('{}: {} {} names'.format(filename, len(names), table_name))
+    except (IOError, ValueError, KeyError, sqlite3.Error) as e:
+        print('Failed to load SDE: {}'.format(str(e)), file=sys.stderr)
+        sys.exit(1)
+
+    eve_names = EveNamesDb(args.db)
+    eve_names.set_names_bulk(names_by_table)
+    eve_names.set_static_map_bulk(maps_by_table)
+    names_by_table.update(maps_by_table)
+    print('Imported into {}: {}'.format(
+        args.db, ', '.join(['{} {}'.format(len(n), t) for t, n in names_by_table.items()])))
+
+
+if __name__ == '__main__':
+    main()
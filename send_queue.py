@@ -0,0 +1,167 @@
+import sqlite3
+import threading
+import time
+from typing import Union, List
+
+
+class OutgoingMessage:
+    def __init__(self, msg_id: str, chat_id: Union[str, int], text: str, parse_mode: str = 'Markdown',
+                 disable_web_page_preview: bool = False, attempts: int = 0):
+        self.msg_id = msg_id
+        self.chat_id = chat_id
+        self.text = text
+        self.parse_mode = parse_mode
+        self.disable_web_page_preview = disable_web_page_preview
+        self.attempts = attempts
+
+
+class SendQueue:
+    """
+    Durable outgoing messages queue, stored in SQLite.
+    Each message has a unique msg_id, enqueueing the same msg_id again is a no-op,
+    so re-sending the same notification after restart does not produce duplicates.
+    Failed messages are retried with exponential backoff.
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_SENDING = 'sending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+
+    def __init__(self, db_filename: str, max_attempts: int = 10,
+                 backoff_base_secs: float = 5, backoff_max_secs: float = 3600):
+        self.db_filename = db_filename
+        self.max_attempts = max_attempts
+        self.backoff_base_secs = backoff_base_secs
+        self.backoff_max_secs = backoff_max_secs
+        self._conn = sqlite3.connect(self.db_filename, check_same_thread=False)
+        self._write_lock = threading.Lock()
+        self.check_tables()
+
+    def check_tables(self):
+        """
+        Automatically create needed tables if not exist
+        :return: None
+        """
+        with self._write_lock:
+            with self._conn:
+                self._conn.execute('CREATE TABLE IF NOT EXISTS outbox ('
+                                   'msg_id TEXT PRIMARY KEY NOT NULL, '
+                                   'chat_id TEXT NOT NULL, '
+                                   'text TEXT NOT NULL, '
+                                   'parse_mode TEXT, '
+                                   'disable_web_page_preview INTEGER, '
+                                   'status TEXT NOT NULL, '
+                                   'attempts INTEGER NOT NULL DEFAULT 0, '
+                                   'next_attempt_at REAL NOT NULL, '
+                                   'created_at REAL NOT NULL, '
+                                   'last_error TEXT)')
+                self._conn.execute('CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at)')
+
+    def recover(self) -> int:
+        """
+        Return messages that were being sent when the process died back to the queue.
+        Call once on startup, before starting a worker.
+        :return: number of recovered messages
+        """
+        with self._write_lock:
+            with self._conn:
+                cur = self._conn.execute('UPDATE outbox SET status = ? WHERE status = ?',
+                                         (self.STATUS_PENDING, self.STATUS_SENDING))
+                return cur.rowcount
+
+    def enqueue_many(self, messages: List[OutgoingMessage]) -> int:
+        """
+        Add messages to the queue in a single transaction
+        :return: number of really added messages (already known msg_ids are skipped)
+        """
+        now = time.time()
+        rows = [(m.msg_id, str(m.chat_id), m.text, m.parse_mode, int(m.disable_web_page_preview),
+                 self.STATUS_PENDING, now, now) for m in messages]
+        with self._write_lock:
+            with self._conn:
+                before = self._conn.total_changes
+                self._conn.executemany('INSERT OR IGNORE INTO outbox (msg_id, chat_id, text, parse_mode, '
+                                       'disable_web_page_preview, status, next_attempt_at, created_at) '
+                                       'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                return self._conn.total_changes - before
+
+    def enqueue(self, message: OutgoingMessage) -> bool:
+        return self.enqueue_many([message]) > 0
+
+    def fetch_due(self, limit: int = 100) -> List[OutgoingMessage]:
+        """
+        Take messages which are due to be sent now, and mark them as being sent
+        :return: list of messages
+        """
+        ret = []
+        with self._write_lock:
+            with self._conn:
+                cur = self._conn.execute('SELECT msg_id, chat_id, text, parse_mode, disable_web_page_preview, '
+                                         'attempts FROM outbox WHERE status = ? AND next_attempt_at <= ? '
+                                         'ORDER BY created_at LIMIT ?', (self.STATUS_PENDING, time.time(), limit))
+                for row in cur.fetchall():
+                    # chat ids are stored as text, numeric ones are ints everywhere else
+                    chat_id = int(row[1]) if row[1].lstrip('-').isdigit() else row[1]
+                    ret.append(OutgoingMessage(row[0], chat_id, row[2], row[3], bool(row[4]), row[5]))
+                self._conn.executemany('UPDATE outbox SET status = ? WHERE msg_id = ?',
+                                       [(self.STATUS_SENDING, m.msg_id) for m in ret])
+        return ret
+
+    def mark_sent(self, msg_id: str) -> None:
+        with self._write_lock:
+            with self._conn:
+                self._conn.execute('UPDATE outbox SET status = ?, last_error = NULL WHERE msg_id = ?',
+                                   (self.STATUS_SENT, msg_id))
+
+    def mark_failed(self, msg_id: str, error: str = '', permanent: bool = False) -> None:
+        """
+        Schedule a retry with exponential backoff, or give up after max_attempts
+        :param msg_id: message id
+        :param error: error description
+        :param permanent: give up right away, retrying will not help (chat not found, bad markup)
+        """
+        with self._write_lock:
+            with self._conn:
+                row = self._conn.execute('SELECT attempts FROM outbox WHERE msg_id = ?', (msg_id,)).fetchone()
+                if row is None:
+                    return
+                attempts = row[0] + 1
+                status = self.STATUS_PENDING
+                if permanent or (attempts >= self.max_attempts):
+                    status = self.STATUS_FAILED
+                delay = min(self.backoff_max_secs, self.backoff_base_secs * (2 ** (attempts - 1)))
+                self._conn.execute('UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, '
+                                   'last_error = ? WHERE msg_id = ?',
+                                   (status, attempts, time.time() + delay, error, msg_id))
+
+    def next_due_in(self) -> float:
+        """
+        :return: seconds until next pending message is due, or -1 if there are no pending messages
+        """
+        cur = self._conn.execute('SELECT MIN(next_attempt_at) FROM outbox WHERE status = ?',
+                                 (self.STATUS_PENDING,))
+        row = cur.fetchone()
+        cur.close()
+        if (row is None) or (row[0] is None):
+            return -1
+        return max(0.0, row[0] - time.time())
+
+    def purge(self, older_than_secs: float = 7 * 24 * 3600) -> int:
+        """
+        Delete old sent and failed messages. msg_ids are remembered until purged,
+        so keep them long enough to cover re-enqueueing after restarts.
+        :return: number of deleted messages
+        """
+        with self._write_lock:
+            with self._conn:
+                cur = self._conn.execute('DELETE FROM outbox WHERE status IN (?, ?) AND created_at < ?',
+                                         (self.STATUS_SENT, self.STATUS_FAILED, time.time() - older_than_secs))
+                return cur.rowcount
+
+    def stats(self) -> dict:
+        ret = dict()
+        cur = self._conn.execute('SELECT status, COUNT(*) FROM outbox GROUP BY status')
+        for row in cur:
+            ret[row[0]] = row[1]
+        cur.close()
+        return ret
@@ -0,0 +1,324 @@
+import random
+import sys
+import threading
+import time
+from typing import Iterable, List, Optional, Set, Union
+
+from killmail import Killmail, Participant, ZkbMeta
+
+
+# command argument => filter name
+FILTER_ALIASES = {
+    'char': 'character',
+    'character': 'character',
+    'corp': 'corporation',
+    'corporation': 'corporation',
+    'ally': 'alliance',
+    'alliance': 'alliance',
+    'system': 'system',
+    'region': 'region',
+    'group': 'group',
+    'ship': 'type',
+    'type': 'type'
+}
+
+ISK_SUFFIXES = {
+    'k': 1000.0,
+    'm': 1000000.0,
+    'b': 1000000000.0
+}
+
+
+def parse_isk_value(s: str) -> float:
+    """
+    Parse ISK value as typed by user: 150000000, 150m, 1.5b, 500k
+    :raises ValueError: if value is invalid
+    """
+    s = s.strip().lower().replace(',', '')
+    multiplier = 1.0
+    if (len(s) > 0) and (s[-1] in ISK_SUFFIXES):
+        multiplier = ISK_SUFFIXES[s[-1]]
+        s = s[:-1]
+    value = float(s) * multiplier
+    if value < 0:
+        raise ValueError('ISK value can not be negative')
+    return value
+
+
+class ChatSubscription:
+    """
+    Kill filters of a single chat.
+
+    Entity filters (characters, corporations, alliances, systems, regions,
+    ship groups and types) are OR'ed: kill matches if any participant (victim or attacker)
+    is one of listed characters/corporations/alliances or flies a ship of listed group or type,
+    or kill happened in one of listed systems/regions. Chat with no entity
+    filters gets all kills. min_isk is applied on top of that.
+    """
+    FILTERS = ('character', 'corporation', 'alliance', 'system', 'region', 'group', 'type')
+
+    def __init__(self, chat_id: Union[str, int]):
+        self.chat_id = chat_id
+        self.ids = dict()
+        for filter_name in self.FILTERS:
+            self.ids[filter_name] = set()
+        self.min_isk = 0.0
+
+    def has_entity_filters(self) -> bool:
+        for ids in self.ids.values():
+            if len(ids) > 0:
+                return True
+        return False
+
+    def is_empty(self) -> bool:
+        return (not self.has_entity_filters()) and (self.min_isk <= 0)
+
+    def matches(self, kill: Killmail) -> bool:
+        if kill.zkb.total_value < self.min_isk:
+            return False
+        if not self.has_entity_filters():
+            return True
+        if (kill.solar_system_id in self.ids['system']) or (kill.region_id in self.ids['region']):
+            return True
+        characters = self.ids['character']
+        corporations = self.ids['corporation']
+        alliances = self.ids['alliance']
+        groups = self.ids['group']
+        types = self.ids['type']
+        for party in kill.participants():
+            if (party.character_id in characters) or (party.corporation_id in corporations) \
+                    or (party.alliance_id in alliances) or (party.ship_group_id in groups) \
+                    or (party.ship_type_id in types):
+                return True
+        return False
+
+    def describe(self) -> str:
+        lines = []
+        for filter_name in self.FILTERS:
+            if len(self.ids[filter_name]) > 0:
+                lines.append('{}: {}'.format(filter_name, ', '.join([str(i) for i in sorted(self.ids[filter_name])])))
+        if self.min_isk > 0:
+            lines.append('min ISK value: {:,.0f}'.format(self.min_isk))
+        if len(lines) < 1:
+            return 'No filters, all kills are shown.'
+        return '\n'.join(lines)
+
+    def copy(self) -> 'ChatSubscription':
+        sub = ChatSubscription(self.chat_id)
+        sub.min_isk = self.min_isk
+        for filter_name, ids in self.ids.items():
+            sub.ids[filter_name] = set(ids)
+        return sub
+
+    def to_dict(self) -> dict:
+        ret = {'min_isk': self.min_isk}
+        for filter_name in self.FILTERS:
+            ret[filter_name] = sorted(self.ids[filter_name])
+        return ret
+
+    @classmethod
+    def from_dict(cls, chat_id: Union[str, int], d: dict) -> 'ChatSubscription':
+        sub = cls(chat_id)
+        sub.min_isk = float(d.get('min_isk', 0.0))
+        for filter_name in cls.FILTERS:
+            sub.ids[filter_name] = set([int(i) for i in d.get(filter_name, [])])
+        return sub
+
+
+def chats_matching_kill(subscriptions: dict, chat_ids: Iterable[Union[str, int]], kill: Killmail) -> List:
+    """
+    Straightforward matching, tests every chat's filters: O(chats x participants).
+    See SubscriptionIndex for the fast one.
+    :param subscriptions: dict chat_id => ChatSubscription
+    :param chat_ids: registered chats
+    :param kill: kill with region and ship groups filled in
+    :return: list of chat ids which should be notified about this kill
+    """
+    ret = []
+    for chat_id in chat_ids:
+        sub = subscriptions.get(chat_id)
+        if (sub is None) or sub.matches(kill):
+            ret.append(chat_id)
+    return ret
+
+
+class SubscriptionIndex:
+    """
+    Inverted index of registered chats' filters: filter name => entity id => chat ids.
+    A kill's participants are looked up once each, so matching takes time
+    proportional to number of participants (and matched chats), not to number of chats.
+    Chats without entity filters are kept aside, they match every kill.
+    """
+    def __init__(self):
+        self._index = dict()
+        for filter_name in ChatSubscription.FILTERS:
+            self._index[filter_name] = dict()
+        # chat_id => ChatSubscription, for all indexed chats
+        self._subs = dict()
+        # chat_id => min_isk, for chats without entity filters
+        self._unfiltered = dict()
+        # chat_id => min_isk, for chats with entity filters and min_isk > 0
+        self._min_isk = dict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._subs)
+
+    def has_filters(self, filter_name: str) -> bool:
+        """
+        :return: True if any chat filters kills by this filter, e.g. 'region'
+        """
+        return len(self._index[filter_name]) > 0
+
+    def _remove(self, chat_id: Union[str, int]) -> None:
+        sub = self._subs.pop(chat_id, None)
+        self._unfiltered.pop(chat_id, None)
+        self._min_isk.pop(chat_id, None)
+        if sub is None:
+            return
+        for filter_name, ids in sub.ids.items():
+            filter_index = self._index[filter_name]
+            for iid in ids:
+                chats = filter_index.get(iid)
+                if chats is None:
+                    continue
+                chats.discard(chat_id)
+                if len(chats) < 1:
+                    del filter_index[iid]
+
+    def _add(self, chat_id: Union[str, int], sub: Optional[ChatSubscription]) -> None:
+        if sub is None:
+            sub = ChatSubscription(chat_id)
+        # keep a copy, so that later changes of sub do not break the index
+        sub = sub.copy()
+        self._subs[chat_id] = sub
+        if not sub.has_entity_filters():
+            self._unfiltered[chat_id] = sub.min_isk
+            return
+        if sub.min_isk > 0:
+            self._min_isk[chat_id] = sub.min_isk
+        for filter_name, ids in sub.ids.items():
+            filter_index = self._index[filter_name]
+            for iid in ids:
+                filter_index.setdefault(iid, set()).add(chat_id)
+
+    def update_chat(self, chat_id: Union[str, int], sub: Optional[ChatSubscription]) -> None:
+        """
+        Add registered chat or replace its filters
+        :param chat_id: chat id
+        :param sub: chat's filters, None if chat gets all kills
+        """
+        with self._lock:
+            self._remove(chat_id)
+            self._add(chat_id, sub)
+
+    def remove_chat(self, chat_id: Union[str, int]) -> None:
+        with self._lock:
+            self._remove(chat_id)
+
+    def rebuild(self, subscriptions: dict, chat_ids: Iterable[Union[str, int]]) -> None:
+        """
+        :param subscriptions: dict chat_id => ChatSubscription
+        :param chat_ids: registered chats
+        """
+        with self._lock:
+            for filter_index in self._index.values():
+                filter_index.clear()
+            self._subs.clear()
+            self._unfiltered.clear()
+            self._min_isk.clear()
+            for chat_id in chat_ids:
+                self._add(chat_id, subscriptions.get(chat_id))
+
+    def match(self, kill: Killmail) -> Set:
+        """
+        :param kill: kill with region and ship groups filled in
+        :return: set of chat ids which should be notified about this kill
+        """
+        value = kill.zkb.total_value
+        # collect distinct ids first: attackers often share corporations, alliances and ships
+        characters = set()
+        corporations = set()
+        alliances = set()
+        groups = set()
+        types = set()
+        for party in kill.participants():
+            characters.add(party.character_id)
+            corporations.add(party.corporation_id)
+            alliances.add(party.alliance_id)
+            groups.add(party.ship_group_id)
+            types.add(party.ship_type_id)
+        lookups = [('system', [kill.solar_system_id]), ('region', [kill.region_id]),
+                   ('character', characters), ('corporation', corporations), ('alliance', alliances),
+                   ('group', groups), ('type', types)]
+        ret = set()
+        with self._lock:
+            for chat_id, min_isk in self._unfiltered.items():
+                if value >= min_isk:
+                    ret.add(chat_id)
+            matched = set()
+            for filter_name, ids in lookups:
+                filter_index = self._index[filter_name]
+                for iid in ids:
+                    chats = filter_index.get(iid)
+                    if chats is not None:
+                        matched.update(chats)
+            min_isk_by_chat = self._min_isk
+            for chat_id in matched:
+                if value >= min_isk_by_chat.get(chat_id, 0.0):
+                    ret.add(chat_id)
+        return ret
+
+
+def _make_benchmark_data(num_subs: int, num_kills: int, num_attackers: int) -> tuple:
+    rnd = random.Random(42)
+    subscriptions = dict()
+    chat_ids = []
+    for chat_id in range(num_subs):
+        chat_ids.append(chat_id)
+        if chat_id % 100 == 0:
+            continue  # some chats get everything
+        sub = ChatSubscription(chat_id)
+        for _ in range(rnd.randint(1, 5)):
+            filter_name = rnd.choice(['character', 'corporation', 'corporation', 'alliance', 'system', 'region'])
+            sub.ids[filter_name].add(rnd.randint(1, 20000))
+        if rnd.random() < 0.3:
+            sub.min_isk = rnd.choice([1e8, 1e9])
+        subscriptions[chat_id] = sub
+    kills = []
+    for i in range(num_kills):
+        attackers = [Participant(rnd.randint(1, 20000), rnd.randint(1, 20000), rnd.randint(1, 20000), 0,
+                                 rnd.randint(1, 20000)) for _ in range(num_attackers)]
+        victim = Participant(rnd.randint(1, 20000), rnd.randint(1, 20000), rnd.randint(1, 20000), 0,
+                             rnd.randint(1, 20000))
+        kill = Killmail(i, '', None, rnd.randint(1, 20000), victim, attackers,
+                        ZkbMeta(total_value=rnd.choice([1e7, 5e8, 5e9])))
+        kill.region_id = rnd.randint(1, 20000)
+        kills.append(kill)
+    return subscriptions, chat_ids, kills
+
+
+def benchmark(num_subs: int = 10000, num_kills: int = 200, num_attackers: int = 20) -> None:
+    subscriptions, chat_ids, kills = _make_benchmark_data(num_subs, num_kills, num_attackers)
+    print('{} subscriptions, {} kills x {} attackers'.format(num_subs, num_kills, num_attackers))
+
+    t0 = time.perf_counter()
+    index = SubscriptionIndex()
+    index.rebuild(subscriptions, chat_ids)
+    print('  index build:     {:>10.1f} ms'.format((time.perf_counter() - t0) * 1000))
+
+    t0 = time.perf_counter()
+    naive_results = [set(chats_matching_kill(subscriptions, chat_ids, kill)) for kill in kills]
+    naive_secs = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    index_results = [index.match(kill) for kill in kills]
+    index_secs = time.perf_counter() - t0
+    if naive_results != index_results:
+        print('  ERROR: results differ!')
+    print('  naive matching:  {:>10.0f} kills/sec'.format(num_kills / naive_secs))
+    print('  index matching:  {:>10.0f} kills/sec'.format(num_kills / index_secs))
+    print('  avg chats per kill: {:.1f}'.format(sum([len(r) for r in index_results]) / num_kills))
+
+
+if __name__ == '__main__':
+    benchmark(*[int(arg) for arg in sys.argv[1:4]])
@@ -0,0 +1,94 @@
+import hmac
+import http.server
+import json
+import logging
+import sys
+import threading
+from typing import Callable
+
+from bot_logger import create_logger
+
+
+class _WebhookRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        srv = self.server
+        if self.path.split('?')[0] != srv.webhook_path:
+            self._reply(404)
+            return
+        # telegram sends secret_token given in setWebhook in every request
+        secret = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(secret.encode('utf-8'), srv.secret_token.encode('utf-8')):
+            srv.log.warning('Rejected webhook request with wrong secret token from {}'.format(
+                self.client_address[0]))
+            self._reply(403)
+            return
+        try:
+            length = int(self.headers.get('Content-Length', '0'))
+        except ValueError:
+            length = -1
+        if (length <= 0) or (length > srv.max_body_size):
+            self._reply(400)
+            return
+        try:
+            update = json.loads(self.rfile.read(length).decode('utf-8'))
+        except ValueError:
+            self._reply(400)
+            return
+        if (not isinstance(update, dict)) or ('update_id' not in update):
+            self._reply(400)
+            return
+        # reply fast, telegram waits for it before sending next update
+        self._reply(200)
+        try:
+            srv.on_update(update)
+        except Exception:
+            srv.log.exception('Failed to dispatch update {}'.format(update['update_id']))
+
+    def do_GET(self):
+        self._reply(405)
+
+    def _reply(self, status: int) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    def log_message(self, format, *args):
+        self.server.log.debug('webhook: ' + format % args)
+
+
+class TelegramWebhookServer:
+    """
+    Small HTTP server receiving telegram updates pushed by setWebhook.
+    Telegram connects only over HTTPS, so usually it listens on localhost
+    behind a TLS terminating reverse proxy (nginx, caddy).
+    Every accepted update is passed to on_update(update) in server's thread.
+    """
+    def __init__(self, host: str, port: int, webhook_path: str, secret_token: str,
+                 on_update: Callable[[dict], None], max_body_size: int = 1024 * 1024):
+        self.log = create_logger(__name__, level=logging.DEBUG, stream=sys.stdout, filename='bot.log')
+        self._httpd = http.server.ThreadingHTTPServer((host, port), _WebhookRequestHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.webhook_path = webhook_path
+        self._httpd.secret_token = secret_token
+        self._httpd.on_update = on_update
+        self._httpd.max_body_size = max_body_size
+        self._httpd.log = self.log
+        self._thread = None
+
+    @property
+    def server_address(self) -> tuple:
+        return self._httpd.server_address
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='telegram-webhook', daemon=True)
+        self._thread.start()
+        self.log.info('Listening for telegram updates on {}:{}{}'.format(
+            self.server_address[0], self.server_address[1], self._httpd.webhook_path))
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
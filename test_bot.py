@@ -0,0 +1,118 @@
+"""
+Tests of ZKBBot command handling, without connecting to telegram,
+and of splitting long messages.
+Run with: python -m pytest test_bot.py  (or python test_bot.py)
+"""
+import os
+import tempfile
+import unittest
+
+from bot import ZKBBot, markdown_open_entity, split_message_text
+from kill_formatter import utf16_len
+
+
+class BotTestCase(unittest.TestCase):
+    def setUp(self):
+        # bot writes its log and saved state into current directory
+        self._old_cwd = os.getcwd()
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self._tmp_dir.name)
+        self.bot = ZKBBot('test-token')
+
+    def tearDown(self):
+        os.chdir(self._old_cwd)
+        self._tmp_dir.cleanup()
+
+
+class TestSubscriptionCommands(BotTestCase):
+    def test_sub_registers_chat(self):
+        reply = self.bot.handle_subscription_command(100, '/sub', ['corp', '98000001'])
+        self.assertTrue(reply.startswith('Ok.'))
+        self.assertEqual(self.bot.chats_notify, [100])
+        self.assertEqual(self.bot.subscriptions[100].ids['corporation'], {98000001})
+        self.assertEqual(len(self.bot.subscription_index), 1)
+
+    def test_unsub_all_does_not_register_chat(self):
+        reply = self.bot.handle_subscription_command(100, '/unsub', ['all'])
+        self.assertIn('not registered', reply)
+        self.assertEqual(self.bot.chats_notify, [])
+        self.assertEqual(self.bot.subscriptions, {})
+        self.assertEqual(len(self.bot.subscription_index), 0)
+
+    def test_unsub_filter_does_not_register_chat(self):
+        reply = self.bot.handle_subscription_command(100, '/unsub', ['corp', '123'])
+        self.assertIn('not registered', reply)
+        self.assertEqual(self.bot.chats_notify, [])
+        self.assertEqual(len(self.bot.subscription_index), 0)
+
+    def test_unsub_registered_chat(self):
+        self.bot.handle_subscription_command(100, '/sub', ['corp', '98000001', '98000002'])
+        reply = self.bot.handle_subscription_command(100, '/unsub', ['corp', '98000001'])
+        self.assertTrue(reply.startswith('Ok.'))
+        self.assertEqual(self.bot.chats_notify, [100])
+        self.assertEqual(self.bot.subscriptions[100].ids['corporation'], {98000002})
+
+
+class TestSplitMessageText(unittest.TestCase):
+    def assertValidParts(self, parts: list, max_length: int):
+        self.assertGreater(len(parts), 1)
+        for part in parts:
+            self.assertLessEqual(utf16_len(part), max_length, part)
+            self.assertEqual(markdown_open_entity(part), '', part)
+            self.assertNotEqual(part.strip(), '')
+
+    def test_short_text_is_not_split(self):
+        self.assertEqual(split_message_text('*short* text', 100), ['*short* text'])
+
+    def test_digest_is_split_between_kills(self):
+        kills = ['*Victim {}* lost a *Capsule*.\nValue: *10 Mil* ISK. https://zkillboard.com/kill/{}/'.format(
+            i, 70000000 + i) for i in range(10)]
+        parts = split_message_text('\n\n'.join(kills), 200)
+        self.assertValidParts(parts, 200)
+        # every part consists of whole kills
+        self.assertEqual('\n\n'.join(parts), '\n\n'.join(kills))
+        for part in parts:
+            for kill_text in part.split('\n\n'):
+                self.assertIn(kill_text, kills)
+
+    def test_long_bold_line(self):
+        text = '*' + ' '.join(['word{}'.format(i) for i in range(60)]) + '*'
+        parts = split_message_text(text, 50)
+        self.assertValidParts(parts, 50)
+        for part in parts:
+            self.assertTrue(part.startswith('*') and part.endswith('*'), part)
+
+    def test_code_block_spanning_parts(self):
+        text = 'Log:\n```\n' + '\n'.join(['line {} of code'.format(i) for i in range(20)]) + '\n```\nend'
+        parts = split_message_text(text, 80)
+        self.assertValidParts(parts, 80)
+        self.assertTrue(parts[1].startswith('```\n'), parts[1])
+
+    def test_emoji_count_as_two(self):
+        text = '\U0001F600' * 50
+        parts = split_message_text(text, 40, parse_mode='')
+        self.assertValidParts(parts, 40)
+        self.assertEqual(''.join(parts), text)
+        self.assertEqual([len(part) for part in parts], [20, 20, 10])
+
+    def test_link_at_boundary_is_moved_whole(self):
+        link = '[kill](https://zkillboard.com/kill/70000001/)'
+        text = 'x ' * 20 + link + ' tail'
+        parts = split_message_text(text, 60)
+        self.assertValidParts(parts, 60)
+        self.assertTrue(any([link in part for part in parts]), parts)
+
+    def test_link_across_lines(self):
+        text = 'see [docs\n' + 'x' * 40 + '\nmore](http://e.com) end'
+        parts = split_message_text(text, 30)
+        self.assertValidParts(parts, 30)
+
+    def test_link_spanning_lines_is_moved_whole(self):
+        text = 'x' * 30 + ' [first\nsecond](http://e.com) end'
+        parts = split_message_text(text, 40)
+        self.assertValidParts(parts, 40)
+        self.assertEqual(parts[1], '[first\nsecond](http://e.com) end')
+
+
+if __name__ == '__main__':
+    unittest.main()
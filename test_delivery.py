@@ -0,0 +1,67 @@
+"""
+Tests of delivery from the send queue, with telegram replies made up locally.
+Run with: python -m pytest test_delivery.py  (or python test_delivery.py)
+"""
+import os
+import tempfile
+import unittest
+
+from bot import ZKBBot
+from delivery import DeliveryEngine
+from send_queue import OutgoingMessage, SendQueue
+
+
+# chat_id => sendMessage reply, None for failed request
+REPLIES = {
+    1: {'ok': True, 'result': {}},
+    2: {'ok': False, 'error_code': 403, 'description': 'Forbidden: bot was blocked by the user'},
+    3: {'ok': False, 'error_code': 400, 'description': 'Bad Request: chat not found'},
+    4: None,
+    5: {'ok': False, 'error_code': 502, 'description': 'Bad Gateway'}
+}
+
+
+class TestProcessQueue(unittest.TestCase):
+    def setUp(self):
+        # bot writes its log and saved state into current directory
+        self._old_cwd = os.getcwd()
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self._tmp_dir.name)
+        self.bot = ZKBBot('test-token')
+        self.bot.chats_notify = list(REPLIES.keys())
+        self.bot.tg_bot_api_call = lambda method_name, params=None: REPLIES[params['chat_id']]
+        self.queue = SendQueue('send_queue.db')
+        self.engine = DeliveryEngine(self.bot)
+
+    def tearDown(self):
+        self.engine.shutdown()
+        self.queue._conn.close()
+        os.chdir(self._old_cwd)
+        self._tmp_dir.cleanup()
+
+    def message_status(self, msg_id: str) -> tuple:
+        return self.queue._conn.execute('SELECT status, attempts FROM outbox WHERE msg_id = ?',
+                                        (msg_id,)).fetchone()
+
+    def test_permanent_and_temporary_errors(self):
+        self.queue.enqueue_many([OutgoingMessage('msg{}'.format(chat_id), chat_id, 'text')
+                                 for chat_id in REPLIES.keys()])
+        self.assertEqual(self.engine.process_queue(self.queue), len(REPLIES))
+        self.assertEqual(self.message_status('msg1'), (SendQueue.STATUS_SENT, 0))
+        # permanent errors are not retried
+        self.assertEqual(self.message_status('msg2'), (SendQueue.STATUS_FAILED, 1))
+        self.assertEqual(self.message_status('msg3'), (SendQueue.STATUS_FAILED, 1))
+        # network errors and 5xx are retried later
+        self.assertEqual(self.message_status('msg4'), (SendQueue.STATUS_PENDING, 1))
+        self.assertEqual(self.message_status('msg5'), (SendQueue.STATUS_PENDING, 1))
+        # only the chat which blocked the bot is unregistered
+        self.assertEqual(self.bot.chats_notify, [1, 3, 4, 5])
+
+    def test_deliver_unregisters_blocked_chat(self):
+        results = self.engine.deliver([1, 2], 'text')
+        self.assertEqual(results, {1: True, 2: False})
+        self.assertNotIn(2, self.bot.chats_notify)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+"""
+Tests of names resolving with ESI requests replaced by local functions.
+Run with: python -m pytest test_eve_names_resolver.py  (or python test_eve_names_resolver.py)
+"""
+import os
+import tempfile
+import unittest
+
+from esi_calls import ESIException
+from eve_names_resolver import EveNamesDb, NameRecord
+
+
+class TestResolveNames(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.db = EveNamesDb(os.path.join(self._tmp_dir.name, 'eve_names.db'))
+        self.esi_calls = self.db._resolver.esi_calls
+
+    def tearDown(self):
+        self.db._conn.close()
+        self._tmp_dir.cleanup()
+
+    @staticmethod
+    def _names_chunk(ids: list) -> list:
+        # chunk of ids from 2001 fails; id 5 does not exist
+        if ids[0] > 2000:
+            raise ESIException('ESI error: Internal Server Error')
+        return [{'id': iid, 'name': 'Char {}'.format(iid), 'category': 'character'} for iid in ids if iid != 5]
+
+    def test_universe_names_keeps_successful_chunks(self):
+        self.esi_calls._universe_names_chunk = self._names_chunk
+        names, failed_ids = self.esi_calls.universe_names(list(range(1, 2500)))
+        self.assertEqual(len(names), 1999)
+        self.assertEqual(failed_ids, list(range(2001, 2500)))
+
+    def test_universe_names_single_chunk_fails(self):
+        self.esi_calls._universe_names_chunk = self._names_chunk
+        self.assertEqual(self.esi_calls.universe_names([2001, 2002]), ([], [2001, 2002]))
+
+    def test_resolve_ids_statuses(self):
+        self.esi_calls._universe_names_chunk = self._names_chunk
+        ids = list(range(1, 2500))
+        records = self.db._resolve_ids({'charnames': ids}, {'charnames': dict()})['charnames']
+        self.assertEqual(records[1].name, 'Char 1')
+        self.assertEqual(records[1].status, NameRecord.STATUS_OK)
+        self.assertEqual(records[5].name, '')
+        self.assertEqual(records[5].status, NameRecord.STATUS_NOT_FOUND)
+        for iid in range(2001, 2500):
+            self.assertEqual(records[iid].status, NameRecord.STATUS_ERROR)
+        num_ok = len([r for r in records.values() if r.status == NameRecord.STATUS_OK])
+        self.assertEqual(num_ok, 1999)
+
+
+if __name__ == '__main__':
+    unittest.main()
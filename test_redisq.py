@@ -0,0 +1,140 @@
+"""
+Tests of ZKBRedisQ against a local stand-in of RedisQ server.
+Run with: python -m pytest test_redisq.py  (or python test_redisq.py)
+"""
+import http.server
+import json
+import threading
+import unittest
+import unittest.mock
+import urllib.parse
+
+import requests
+
+from zkillboard import ZKBRedisQ
+
+
+KILL_PACKAGE = {
+    'killID': 70000001,
+    'killmail': {
+        'killmail_id': 70000001,
+        'killmail_time': '2018-01-02T03:04:05Z',
+        'solar_system_id': 30000142,
+        'victim': {'character_id': 91000001, 'corporation_id': 98000001, 'ship_type_id': 670,
+                   'damage_taken': 1000, 'items': []},
+        'attackers': [{'character_id': 90000001, 'corporation_id': 98000002, 'faction_id': 500001,
+                       'ship_type_id': 587, 'damage_done': 1000, 'final_blow': True}]
+    },
+    'zkb': {'locationID': 40009077, 'hash': 'abcdef', 'totalValue': 12345678.9, 'points': 1,
+            'npc': False, 'solo': True, 'awox': False}
+}
+
+
+class _RedisQHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        srv = self.server
+        url = urllib.parse.urlparse(self.path)
+        with srv.lock:
+            srv.requests.append(dict(urllib.parse.parse_qsl(url.query)))
+            if len(srv.replies) > 0:
+                status, body = srv.replies.pop(0)
+            else:
+                status, body = 200, json.dumps({'package': None})
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RedisQStandIn:
+    """
+    Serves scripted replies in order, then {"package": null} forever,
+    and remembers query parameters of every request.
+    """
+    def __init__(self, replies: list):
+        self._httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _RedisQHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.replies = list(replies)
+        self._httpd.requests = []
+        self._httpd.lock = threading.Lock()
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return 'http://{}:{}/listen.php'.format(*self._httpd.server_address)
+
+    @property
+    def requests(self) -> list:
+        with self._httpd.lock:
+            return list(self._httpd.requests)
+
+    def __enter__(self) -> 'RedisQStandIn':
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._thread.join()
+
+
+class TestZKBRedisQ(unittest.TestCase):
+    def make_redisq(self, server: RedisQStandIn) -> ZKBRedisQ:
+        # plain session: no retries, so every scripted reply reaches ZKBRedisQ
+        redisq = ZKBRedisQ({'url': server.url, 'queue_id': 'test-queue', 'ttw': 1,
+                            'session': requests.Session()})
+        redisq.error_backoff_secs = 0.01
+        return redisq
+
+    def test_listen_once_kill(self):
+        with RedisQStandIn([(200, json.dumps({'package': KILL_PACKAGE}))]) as server:
+            kill = self.make_redisq(server).listen_once()
+            self.assertEqual(server.requests, [{'queueID': 'test-queue', 'ttw': '1'}])
+        self.assertEqual(kill.killmail_id, 70000001)
+        self.assertEqual(kill.solar_system_id, 30000142)
+        self.assertEqual(kill.victim.character_id, 91000001)
+        self.assertEqual(kill.attackers[0].character_id, 90000001)
+        self.assertAlmostEqual(kill.zkb.total_value, 12345678.9)
+
+    def test_listen_once_null_package(self):
+        with RedisQStandIn([(200, json.dumps({'package': None}))]) as server:
+            self.assertIsNone(self.make_redisq(server).listen_once())
+
+    def test_listen_once_errors(self):
+        with RedisQStandIn([(500, '{}'), (200, 'not json'), (200, '{}')]) as server:
+            redisq = self.make_redisq(server)
+            self.assertRaises(ValueError, redisq.listen_once)
+            self.assertRaises(ValueError, redisq.listen_once)
+            self.assertRaises(KeyError, redisq.listen_once)
+
+    def test_listen_skips_nulls_and_backs_off_on_errors(self):
+        replies = [
+            (500, '{}'),
+            (200, json.dumps({'package': None})),
+            (200, 'not json'),
+            (200, json.dumps({'package': KILL_PACKAGE}))
+        ]
+        with RedisQStandIn(replies) as server:
+            redisq = self.make_redisq(server)
+            with unittest.mock.patch('zkillboard.time.sleep') as sleep:
+                kills = list(redisq.listen(should_stop=lambda: len(server.requests) >= len(replies)))
+            num_requests = len(server.requests)
+        self.assertEqual([kill.killmail_id for kill in kills], [70000001])
+        self.assertEqual(num_requests, len(replies))
+        # backed off once after each of 2 errors, and not after the null package
+        self.assertEqual(sleep.call_args_list, [unittest.mock.call(0.01)] * 2)
+
+    def test_listen_stops(self):
+        with RedisQStandIn([]) as server:
+            kills = list(self.make_redisq(server).listen(should_stop=lambda: len(server.requests) >= 2))
+            self.assertEqual(len(server.requests), 2)
+        self.assertEqual(kills, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
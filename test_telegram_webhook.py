@@ -0,0 +1,94 @@
+"""
+Tests of TelegramWebhookServer, with a local client in place of telegram.
+Run with: python -m pytest test_telegram_webhook.py  (or python test_telegram_webhook.py)
+"""
+import json
+import os
+import queue
+import tempfile
+import unittest
+
+import requests
+
+from bot import ZKBBot
+from telegram_webhook import TelegramWebhookServer
+
+
+SECRET = 'test-secret'
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class TestTelegramWebhookServer(unittest.TestCase):
+    def setUp(self):
+        # server writes its log into current directory
+        self._old_cwd = os.getcwd()
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self._tmp_dir.name)
+        self.updates = queue.Queue()
+        self.server = TelegramWebhookServer('127.0.0.1', 0, '/hook', SECRET, self.updates.put,
+                                            max_body_size=1024)
+        self.server.start()
+        self.url = 'http://127.0.0.1:{}/hook'.format(self.server.server_address[1])
+        self.session = requests.Session()
+
+    def tearDown(self):
+        self.session.close()
+        self.server.stop()
+        os.chdir(self._old_cwd)
+        self._tmp_dir.cleanup()
+
+    def post(self, body, url: str = None, secret: str = SECRET, headers: dict = None) -> int:
+        all_headers = {'Content-Type': 'application/json'}
+        if secret is not None:
+            all_headers[SECRET_HEADER] = secret
+        all_headers.update(headers or {})
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        r = self.session.post(url or self.url, data=body, headers=all_headers, timeout=5)
+        return r.status_code
+
+    def assertNoUpdates(self):
+        self.assertTrue(self.updates.empty())
+
+    def test_valid_update_is_dispatched(self):
+        update = {'update_id': 1, 'message': {'chat': {'id': 100}, 'text': '/reg'}}
+        self.assertEqual(self.post(update), 200)
+        self.assertEqual(self.updates.get(timeout=5), update)
+
+    def test_wrong_secret(self):
+        self.assertEqual(self.post({'update_id': 1}, secret='wrong'), 403)
+        self.assertNoUpdates()
+
+    def test_missing_secret(self):
+        self.assertEqual(self.post({'update_id': 1}, secret=None), 403)
+        self.assertNoUpdates()
+
+    def test_wrong_path(self):
+        self.assertEqual(self.post({'update_id': 1}, url=self.url + 'x'), 404)
+        self.assertNoUpdates()
+
+    def test_not_a_dict(self):
+        self.assertEqual(self.post([{'update_id': 1}]), 400)
+        self.assertEqual(self.post({'message': {}}), 400)
+        self.assertEqual(self.post(b'not json'), 400)
+        self.assertNoUpdates()
+
+    def test_too_big(self):
+        self.assertEqual(self.post({'update_id': 1, 'text': 'x' * 2000}), 400)
+        self.assertNoUpdates()
+
+    def test_repeated_updates_are_handled_once(self):
+        bot = ZKBBot('test-token')
+        handled = []
+        for update_id in (5, 3, 5, 4, 3):
+            self.assertEqual(self.post({'update_id': update_id}), 200)
+            update = self.updates.get(timeout=5)
+            if bot.mark_update_seen(update['update_id']):
+                handled.append(update['update_id'])
+        # out of order updates are not repeats
+        self.assertEqual(handled, [5, 3, 4])
+        self.assertEqual(bot.last_update_id, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
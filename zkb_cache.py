@@ -0,0 +1,173 @@
+import abc
+import collections
+import hashlib
+import json
+import os
+import os.path
+import threading
+import time
+from typing import Optional
+
+
+class CacheEntry:
+    def __init__(self, text: str, etag: str = '', last_modified: str = '', stored_at: float = 0):
+        self.text = text
+        self.etag = etag
+        self.last_modified = last_modified
+        self.stored_at = stored_at
+        if self.stored_at == 0:
+            self.stored_at = time.time()
+
+
+class ZKBCache(abc.ABC):
+    """
+    Interface of response cache used by ZKB.go(), keys are ZKB modifiers strings.
+    get_json() returns only fresh responses (younger than ttl), get_entry()
+    also returns expired ones, which still can be revalidated with ETag/Last-Modified.
+    """
+    def __init__(self, ttl: float = 10):
+        self.ttl = ttl
+
+    def get_json(self, key: str) -> Optional[str]:
+        entry = self.get_entry(key)
+        if (entry is None) or (time.time() - entry.stored_at > self.ttl):
+            return None
+        return entry.text
+
+    @abc.abstractmethod
+    def save_json(self, key: str, text: str, etag: str = '', last_modified: str = '') -> None:
+        pass
+
+    @abc.abstractmethod
+    def get_entry(self, key: str) -> Optional[CacheEntry]:
+        pass
+
+    @abc.abstractmethod
+    def touch(self, key: str) -> None:
+        """
+        Mark entry as fresh again (server said 304 Not Modified)
+        """
+        pass
+
+    def get_parsed(self, key: str):
+        """
+        :return: already parsed and normalized kills for this response, if cache can keep them
+        """
+        return None
+
+    def save_parsed(self, key: str, obj) -> None:
+        pass
+
+
+class MemoryTTLCache(ZKBCache):
+    """
+    Keeps up to max_entries most recently used responses in memory,
+    together with parsed kills, so 304 responses do not need parsing at all.
+    """
+    def __init__(self, ttl: float = 10, max_entries: int = 64):
+        super(MemoryTTLCache, self).__init__(ttl)
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._parsed = dict()
+        self._lock = threading.Lock()
+
+    def get_entry(self, key: str) -> Optional[CacheEntry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def save_json(self, key: str, text: str, etag: str = '', last_modified: str = '') -> None:
+        with self._lock:
+            self._entries[key] = CacheEntry(text, etag, last_modified)
+            self._entries.move_to_end(key)
+            self._parsed.pop(key, None)
+            while len(self._entries) > self.max_entries:
+                old_key, _ = self._entries.popitem(last=False)
+                self._parsed.pop(old_key, None)
+
+    def touch(self, key: str) -> None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.stored_at = time.time()
+
+    def get_parsed(self, key: str):
+        with self._lock:
+            return self._parsed.get(key)
+
+    def save_parsed(self, key: str, obj) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._parsed[key] = obj
+
+
+class DiskCache(ZKBCache):
+    """
+    Stores responses as files in cache_dir, survives restarts.
+    Keys change with every new afterKillID, so after each write files older
+    than max_age seconds are removed, and then the oldest ones, to keep
+    at most max_entries files.
+    """
+    def __init__(self, cache_dir: str = 'cache', ttl: float = 10, max_entries: int = 64,
+                 max_age: float = 24 * 3600):
+        super(DiskCache, self).__init__(ttl)
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_age = max_age
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def _filename(self, key: str) -> str:
+        # modifiers strings may be long, use hash as file name
+        return os.path.join(self.cache_dir, 'zkb_{}.json'.format(hashlib.sha1(key.encode('utf-8')).hexdigest()))
+
+    def get_entry(self, key: str) -> Optional[CacheEntry]:
+        try:
+            with open(self._filename(key), 'rt', encoding='utf-8') as f:
+                obj = json.load(f)
+            return CacheEntry(obj['text'], obj['etag'], obj['last_modified'], obj['stored_at'])
+        except (IOError, ValueError, KeyError):
+            return None
+
+    def save_json(self, key: str, text: str, etag: str = '', last_modified: str = '') -> None:
+        self._write(key, CacheEntry(text, etag, last_modified))
+        self._evict()
+
+    def touch(self, key: str) -> None:
+        entry = self.get_entry(key)
+        if entry is not None:
+            entry.stored_at = time.time()
+            self._write(key, entry)
+
+    def _write(self, key: str, entry: CacheEntry) -> None:
+        fn = self._filename(key)
+        try:
+            # write to temporary file first, so that readers never see a partial file
+            with open(fn + '.tmp', 'wt', encoding='utf-8') as f:
+                json.dump({'text': entry.text, 'etag': entry.etag, 'last_modified': entry.last_modified,
+                           'stored_at': entry.stored_at}, f)
+            os.replace(fn + '.tmp', fn)
+        except IOError:
+            pass
+
+    def _evict(self) -> None:
+        files = []
+        try:
+            for name in os.listdir(self.cache_dir):
+                if name.startswith('zkb_') and name.endswith('.json'):
+                    fn = os.path.join(self.cache_dir, name)
+                    files.append((os.path.getmtime(fn), fn))
+        except IOError:
+            return
+        files.sort()
+        older_than = time.time() - self.max_age
+        num_remove = len(files) - self.max_entries
+        for i, (mtime, fn) in enumerate(files):
+            if (i >= num_remove) and (mtime >= older_than):
+                break
+            try:
+                os.remove(fn)
+            except IOError:
+                pass
@@ -0,0 +1,208 @@
+"""
+Fast conversion of kills received from ZKB to Killmail objects.
+
+Run this file directly to benchmark normalization speed:
+    python zkb_normalizer.py [num_kills] [num_attackers]
+"""
+import codecs
+import datetime
+import json
+import sys
+import time
+import tracemalloc
+from typing import Iterable, Iterator, Union
+
+from killmail import Killmail, Participant, ZkbMeta
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+def loads_json(text):
+    """
+    Parse JSON using orjson, if it is installed, standard json module otherwise
+    :param text: str or bytes
+    :raises ValueError: on invalid JSON
+    """
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def iter_json_array(chunks: Iterable[Union[bytes, str]]) -> Iterator:
+    """
+    Incrementally decode top-level JSON array, yielding its items one by one
+    as soon as they are fully received. Only the current item is kept in memory,
+    not the whole document. Pure python fallback for ijson.items(f, 'item').
+    :param chunks: pieces of JSON text, for example response.iter_content()
+    :raises ValueError: on invalid or truncated JSON
+    """
+    decoder = json.JSONDecoder()
+    utf8_decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buf = ''
+    pos = 0
+    eof = False
+    started = False
+    # how much buffered text is needed before trying to decode next item again
+    need_len = 0
+
+    def read_more() -> None:
+        nonlocal buf, pos, eof
+        # forget already decoded text, so the buffer holds at most one item
+        buf = buf[pos:]
+        pos = 0
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            eof = True
+            buf += utf8_decoder.decode(b'', final=True)
+            return
+        if isinstance(chunk, bytes):
+            chunk = utf8_decoder.decode(chunk)
+        buf += chunk
+
+    while True:
+        # skip whitespace and item separators
+        while (pos < len(buf)) and (buf[pos] in ' \t\r\n,'):
+            pos += 1
+        if (not eof) and ((pos >= len(buf)) or (len(buf) - pos < need_len)):
+            read_more()
+            continue
+        if pos >= len(buf):
+            raise ValueError('Truncated JSON array')
+        need_len = 0
+        c = buf[pos]
+        if not started:
+            if c != '[':
+                raise ValueError('JSON array expected')
+            started = True
+            pos += 1
+            continue
+        if c == ']':
+            return
+        try:
+            obj, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            # item is not fully received yet; wait for twice as much data,
+            # so that a big item is not re-parsed for every small chunk
+            need_len = 2 * (len(buf) - pos)
+            continue
+        if (end >= len(buf)) or (buf[end] not in ' \t\r\n,]'):
+            if eof:
+                raise ValueError('Invalid JSON array item at: {}'.format(buf[pos:end + 10]))
+            # a number at the end of buffer may be not complete yet: "12" + "34", "2." + "5"
+            need_len = len(buf) - pos + 1
+            continue
+        pos = end
+        yield obj
+
+
+# ZKB has changed kill time format over time:
+#   current ZKB: "2017-06-07T17:02:57Z"
+#   some older formats: '2015-07-08 01:11:00', '2015.07.08 01:11:00'
+KILL_TIME_FORMATS = ['%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%d %H:%M:%S', '%Y.%m.%d %H:%M:%S']
+_last_time_format = [KILL_TIME_FORMATS[0]]
+
+
+def parse_kill_time(s: str) -> datetime.datetime:
+    """
+    Parse kill time string to naive UTC datetime
+    :raises ValueError: if format is not known
+    """
+    # fast path for current format, fromisoformat is many times faster than strptime
+    if (len(s) == 20) and (s[10] == 'T') and (s[19] == 'Z'):
+        try:
+            return datetime.datetime.fromisoformat(s[:19])
+        except ValueError:
+            pass
+    # try the format that worked last time first
+    try:
+        return datetime.datetime.strptime(s, _last_time_format[0])
+    except ValueError:
+        pass
+    for fmt in KILL_TIME_FORMATS:
+        try:
+            dt = datetime.datetime.strptime(s, fmt)
+            _last_time_format[0] = fmt
+            return dt
+        except ValueError:
+            pass
+    raise ValueError('Unknown kill time format: {}'.format(s))
+
+
+def normalize_zkb_kill(a_kill: dict) -> Killmail:
+    """
+    Convert kill object as received from ZKB (ESI killmail + zkb block)
+    to Killmail object. Names are left empty, to be filled later.
+    Raises KeyError, if kill object does not have some required key.
+    :param a_kill: kill dict
+    :return: Killmail
+    """
+    attackers = [Participant.from_dict(atk) for atk in a_kill['attackers']]
+    zkb = None
+    if 'zkb' in a_kill:
+        zkb = ZkbMeta.from_dict(a_kill['zkb'])
+    return Killmail(int(a_kill['killmail_id']),
+                    a_kill['killmail_time'],
+                    parse_kill_time(a_kill['killmail_time']),
+                    int(a_kill['solar_system_id']),
+                    Participant.from_dict(a_kill['victim'], True),
+                    attackers,
+                    zkb)
+
+
+def _make_benchmark_json(num_kills: int, num_attackers: int) -> str:
+    kills = []
+    for i in range(num_kills):
+        attackers = []
+        for j in range(num_attackers):
+            attackers.append({'character_id': 90000000 + j, 'corporation_id': 98000000 + j % 50,
+                              'alliance_id': 99000000 + j % 10, 'ship_type_id': 587 + j % 20,
+                              'weapon_type_id': 2488, 'damage_done': 100 + j, 'security_status': 0.5,
+                              'final_blow': j == 0})
+        kills.append({'killmail_id': 70000000 + i, 'killmail_time': '2018-01-02T03:04:05Z',
+                      'solar_system_id': 30000142,
+                      'victim': {'character_id': 91000000 + i, 'corporation_id': 98000001,
+                                 'ship_type_id': 670, 'damage_taken': 1000, 'items': [],
+                                 'position': {'x': 1.0, 'y': 2.0, 'z': 3.0}},
+                      'attackers': attackers,
+                      'zkb': {'locationID': 40009077, 'hash': 'abcdef', 'fittedValue': 10000.0,
+                              'totalValue': 12345678.9, 'points': 1, 'npc': False, 'solo': False,
+                              'awox': False}})
+    return json.dumps(kills)
+
+
+def benchmark(num_kills: int = 200, num_attackers: int = 100) -> None:
+    text = _make_benchmark_json(num_kills, num_attackers)
+
+    print('{} kills x {} attackers, orjson: {}'.format(num_kills, num_attackers, orjson is not None))
+    repeats = 5
+    t0 = time.perf_counter()
+    for _ in range(repeats):
+        [normalize_zkb_kill(a_kill) for a_kill in loads_json(text)]
+    secs = (time.perf_counter() - t0) / repeats
+    print('  parse + normalize: {:>10.0f} kills/sec'.format(num_kills / secs))
+
+    # memory held by parsed kills: raw dicts vs Killmail objects
+    for name, parse in [('dicts', lambda: json.loads(text)),
+                        ('Killmail', lambda: [normalize_zkb_kill(k) for k in json.loads(text)])]:
+        tracemalloc.start()
+        kills = parse()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del kills
+        print('  memory, {:<9} {:>10.0f} bytes/kill'.format(name + ':', size / num_kills))
+
+
+if __name__ == '__main__':
+    benchmark(*[int(arg) for arg in sys.argv[1:3]])
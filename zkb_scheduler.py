@@ -0,0 +1,55 @@
+from zkillboard import ZKB
+
+
+class ZKBPollScheduler:
+    """
+    Chooses delay before the next ZKB poll from rate limiting headers of the previous one.
+
+    ZKB allows x-bin-max-requests per hour and reports x-bin-request-count already made.
+    Remaining requests (keeping a safety margin) are spread over the next hour,
+    so while budget is plenty, polls go every min_interval seconds, and
+    as it runs out, polls get rarer. If server does not report its limits,
+    polls go every max_interval seconds.
+    If the server replies with Retry-After, the next poll waits exactly that long.
+    """
+    HOUR = 3600
+
+    def __init__(self, min_interval: float = 15, max_interval: float = 300, safety: float = 0.8):
+        """
+        :param min_interval: never poll more often than this
+        :param max_interval: poll interval when requests budget is not known
+        :param safety: use only this part of hourly requests budget
+        """
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.safety = safety
+        self.interval = min_interval
+        self._last_num_requests = 0
+
+    def next_interval(self, zkb: ZKB) -> float:
+        """
+        Call after each poll
+        :param zkb: ZKB object used for the poll
+        :return: number of seconds to wait before the next poll
+        """
+        requests_made = zkb.num_requests - self._last_num_requests
+        self._last_num_requests = zkb.num_requests
+        if (requests_made > 0) and (zkb.retry_after > 0):
+            # server told us exactly how long to wait
+            self.interval = zkb.retry_after
+            return self.interval
+        if zkb.max_requests <= 0:
+            if requests_made > 0:
+                # server does not tell its limits, be conservative
+                self.interval = self.max_interval
+            return self.interval
+        # one poll may take several requests, when catching up with several pages
+        requests_per_poll = max(requests_made, 1)
+        remaining = zkb.max_requests * self.safety - zkb.request_count
+        if remaining < requests_per_poll:
+            # budget is used up; hourly counter will go down in at most an hour
+            self.interval = max(self.HOUR / zkb.max_requests * requests_per_poll, self.max_interval)
+            return self.interval
+        interval = self.HOUR * requests_per_poll / remaining
+        self.interval = min(max(interval, self.min_interval), self.HOUR)
+        return self.interval
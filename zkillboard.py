@@ -1,7 +1,29 @@
 import datetime
-import json
+import email.utils
+import time
+from typing import Callable, Iterator, Optional
+
 import requests
 
+from http_session import create_http_session
+from killmail import Killmail
+from zkb_normalizer import ijson, iter_json_array, loads_json, normalize_zkb_kill
+
+
+def parse_retry_after(value: str) -> float:
+    """
+    Retry-After header can be either a number of seconds or an HTTP date
+    :return: number of seconds to wait, 0 if value is invalid
+    """
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError, IndexError):
+        return 0.0
+
 
 class ZKB:
     def __init__(self, options: dict=None):
@@ -15,9 +37,16 @@ class ZKB:
         self._url = ''
         self._modifiers = ''
         self._cache = None
+        self._session = None
         self._debug = False
         self.request_count = 0
         self.max_requests = 0
+        # number of HTTP requests actually sent (not served from cache)
+        self.num_requests = 0
+        # seconds to wait before next request, if server has told so in last response
+        self.retry_after = 0.0
+        # True if last go() got 304 Not Modified from server
+        self.not_modified = False
         self.clear_url()
         # parse options
         if options:
@@ -25,6 +54,13 @@ class ZKB:
                 self._debug = options['debug']
             if 'user_agent' in options:
                 self._headers['user-agent'] = options['user_agent']
+            if 'session' in options:
+                self._session = options['session']
+            if 'cache' in options:
+                # see zkb_cache.ZKBCache for interface
+                self._cache = options['cache']
+        if self._session is None:
+            self._session = create_http_session()
 
     def clear_url(self):
         self._url = self._BASE_URL_ZKB
@@ -35,7 +71,7 @@ class ZKB:
         self._url += '/'
         self._modifiers += mname
         self._modifiers += '_'
-        if mvalue:
+        if mvalue is not None:
             self._url += str(mvalue)
             self._url += '/'
             self._modifiers += str(mvalue)
@@ -134,135 +170,195 @@ class ZKB:
     def add_solarSystem(self, solarSystemID):
         self.add_modifier('solarSystemID', solarSystemID)
 
-    # Default cache lifetime set to 1 hour (3600 seconds)
+    # Responses are cached for cache ttl seconds, then revalidated with ETag / Last-Modified
+    def _check_response_headers(self, r: requests.Response) -> None:
+        """
+        Remember rate limiting information from response headers
+        """
+        self.num_requests += 1
+        self.retry_after = 0.0
+        if 'x-bin-request-count' in r.headers:
+            self.request_count = int(r.headers['x-bin-request-count'])
+        if 'x-bin-max-requests' in r.headers:
+            self.max_requests = int(r.headers['x-bin-max-requests'])
+        if 'retry-after' in r.headers:
+            self.retry_after = parse_retry_after(r.headers['retry-after'])
+
     def go(self):
         zkb_kills = []
         ret = ''
+        key = self._modifiers
+        cache_entry = None
+        self.not_modified = False
         # first, try to get from cache
         if self._cache:
-            ret = self._cache.get_json(self._modifiers)
+            ret = self._cache.get_json(key)
+            if (ret is not None) and (ret != ''):
+                parsed = self._cache.get_parsed(key)
+                if parsed is not None:
+                    return parsed
+            else:
+                # expired response still can be revalidated by server
+                cache_entry = self._cache.get_entry(key)
         if (ret is None) or (ret == ''):
+            ret = ''
             # either no cache exists or cache read error :( send request
+            headers = self._headers
+            if cache_entry is not None:
+                headers = dict(self._headers)
+                if cache_entry.etag != '':
+                    headers['if-none-match'] = cache_entry.etag
+                if cache_entry.last_modified != '':
+                    headers['if-modified-since'] = cache_entry.last_modified
             try:
                 if self._debug:
                     print('ZKB: Sending request! {0}'.format(self._url))
-                r = requests.get(self._url, headers=self._headers)
+                r = self._session.get(self._url, headers=headers)
+                self._check_response_headers(r)
                 if r.status_code == 200:
                     ret = r.text
-                    if 'x-bin-request-count' in r.headers:
-                        self.request_count = int(r.headers['x-bin-request-count'])
-                    if 'x-bin-max-requests' in r.headers:
-                        self.max_requests = int(r.headers['x-bin-max-requests'])
                     if self._debug:
                         print('ZKB: We are making {0} requests of {1} allowed per hour.'.
                               format(self.request_count, self.max_requests))
-                elif r.status_code == 403:
+                    if self._cache:
+                        self._cache.save_json(key, ret, r.headers.get('etag', ''),
+                                              r.headers.get('last-modified', ''))
+                elif (r.status_code == 304) and (cache_entry is not None):
+                    # not changed since last time, reuse cached response
+                    self.not_modified = True
+                    self._cache.touch(key)
+                    parsed = self._cache.get_parsed(key)
+                    if parsed is not None:
+                        return parsed
+                    ret = cache_entry.text
+                elif r.status_code in (403, 429):
                     # If you get an error 403, look at the Retry-After header.
-                    retry_after = r.headers['retry-after']
                     if self._debug:
-                        print('ZKB: ERROR: we got 403, retry-after: {0}'.format(retry_after))
+                        print('ZKB: ERROR: we got {0}, retry-after: {1}'.format(r.status_code, self.retry_after))
                 else:
                     if self._debug:
                         print('ZKB: ERROR: HTTP response code: {0}'.format(r.status_code))
             except requests.exceptions.RequestException as e:
                 if self._debug:
                     print(str(e))
-            # request done, see if we have a response
-            if ret != '':
-                if self._cache:
-                    self._cache.save_json(self._modifiers, ret)
         # parse response JSON, if we have one
         if (ret is not None) and (ret != ''):
             try:
-                zkb_kills = json.loads(ret)
+                zkb_kills = loads_json(ret)
             except ValueError:
                 # skip JSON parse errors
                 pass
-            utcnow = datetime.datetime.utcnow()
             try:
-                for a_kill in zkb_kills:
-                    # fix new keys format to old format, becuase templates use old keys
-                    a_kill['killID'] = a_kill['killmail_id']
-                    # init a kill datetime with an empty date
-                    a_kill['kill_dt'] = datetime.datetime(1970, 1, 1, 0, 0, 0)
-                    a_kill['killTime'] = a_kill['killmail_time']  # compatibility with old API
-                    # guess time format, ZKB has changed it over time
-                    # ValueError: time data '2015.07.08 01:11:00' does not match format '%Y-%m-%d %H:%M:%S'
-                    # current ZKB has a totallly different time format: "2017-06-07T17:02:57Z"
-                    try:
-                        a_kill['kill_dt'] = datetime.datetime.strptime(a_kill['killmail_time'], '%Y-%m-%dT%H:%M:%SZ')
-                    except ValueError:
-                        # some older formats
-                        try:
-                            a_kill['kill_dt'] = datetime.datetime.strptime(a_kill['killmail_time'], '%Y-%m-%d %H:%M:%S')
-                        except ValueError:
-                            a_kill['kill_dt'] = datetime.datetime.strptime(a_kill['killmail_time'], '%Y.%m.%d %H:%M:%S')
-                    # now calculate how long ago it happened
-                    delta = utcnow - a_kill['kill_dt']
-                    a_kill['days_ago'] = delta.days
-                    # convert to integers (zkillboard sends strings) and also initialize all keys used by templates
-                    a_kill['victim']['characterID'] = 0
-                    a_kill['victim']['characterName'] = ''
-                    a_kill['victim']['corporationID'] = 0
-                    a_kill['victim']['corporationName'] = ''
-                    a_kill['victim']['allianceID'] = 0
-                    a_kill['victim']['allianceName'] = ''
-                    a_kill['victim']['shipTypeID'] = 0
-                    a_kill['victim']['shipTypeName'] = ''
-                    # fix character_id => characterID
-                    if 'character_id' in a_kill['victim']:
-                        a_kill['victim']['characterID'] = int(a_kill['victim']['character_id'])
-                    # fix alliance_id => allianceID
-                    if 'alliance_id' in a_kill['victim']:
-                        a_kill['victim']['allianceID'] = int(a_kill['victim']['alliance_id'])
-                    # fix corporation_id => corporationID
-                    if 'corporation_id' in a_kill['victim']:
-                        a_kill['victim']['corporationID'] = int(a_kill['victim']['corporation_id'])
-                    # fix ship_type_id => shipTypeID
-                    if 'ship_type_id' in a_kill['victim']:
-                        a_kill['victim']['shipTypeID'] = int(a_kill['victim']['ship_type_id'])
-                        a_kill['victim']['shipTypeName'] = ''
-                    # process attackers
-                    for atk in a_kill['attackers']:
-                        atk['characterID'] = 0
-                        atk['characterName'] = ''
-                        atk['corporationID'] = 0
-                        atk['corporationName'] = ''
-                        atk['allianceID'] = 0
-                        atk['allianceName'] = ''
-                        atk['shipTypeID'] = 0
-                        atk['shipTypeName'] = ''
-                        atk['finalBlow'] = atk['final_blow']
-                        atk['factionID'] = 0
-                        atk['factionName'] = ''
-                        if 'character_id' in atk:
-                            atk['characterID'] = atk['character_id']
-                        if 'alliance_id' in atk:
-                            atk['allianceID'] = atk['alliance_id']
-                        if 'corporation_id' in atk:
-                            atk['corporationID'] = atk['corporation_id']
-                        if 'ship_type_id' in atk:
-                            atk['shipTypeID'] = atk['ship_type_id']
-                        if 'faction_id' in atk:
-                            # this is an NPC kill
-                            atk['factionID'] = atk['faction_id']
-                            # NPC is not a character, zero out char name/id
-                            atk['characterID'] = 0
-                            atk['characterName'] = ''
-                    finalBlow_attacker = dict()
-                    for atk in a_kill['attackers']:
-                        if atk['final_blow'] == True:
-                            finalBlow_attacker = atk
-                    a_kill['finalBlowAttacker'] = finalBlow_attacker
-                    # fix solar system id
-                    a_kill['solarSystemID'] = a_kill['solar_system_id']
-                    a_kill['solarSystemName'] = ''
-                    # kill price in ISK
-                    if 'zkb' in a_kill:
-                        if 'totalValue' in a_kill['zkb']:
-                            a_kill['zkb']['totalValueM'] = round(float(a_kill['zkb']['totalValue']) / 1000000.0)
-            except KeyError as k_e:
+                zkb_kills = [normalize_zkb_kill(a_kill) for a_kill in zkb_kills]
+                if self._cache:
+                    self._cache.save_parsed(key, zkb_kills)
+            except (KeyError, ValueError) as k_e:
+                zkb_kills = []
                 if self._debug:
                     print('It is possible that ZKB API has chabged (again).')
                     print(str(k_e))
         return zkb_kills
+
+
+    def iter_kills(self) -> Iterator[Killmail]:
+        """
+        Streaming version of go() for big responses (large page/limit queries, backfills):
+        response is decoded incrementally and kills are yielded one by one, so
+        memory usage is bounded by a single kill, not by the whole page.
+        Response cache is not used.
+        """
+        try:
+            if self._debug:
+                print('ZKB: Sending streaming request! {0}'.format(self._url))
+            with self._session.get(self._url, headers=self._headers, stream=True) as r:
+                self._check_response_headers(r)
+                if r.status_code != 200:
+                    if self._debug:
+                        print('ZKB: ERROR: HTTP response code: {0}'.format(r.status_code))
+                    return
+                if ijson is not None:
+                    r.raw.decode_content = True
+                    items = ijson.items(r.raw, 'item', use_float=True)
+                else:
+                    items = iter_json_array(r.iter_content(chunk_size=65536))
+                for a_kill in items:
+                    yield normalize_zkb_kill(a_kill)
+        except requests.exceptions.RequestException as e:
+            if self._debug:
+                print(str(e))
+        except (KeyError, ValueError) as k_e:
+            if self._debug:
+                print('It is possible that ZKB API has chabged (again).')
+                print(str(k_e))
+
+
+class ZKBRedisQ:
+    """
+    Streaming kills from zKillboard RedisQ service: each request long-polls
+    for up to ttw seconds and returns the next kill as soon as it is published.
+    See https://github.com/zKillboard/RedisQ
+    """
+    def __init__(self, options: dict=None):
+        self._url = 'https://redisq.zkillboard.com/listen.php'
+        self._headers = dict()
+        self._headers['accept'] = 'application/json'
+        self._headers['accept-encoding'] = 'gzip, deflate'
+        self._headers['user-agent'] = 'Python/ZKB agent'
+        self._queue_id = ''
+        self._ttw = 10
+        self._session = None
+        self._debug = False
+        self.error_backoff_secs = 5
+        # parse options
+        if options:
+            if 'debug' in options:
+                self._debug = options['debug']
+            if 'user_agent' in options:
+                self._headers['user-agent'] = options['user_agent']
+            if 'url' in options:
+                self._url = options['url']
+            if 'queue_id' in options:
+                # queueID lets RedisQ remember our position between reconnects
+                self._queue_id = options['queue_id']
+            if 'ttw' in options:
+                self._ttw = int(options['ttw'])
+            if 'session' in options:
+                self._session = options['session']
+        if self._session is None:
+            self._session = create_http_session()
+
+    def listen_once(self) -> Optional[Killmail]:
+        """
+        Wait for a single kill, at most ttw seconds
+        :return: normalized kill, or None if nothing was published in time
+        :raises requests.exceptions.RequestException, ValueError, KeyError: on errors
+        """
+        params = {'ttw': self._ttw}
+        if self._queue_id != '':
+            params['queueID'] = self._queue_id
+        r = self._session.get(self._url, params=params, headers=self._headers, timeout=self._ttw + 15)
+        if r.status_code != 200:
+            raise ValueError('RedisQ: HTTP response code: {0}'.format(r.status_code))
+        # {"package": {"killID": 123, "killmail": {...}, "zkb": {...}}} or {"package": null}
+        package = loads_json(r.content)['package']
+        if package is None:
+            return None
+        a_kill = package['killmail']
+        a_kill['zkb'] = package['zkb']
+        return normalize_zkb_kill(a_kill)
+
+    def listen(self, should_stop: Callable[[], bool]=None) -> Iterator[Killmail]:
+        """
+        Generator yielding kills the moment they are published.
+        Errors are retried after error_backoff_secs, so it runs forever,
+        or until should_stop() returns True.
+        """
+        while (should_stop is None) or (not should_stop()):
+            try:
+                a_kill = self.listen_once()
+                if a_kill is not None:
+                    yield a_kill
+            except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+                if self._debug:
+                    print('RedisQ: ERROR: {0}'.format(str(e)))
+                time.sleep(self.error_backoff_secs)